@@ -1,7 +1,26 @@
-from django.db.models import Aggregate
+from django.db.models import Aggregate, FloatField
 
 
-class Median(Aggregate):
+class Percentile(Aggregate):
+    """
+    The continuous percentile of the values of a group (interpolating between the two nearest values if necessary),
+    using the PostgreSQL ordered-set aggregate percentile_cont (null values are ignored)
+    :param expression: the field or expression of the values
+    :param percentile: the percentile, as a fraction between 0 and 1 (e.g. 0.9 for the 90th percentile)
+    """
+    name = 'Percentile'
+    function = 'PERCENTILE_CONT'
+    template = '%(function)s(%(percentile)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+
+    def __init__(self, expression, percentile, **extra):
+        percentile = float(percentile)
+        if not 0 <= percentile <= 1:
+            raise ValueError("The percentile must be between 0 and 1, not {0}".format(percentile))
+        super().__init__(expression, percentile=repr(percentile), output_field=FloatField(), **extra)
+
+
+class Median(Percentile):
     name = 'Median'
-    function = 'MEDIAN'
 
+    def __init__(self, expression, **extra):
+        super().__init__(expression, 0.5, **extra)
@@ -0,0 +1,238 @@
+from decimal import Decimal
+
+# NumPy is optional; without it calc_rep_concs always calculates with Decimals
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+######
+#
+#  Replicate Concentrations
+#
+#  These functions are pure (no queries, no side effects): the caller fetches the values once per extraction batch
+#  and once per sample, and then the concentrations of any number of replicates are calculated from them
+#
+######
+
+
+# the matrices whose concentration is scaled by a sample volume ratio, and the field holding that volume
+SAMPLE_VOLUME_FIELDS = {
+    'F': 'final_concentrated_sample_volume',
+    'W': 'final_concentrated_sample_volume',
+    'WW': 'final_concentrated_sample_volume',
+    'A': 'dissolution_volume',
+    'SM': 'post_dilution_volume'
+}
+
+# the unit-cancelling factor of each matrix (matrices not listed here, like solid manure, are not scaled)
+UNIT_FACTORS = {
+    # 1,000 microliters per 1 milliliter
+    'A': 1000,
+    'F': 1000,
+    'W': 1000,
+    'WW': 1000,
+    # 1,000,000 microliters per 1 liter
+    'LM': 1000000
+}
+
+
+def get_extraction_batch_context(extraction_batch, rt=None):
+    """
+    returns the values of an extraction batch (and of its active RT) needed to calculate replicate concentrations
+    :param extraction_batch: the extraction batch
+    :param rt: the active RT (the one with a null re_rt) of the extraction batch, if any
+    :return: a dict of the calculation values of the extraction batch
+    """
+    return {
+        "qpcr_reaction_volume": extraction_batch.qpcr_reaction_volume,
+        "qpcr_template_volume": extraction_batch.qpcr_template_volume,
+        "elution_volume": extraction_batch.elution_volume,
+        "extraction_volume": extraction_batch.extraction_volume,
+        "sample_dilution_factor": extraction_batch.sample_dilution_factor,
+        "rt_reaction_volume": rt.reaction_volume if rt else None,
+        "rt_template_volume": rt.template_volume if rt else None
+    }
+
+
+def get_sample_context(sample, matrix_code, final_concentrated_sample_volume=None):
+    """
+    returns the values of a sample needed to calculate replicate concentrations
+    :param sample: the sample
+    :param matrix_code: the code of the matrix of the sample
+    :param final_concentrated_sample_volume: the final_concentrated_sample_volume of the sample, if any
+    :return: a dict of the calculation values of the sample
+    """
+    return {
+        "matrix_code": matrix_code,
+        "total_volume_or_mass_sampled": sample.total_volume_or_mass_sampled,
+        "final_concentrated_sample_volume": final_concentrated_sample_volume,
+        "dissolution_volume": sample.dissolution_volume,
+        "post_dilution_volume": sample.post_dilution_volume
+    }
+
+
+def get_extraction_batch_factors(eb_context):
+    # the ratios are kept separate (rather than multiplied together) so that the Decimal results round the same way
+    # as when the whole formula is evaluated for a single replicate
+    rt_ratio = None
+    if eb_context.get('rt_reaction_volume') is not None:
+        rt_ratio = eb_context['rt_reaction_volume'] / eb_context['rt_template_volume']
+    return (eb_context['qpcr_reaction_volume'],
+            eb_context['qpcr_reaction_volume'] / eb_context['qpcr_template_volume'],
+            eb_context['elution_volume'] / eb_context['extraction_volume'],
+            eb_context['sample_dilution_factor'],
+            rt_ratio)
+
+
+def get_sample_factors(sample_context):
+    # returns None if the volume the matrix of the sample needs is missing
+    matrix = sample_context['matrix_code']
+    volume_ratio = None
+    if matrix in SAMPLE_VOLUME_FIELDS:
+        volume = sample_context[SAMPLE_VOLUME_FIELDS[matrix]]
+        if volume is None:
+            return None
+        volume_ratio = volume / sample_context['total_volume_or_mass_sampled']
+    return volume_ratio, UNIT_FACTORS.get(matrix)
+
+
+def calc_rep_concs(reps, eb_contexts, sample_contexts, exact=True):
+    """
+    calculates the concentrations of a batch of replicates
+    :param reps: an iterable of dicts with the gc_reaction, extraction_batch_id, sample_id, nucleic_acid_type_name,
+        and inhibition_dilution_factor of each replicate
+    :param eb_contexts: a dict of extraction batch ID to the dict returned by get_extraction_batch_context
+    :param sample_contexts: a dict of sample ID to the dict returned by get_sample_context
+    :param exact: if True, calculate with Decimals (as stored in replicate_concentration), giving exactly the same
+        results as evaluating the formula for one replicate at a time, otherwise calculate with NumPy float arrays
+        for uses where float precision is acceptable (falling back to Decimals if NumPy is not installed)
+    :return: a list of the replicate concentrations (None if any necessary value is missing), in the order of reps
+    """
+    if not exact and numpy is not None:
+        return calc_rep_concs_float(reps, eb_contexts, sample_contexts)
+
+    eb_factors = {}
+    sample_factors = {}
+    concs = []
+
+    for rep in reps:
+        gc_reaction = rep['gc_reaction']
+        inhibition_dilution_factor = rep['inhibition_dilution_factor']
+        # all reps must have gc_reaction and inhibition_dilution_factor
+        if gc_reaction is None or inhibition_dilution_factor is None:
+            concs.append(None)
+            continue
+        if not gc_reaction > Decimal('0'):
+            # a gc_reaction less than zero is impossible due to the model field definition
+            concs.append(0)
+            continue
+
+        # the ratios are only calculated once per extraction batch and per sample, and only when first needed
+        sample_id = rep['sample_id']
+        if sample_id not in sample_factors:
+            sample_factors[sample_id] = get_sample_factors(sample_contexts[sample_id])
+        extraction_batch_id = rep['extraction_batch_id']
+        if extraction_batch_id not in eb_factors:
+            eb_factors[extraction_batch_id] = get_extraction_batch_factors(eb_contexts[extraction_batch_id])
+        qpcr_reaction_volume, qpcr_ratio, elution_ratio, sample_dilution_factor, rt_ratio = eb_factors[
+            extraction_batch_id]
+
+        # reps with matrix F, W, or WW must have final_concentrated_sample_volume
+        # reps with matrix A must have dissolution_volume
+        # reps with matrix SM must have post_dilution_volume
+        # RNA reps must have a RT
+        nucleic_acid_type_name = rep['nucleic_acid_type_name'].upper()
+        if sample_factors[sample_id] is None or (nucleic_acid_type_name == 'RNA' and rt_ratio is None):
+            concs.append(None)
+            continue
+        volume_ratio, unit_factor = sample_factors[sample_id]
+
+        # first apply the universal expressions, then the RT expression if applicable,
+        # then the final volume-or-mass ratio expression, and finally the unit-cancelling expression
+        value = (gc_reaction / qpcr_reaction_volume) * qpcr_ratio * elution_ratio * sample_dilution_factor
+        if nucleic_acid_type_name == 'DNA':
+            value = value * inhibition_dilution_factor
+        elif nucleic_acid_type_name == 'RNA':
+            value = value * inhibition_dilution_factor * rt_ratio
+        if volume_ratio is not None:
+            value = value * volume_ratio
+        if unit_factor is not None:
+            value = value * unit_factor
+        concs.append(value)
+    return concs
+
+
+def calc_rep_concs_float(reps, eb_contexts, sample_contexts):
+    """
+    calculates the concentrations of a batch of replicates as floats, multiplying the factors of all the replicates
+    at once as NumPy arrays (see calc_rep_concs for the parameters)
+    :return: a list of the replicate concentrations as floats (None if any necessary value is missing)
+    """
+    reps = list(reps)
+    concs = [None] * len(reps)
+    # the combined factors of each extraction batch and sample, and the index of each one in its array
+    eb_indexes = {}
+    eb_volume_factors = []
+    eb_rt_ratios = []
+    sample_indexes = {}
+    sample_volume_factors = []
+    # the index, gc_reaction, inhibition dilution factor, and RT flag of the reps that have a concentration,
+    # and the indexes of the factors of their extraction batch and sample
+    calc_indexes = []
+    gc_reactions = []
+    inhibition_factors = []
+    rna_flags = []
+    rep_eb_indexes = []
+    rep_sample_indexes = []
+
+    for index, rep in enumerate(reps):
+        gc_reaction = rep['gc_reaction']
+        inhibition_dilution_factor = rep['inhibition_dilution_factor']
+        # the same rules as the Decimal calculation of calc_rep_concs
+        if gc_reaction is None or inhibition_dilution_factor is None:
+            continue
+        if not gc_reaction > Decimal('0'):
+            concs[index] = 0
+            continue
+
+        sample_id = rep['sample_id']
+        if sample_id not in sample_indexes:
+            factors = get_sample_factors(sample_contexts[sample_id])
+            sample_indexes[sample_id] = len(sample_volume_factors) if factors is not None else None
+            if factors is not None:
+                volume_ratio, unit_factor = factors
+                sample_volume_factors.append((float(volume_ratio) if volume_ratio is not None else 1.0)
+                                             * (unit_factor if unit_factor is not None else 1.0))
+        extraction_batch_id = rep['extraction_batch_id']
+        if extraction_batch_id not in eb_indexes:
+            qpcr_reaction_volume, qpcr_ratio, elution_ratio, sample_dilution_factor, rt_ratio = \
+                get_extraction_batch_factors(eb_contexts[extraction_batch_id])
+            eb_indexes[extraction_batch_id] = len(eb_volume_factors)
+            eb_volume_factors.append(float(qpcr_ratio) * float(elution_ratio) * float(sample_dilution_factor)
+                                     / float(qpcr_reaction_volume))
+            eb_rt_ratios.append(float(rt_ratio) if rt_ratio is not None else None)
+        eb_index = eb_indexes[extraction_batch_id]
+
+        nucleic_acid_type_name = rep['nucleic_acid_type_name'].upper()
+        if sample_indexes[sample_id] is None or (nucleic_acid_type_name == 'RNA' and eb_rt_ratios[eb_index] is None):
+            continue
+        calc_indexes.append(index)
+        gc_reactions.append(float(gc_reaction))
+        # only DNA and RNA reps are scaled by their inhibition dilution factor
+        inhibition_factors.append(
+            float(inhibition_dilution_factor) if nucleic_acid_type_name in ('DNA', 'RNA') else 1.0)
+        rna_flags.append(nucleic_acid_type_name == 'RNA')
+        rep_eb_indexes.append(eb_index)
+        rep_sample_indexes.append(sample_indexes[sample_id])
+
+    if calc_indexes:
+        rt_ratios = numpy.array([rt_ratio if rt_ratio is not None else 1.0 for rt_ratio in eb_rt_ratios])
+        rep_eb_indexes = numpy.array(rep_eb_indexes)
+        values = (numpy.array(gc_reactions) * numpy.array(eb_volume_factors)[rep_eb_indexes]
+                  * numpy.array(inhibition_factors) * numpy.where(rna_flags, rt_ratios[rep_eb_indexes], 1.0)
+                  * numpy.array(sample_volume_factors)[numpy.array(rep_sample_indexes)])
+        for index, value in zip(calc_indexes, values.tolist()):
+            concs[index] = value
+    return concs
@@ -0,0 +1,48 @@
+import math
+from django.core.management.base import BaseCommand
+from liliapi.models import PCRReplicate
+
+
+class Command(BaseCommand):
+    help = "Checks the stored replicate concentrations against the concentration formula, calculating them in " \
+           "batches as floats (with NumPy, if it is installed), and optionally recalculates the replicates that are " \
+           "off (exactly, with Decimals)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help="the number of replicates to check at a time")
+        parser.add_argument('--tolerance', type=float, default=1e-9,
+                            help="the relative difference above which a stored concentration is off")
+        parser.add_argument('--fix', action='store_true', help="recalculate the replicates that are off")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        tolerance = options['tolerance']
+        reps = PCRReplicate.objects.select_related(
+            'sample_extraction__sample__matrix', 'sample_extraction__extraction_batch',
+            'sample_extraction__inhibition_dna', 'sample_extraction__inhibition_rna',
+            'pcrreplicate_batch__target__nucleic_acid_type').order_by('id')
+        checked_count = 0
+        off_ids = []
+        last_id = 0
+        while True:
+            batch = list(reps.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            for rep, rep_conc in zip(batch, PCRReplicate.objects.calc_concs(batch, exact=False)):
+                stored = rep.replicate_concentration
+                if stored is None or rep_conc is None:
+                    if (stored is None) != (rep_conc is None):
+                        off_ids.append(rep.id)
+                elif not math.isclose(float(stored), float(rep_conc), rel_tol=tolerance):
+                    off_ids.append(rep.id)
+            checked_count += len(batch)
+            last_id = batch[-1].id
+        self.stdout.write("checked {0} replicates, of which {1} have a concentration that is off".format(
+            checked_count, len(off_ids)))
+
+        if off_ids and options['fix']:
+            for index in range(0, len(off_ids), batch_size):
+                PCRReplicate.objects.recalc(PCRReplicate.objects.filter(id__in=off_ids[index:index + batch_size]),
+                                            recalc_invalid=False)
+            self.stdout.write(self.style.SUCCESS("recalculated {0} replicates".format(len(off_ids))))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from liliapi.models import FinalSampleMeanConcentration
+
+
+class Command(BaseCommand):
+    help = "Recalculates the stale FSMCs (and their reps) in batches, such as all of the FSMCs that migration " \
+           "0004_fsmc_versions marks as stale, so that requests do not have to recalculate them when they are read"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="the number of stale FSMCs to recalculate in each transaction")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        stale_fsmcs = FinalSampleMeanConcentration.objects.filter(computed_version__lt=F('input_version'))
+        recalc_count = 0
+        last_id = 0
+        while True:
+            # walk the stale FSMCs by ID, so that FSMCs that cannot be brought up to date are not selected again
+            fsmc_ids = list(stale_fsmcs.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[
+                :batch_size])
+            if not fsmc_ids:
+                break
+            with transaction.atomic():
+                recalc_count += FinalSampleMeanConcentration.objects.recalc_stale(
+                    FinalSampleMeanConcentration.objects.filter(id__in=fsmc_ids))
+            last_id = fsmc_ids[-1]
+            self.stdout.write("recalculated {0} stale FSMCs".format(recalc_count))
+        self.stdout.write(self.style.SUCCESS("recalculated {0} stale FSMCs in total".format(recalc_count)))
@@ -0,0 +1,36 @@
+# Generated by Django 2.2.10 on 2026-10-16 21:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('liliapi', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pcrreplicate',
+            name='recalc_pending',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='PendingRecalc',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.CharField(max_length=128)),
+                ('level_id', models.IntegerField()),
+                ('target', models.IntegerField(blank=True, null=True)),
+                ('recalc_rep_conc', models.BooleanField(default=True)),
+                ('recalc_invalid', models.BooleanField(default=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'lili_pendingrecalc',
+                'ordering': ['id'],
+                'unique_together': {('level', 'level_id', 'target')},
+                'constraints': [models.UniqueConstraint(condition=models.Q(target__isnull=True), fields=('level', 'level_id'), name='lili_pendingrecalc_unique_all_targets')],
+            },
+        ),
+    ]
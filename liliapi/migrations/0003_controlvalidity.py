@@ -0,0 +1,74 @@
+# Generated by Django 2.2.10 on 2026-10-16 21:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_controlvalidities(apps, schema_editor):
+    ControlValidity = apps.get_model('liliapi', 'ControlValidity')
+    ExtractionBatch = apps.get_model('liliapi', 'ExtractionBatch')
+    PCRReplicateBatch = apps.get_model('liliapi', 'PCRReplicateBatch')
+    ReverseTranscription = apps.get_model('liliapi', 'ReverseTranscription')
+
+    ext_pos_dna_invalids = dict(ExtractionBatch.objects.values_list('id', 'ext_pos_dna_invalid'))
+    # only the active RT (the one with a null re_rt) of an extraction batch is valid
+    ext_pos_rna_rt_invalids = {}
+    for extraction_batch_id, ext_pos_rna_rt_invalid in ReverseTranscription.objects.filter(
+            re_rt=None).order_by('id').values_list('extraction_batch', 'ext_pos_rna_rt_invalid'):
+        ext_pos_rna_rt_invalids.setdefault(extraction_batch_id, ext_pos_rna_rt_invalid)
+
+    control_validities = {}
+    for extraction_batch_id, target_id, nucleic_acid_type_name, ext_neg_invalid, rt_neg_invalid, pcr_neg_invalid in (
+            PCRReplicateBatch.objects.values_list(
+                'extraction_batch', 'target', 'target__nucleic_acid_type__name',
+                'ext_neg_invalid', 'rt_neg_invalid', 'pcr_neg_invalid')):
+        control_validity = control_validities.get((extraction_batch_id, target_id))
+        if control_validity is None:
+            control_validity = ControlValidity(
+                extraction_batch_id=extraction_batch_id, target_id=target_id,
+                ext_neg_invalid=False, rt_neg_invalid=False, pcr_neg_invalid=False,
+                ext_pos_rna_rt_invalid=ext_pos_rna_rt_invalids.get(extraction_batch_id, False),
+                ext_pos_dna_invalid=ext_pos_dna_invalids[extraction_batch_id])
+            control_validity.nucleic_acid_type_name = nucleic_acid_type_name.upper()
+            control_validities[(extraction_batch_id, target_id)] = control_validity
+        control_validity.ext_neg_invalid = control_validity.ext_neg_invalid or ext_neg_invalid
+        control_validity.rt_neg_invalid = control_validity.rt_neg_invalid or rt_neg_invalid
+        control_validity.pcr_neg_invalid = control_validity.pcr_neg_invalid or pcr_neg_invalid
+
+    for control_validity in control_validities.values():
+        control_validity.controls_invalid = (
+                control_validity.ext_neg_invalid or control_validity.rt_neg_invalid
+                or control_validity.pcr_neg_invalid
+                or (control_validity.nucleic_acid_type_name == 'RNA' and control_validity.ext_pos_rna_rt_invalid)
+                or (control_validity.nucleic_acid_type_name == 'DNA' and control_validity.ext_pos_dna_invalid))
+    ControlValidity.objects.bulk_create(control_validities.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('liliapi', '0002_pendingrecalc'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ControlValidity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ext_neg_invalid', models.BooleanField(default=False)),
+                ('rt_neg_invalid', models.BooleanField(default=False)),
+                ('pcr_neg_invalid', models.BooleanField(default=False)),
+                ('ext_pos_rna_rt_invalid', models.BooleanField(default=False)),
+                ('ext_pos_dna_invalid', models.BooleanField(default=True)),
+                ('controls_invalid', models.BooleanField(default=True)),
+                ('extraction_batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='controlvalidities', to='liliapi.ExtractionBatch')),
+                ('target', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='controlvalidities', to='liliapi.Target')),
+            ],
+            options={
+                'verbose_name_plural': 'controlvalidities',
+                'db_table': 'lili_controlvalidity',
+                'unique_together': {('extraction_batch', 'target')},
+            },
+        ),
+        migrations.RunPython(populate_controlvalidities, migrations.RunPython.noop),
+    ]
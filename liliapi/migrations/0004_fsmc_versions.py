@@ -0,0 +1,32 @@
+# Generated by Django 2.2.10 on 2026-10-16 21:58
+
+from django.db import migrations, models
+
+
+# FSMCs computed before versioning were only kept up to date by recalculating on read,
+# so treat them all as stale until they are first recomputed
+# (run the recalc_stale_fsmcs management command after migrating to recompute them all up front)
+def mark_fsmcs_stale(apps, schema_editor):
+    FinalSampleMeanConcentration = apps.get_model('liliapi', 'FinalSampleMeanConcentration')
+    FinalSampleMeanConcentration.objects.update(input_version=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('liliapi', '0003_controlvalidity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='finalsamplemeanconcentration',
+            name='computed_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='finalsamplemeanconcentration',
+            name='input_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(mark_fsmcs_stale, migrations.RunPython.noop),
+    ]
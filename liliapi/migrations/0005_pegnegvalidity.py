@@ -0,0 +1,50 @@
+# Generated by Django 2.2.10 on 2026-10-16 22:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_pegnegvalidities(apps, schema_editor):
+    PegNegValidity = apps.get_model('liliapi', 'PegNegValidity')
+    PCRReplicate = apps.get_model('liliapi', 'PCRReplicate')
+
+    # if even a single one of the peg_neg reps is invalid, the peg_neg is invalid for the target
+    invalids = {}
+    for peg_neg_id, target_id, invalid in PCRReplicate.objects.filter(
+            sample_extraction__sample__record_type=2).values_list(
+            'sample_extraction__sample', 'pcrreplicate_batch__target', 'invalid'):
+        invalids[(peg_neg_id, target_id)] = invalids.get((peg_neg_id, target_id), False) or invalid
+    # and a peg_neg without any reps (because it has not yet been extracted) is invalid for the targets of its samples
+    for peg_neg_id, target_id in PCRReplicate.objects.filter(
+            sample_extraction__sample__peg_neg__isnull=False).values_list(
+            'sample_extraction__sample__peg_neg', 'pcrreplicate_batch__target').distinct():
+        invalids.setdefault((peg_neg_id, target_id), True)
+
+    PegNegValidity.objects.bulk_create(
+        [PegNegValidity(peg_neg_id=peg_neg_id, target_id=target_id, invalid=invalid)
+         for (peg_neg_id, target_id), invalid in invalids.items()], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('liliapi', '0004_fsmc_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PegNegValidity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('invalid', models.BooleanField(default=True)),
+                ('peg_neg', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pegnegvalidities', to='liliapi.Sample')),
+                ('target', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pegnegvalidities', to='liliapi.Target')),
+            ],
+            options={
+                'verbose_name_plural': 'pegnegvalidities',
+                'db_table': 'lili_pegnegvalidity',
+                'unique_together': {('peg_neg', 'target')},
+            },
+        ),
+        migrations.RunPython(populate_pegnegvalidities, migrations.RunPython.noop),
+    ]
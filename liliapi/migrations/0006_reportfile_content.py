@@ -0,0 +1,43 @@
+# Generated by Django 2.2.10 on 2026-10-16 22:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('liliapi', '0005_pegnegvalidity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportfile',
+            name='content_encoding',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='reportfile',
+            name='content_type',
+            field=models.CharField(blank=True, max_length=128),
+        ),
+        migrations.AddField(
+            model_name='reportfile',
+            name='file_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reportfilehistory',
+            name='content_encoding',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='reportfilehistory',
+            name='content_type',
+            field=models.CharField(blank=True, max_length=128),
+        ),
+        migrations.AddField(
+            model_name='reportfilehistory',
+            name='file_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
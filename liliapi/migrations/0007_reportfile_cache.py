@@ -0,0 +1,33 @@
+# Generated by Django 2.2.10 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('liliapi', '0006_reportfile_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportfile',
+            name='cache_key',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='reportfile',
+            name='data_version',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='reportfilehistory',
+            name='cache_key',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='reportfilehistory',
+            name='data_version',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 2.2.10 on 2026-10-17 10:05
+
+from django.db import migrations
+
+
+# the custom median aggregate that used to be installed by hand (from create_aggregate_median.sql),
+# now replaced by the built-in percentile_cont ordered-set aggregate (see liliapi.aggregates)
+CREATE_LEGACY_MEDIAN = """
+CREATE OR REPLACE FUNCTION _final_median(anyarray) RETURNS float8 AS $$
+  WITH q AS
+  (
+     SELECT val
+     FROM unnest($1) val
+     WHERE VAL IS NOT NULL
+     ORDER BY 1
+  ),
+  cnt AS
+  (
+    SELECT COUNT(*) AS c FROM q
+  )
+  SELECT AVG(val)::float8
+  FROM
+  (
+    SELECT val FROM q
+    LIMIT  2 - MOD((SELECT c FROM cnt), 2)
+    OFFSET GREATEST(CEIL((SELECT c FROM cnt) / 2.0) - 1,0)
+  ) q2;
+$$ LANGUAGE SQL IMMUTABLE;
+
+DROP AGGREGATE IF EXISTS median(anyelement);
+CREATE AGGREGATE median(anyelement) (
+  SFUNC=array_append,
+  STYPE=anyarray,
+  FINALFUNC=_final_median,
+  INITCOND='{}'
+);
+"""
+
+DROP_LEGACY_MEDIAN = """
+DROP AGGREGATE IF EXISTS median(anyelement);
+DROP FUNCTION IF EXISTS _final_median(anyarray);
+"""
+
+
+# percentile_cont and the legacy median aggregate only exist in PostgreSQL
+def drop_legacy_median(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_LEGACY_MEDIAN)
+
+
+def create_legacy_median(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_LEGACY_MEDIAN)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('liliapi', '0007_reportfile_cache'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_legacy_median, create_legacy_median),
+    ]
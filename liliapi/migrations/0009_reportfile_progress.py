@@ -0,0 +1,63 @@
+# Generated by Django 2.2.10 on 2026-10-17 14:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('liliapi', '0008_percentile_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportfile',
+            name='elapsed_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reportfile',
+            name='phase',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='reportfile',
+            name='rows_processed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='reportfile',
+            name='rows_total',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reportfile',
+            name='started_datetime',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reportfilehistory',
+            name='elapsed_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reportfilehistory',
+            name='phase',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='reportfilehistory',
+            name='rows_processed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='reportfilehistory',
+            name='rows_total',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reportfilehistory',
+            name='started_datetime',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
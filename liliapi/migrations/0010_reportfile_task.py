@@ -0,0 +1,34 @@
+# Generated by Django 2.2.10 on 2026-10-17 16:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('liliapi', '0009_reportfile_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportfile',
+            name='requested_datetime',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, null=True),
+        ),
+        migrations.AddField(
+            model_name='reportfile',
+            name='task_id',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='reportfilehistory',
+            name='requested_datetime',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, null=True),
+        ),
+        migrations.AddField(
+            model_name='reportfilehistory',
+            name='task_id',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.10 on 2026-10-17 17:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('liliapi', '0010_reportfile_task'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportfile',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='reportfilehistory',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddConstraint(
+            model_name='reportfile',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 1), models.Q(_negated=True, idempotency_key='')), fields=('idempotency_key',), name='lili_reportfile_unique_in_progress'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.10 on 2026-10-17 19:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('liliapi', '0011_reportfile_idempotency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportfile',
+            name='phase_metrics',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='reportfilehistory',
+            name='phase_metrics',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.10 on 2026-10-17 19:58
+
+from django.db import migrations
+
+
+# report files created before their size was recorded count as empty in the bytes quota of the retention task,
+# so measure their files in the storage
+def populate_file_sizes(apps, schema_editor):
+    ReportFile = apps.get_model('liliapi', 'ReportFile')
+
+    for report_file in ReportFile.objects.filter(file_size__isnull=True).exclude(file='').exclude(file__isnull=True):
+        try:
+            file_size = report_file.file.size
+        except OSError:
+            # the file is already missing from the storage
+            continue
+        ReportFile.objects.filter(id=report_file.id).update(file_size=file_size)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('liliapi', '0012_reportfile_phase_metrics'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_file_sizes, migrations.RunPython.noop),
+    ]
@@ -1,13 +1,26 @@
+import json
+import uuid
+import logging
+import statistics
+import hashlib
+import threading
+from contextlib import contextmanager
+from collections import Counter, OrderedDict
 from decimal import Decimal
-from datetime import date
-from django.db import models
-from django.db.models import F
+from datetime import date, timedelta
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q
 from django.db.models.signals import post_delete
 from django.dispatch import receiver
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator
 from django.conf import settings
 from simple_history.models import HistoricalRecords
+from liliapi.calculations import calc_rep_concs, get_extraction_batch_context, get_sample_context
+
+
+logger = logging.getLogger(__name__)
 
 
 # Users will be stored in the core User model instead of a custom model.
@@ -39,31 +52,193 @@ def get_sci_val(decimal_val):
     return sci_val
 
 
-def recalc_reps(level, level_id, target=None, recalc_rep_conc=True, recalc_invalid=True):
-    reps = None
+def bulk_create_update_history(model, objs):
+    """
+    creates the history records that a regular save would have created for objects updated in bulk
+    :param model: the model class of the objects
+    :param objs: the updated model instances
+    :return: the created history records
+    """
+    history_model = model.history.model
+    history_date = timezone.now()
+    history_records = [history_model(
+        history_date=history_date,
+        history_type='~',
+        **{field.attname: getattr(obj, field.attname) for field in obj._meta.fields
+           if field.name not in history_model._history_excluded_fields}
+    ) for obj in objs]
+    return history_model.objects.bulk_create(history_records)
+
+
+def get_recalc_reps_filter(level, level_ids, target=None):
+    """
+    returns the filter for the PCR replicates affected by changes to records of a given level
+    :param level: the name of the model of the changed records
+    :param level_ids: the IDs of the changed records (for FinalSampleMeanConcentration, the IDs of the samples)
+    :param target: the ID of the target (only used for FinalSampleMeanConcentration)
+    :return: a Q object for filtering PCRReplicate, or None if the level is unknown
+    """
     if level == 'Sample':
-        reps = PCRReplicate.objects.filter(sample_extraction__sample=level_id)
+        return Q(sample_extraction__sample__in=level_ids)
     elif level == 'FinalSampleMeanConcentration':
-        reps = PCRReplicate.objects.filter(sample_extraction__sample=level_id,
-                                           pcrreplicate_batch__target__exact=target)
+        return Q(sample_extraction__sample__in=level_ids, pcrreplicate_batch__target__exact=target)
     elif level == 'ExtractionBatch':
-        reps = PCRReplicate.objects.filter(sample_extraction__extraction_batch=level_id)
+        return Q(sample_extraction__extraction_batch__in=level_ids)
     elif level == 'PCRReplicateBatch':
-        reps = PCRReplicate.objects.filter(pcrreplicate_batch=level_id)
+        return Q(pcrreplicate_batch__in=level_ids)
     # elif level == 'SampleExtraction':
-    #     reps = PCRReplicate.objects.filter(sample_extraction=level_id)
+    #     return Q(sample_extraction__in=level_ids)
     elif level == 'Inhibition':
-        reps_dna = PCRReplicate.objects.filter(sample_extraction__inhibition_dna=level_id)
-        reps_rna = PCRReplicate.objects.filter(sample_extraction__inhibition_rna=level_id)
-        reps = reps_dna.union(reps_rna).distinct()
-    if reps:
-        for rep in reps:
-            if recalc_rep_conc:
-                rep.replicate_concentration = rep.calc_rep_conc()
-            if recalc_invalid and rep.invalid_override is None:
-                rep.invalid = rep.calc_invalid()
-            if recalc_rep_conc or recalc_invalid:
-                rep.save()
+        return Q(sample_extraction__inhibition_dna__in=level_ids) | Q(sample_extraction__inhibition_rna__in=level_ids)
+    return None
+
+
+def recalc_reps(level, level_id, target=None, recalc_rep_conc=True, recalc_invalid=True):
+    unit_of_work = RecalcUnitOfWork.get_active()
+    if unit_of_work is not None:
+        return unit_of_work.add_reps(level, level_id, target, recalc_rep_conc, recalc_invalid, run_now=True)
+    reps_filter = get_recalc_reps_filter(level, [level_id], target)
+    if reps_filter is not None and (recalc_rep_conc or recalc_invalid):
+        PCRReplicate.objects.recalc(PCRReplicate.objects.filter(reps_filter), recalc_rep_conc, recalc_invalid)
+
+
+def schedule_recalc_reps(level, level_id, target=None, recalc_rep_conc=True, recalc_invalid=True):
+    """
+    queues a recalc_reps call to be run by a celery worker (or runs it right away if RECALC_ASYNC is off),
+    marking the affected PCR replicates as pending recalculation and the affected FSMCs as stale until it has run
+    """
+    unit_of_work = RecalcUnitOfWork.get_active()
+    if unit_of_work is not None:
+        return unit_of_work.add_reps(level, level_id, target, recalc_rep_conc, recalc_invalid, run_now=False)
+    if not settings.RECALC_ASYNC:
+        return recalc_reps(level, level_id, target, recalc_rep_conc, recalc_invalid)
+    reps_filter = get_recalc_reps_filter(level, [level_id], target)
+    if reps_filter is None or not (recalc_rep_conc or recalc_invalid):
+        return
+
+    # only one pending recalculation is kept per level-id-target combo
+    # (the lock waits for a worker already running this one, which then deletes it, so that a new one is created
+    # rather than merged into one that has already read the values changed by this save)
+    with transaction.atomic():
+        pending, created = PendingRecalc.objects.select_for_update().get_or_create(
+            level=level, level_id=level_id, target=target,
+            defaults={'recalc_rep_conc': recalc_rep_conc, 'recalc_invalid': recalc_invalid})
+        if not created and ((recalc_rep_conc and not pending.recalc_rep_conc)
+                            or (recalc_invalid and not pending.recalc_invalid)):
+            pending.recalc_rep_conc = pending.recalc_rep_conc or recalc_rep_conc
+            pending.recalc_invalid = pending.recalc_invalid or recalc_invalid
+            pending.save()
+
+    reps = PCRReplicate.objects.filter(reps_filter)
+    sample_targets = set(reps.values_list('sample_extraction__sample', 'pcrreplicate_batch__target').distinct())
+    reps.filter(recalc_pending=False).update(recalc_pending=True)
+    if sample_targets:
+        fsmcs_filter = Q()
+        for sample_id, target_id in sample_targets:
+            fsmcs_filter |= Q(sample=sample_id, target=target_id)
+        FinalSampleMeanConcentration.objects.filter(fsmcs_filter).update(input_version=F('input_version') + 1)
+
+    if created:
+        transaction.on_commit(lambda: PendingRecalc.objects.start_worker(pending.id))
+
+
+# the recalculation unit of work active in the current thread, if any
+_recalc_unit_of_work = threading.local()
+
+
+class RecalcUnitOfWork(object):
+    """
+    Recalculations requested by the saves within a transaction, each distinct one run once when it is committed
+    """
+
+    def __init__(self):
+        # level-level_id-target combo to its [recalc_rep_conc, recalc_invalid, run_now] flags
+        self.rep_scopes = {}
+        self.sample_targets = set()
+        self.peg_neg_targets = set()
+        self.requested_count = 0
+        self.run_count = 0
+        self.deduped_count = 0
+
+    @staticmethod
+    def get_active():
+        return getattr(_recalc_unit_of_work, 'active', None)
+
+    def add_reps(self, level, level_id, target=None, recalc_rep_conc=True, recalc_invalid=True, run_now=True):
+        if get_recalc_reps_filter(level, [level_id], target) is None or not (recalc_rep_conc or recalc_invalid):
+            return
+        self.requested_count += 1
+        flags = self.rep_scopes.setdefault((level, level_id, target), [False, False, False])
+        flags[0] = flags[0] or recalc_rep_conc
+        flags[1] = flags[1] or recalc_invalid
+        flags[2] = flags[2] or run_now
+
+    def add_sample_target(self, sample_id, target_id):
+        self.requested_count += 1
+        self.sample_targets.add((sample_id, target_id))
+
+    def add_peg_neg_target(self, peg_neg_id, target_id):
+        self.requested_count += 1
+        self.peg_neg_targets.add((peg_neg_id, target_id))
+
+    def flush(self):
+        # stop collecting, so that the saves made by the recalculations below run as usual
+        if self.get_active() is self:
+            _recalc_unit_of_work.active = None
+
+        with transaction.atomic():
+            # propagate the peg_negs first, so that the data reps see their current validity
+            self.sample_targets.update(PegNegValidity.objects.propagate(self.peg_neg_targets))
+            self.run_count += len(self.peg_neg_targets)
+
+            # merge the rep scopes to run now into a single recalc, and queue the others
+            reps_filter = Q()
+            recalc_rep_conc = False
+            recalc_invalid = False
+            for (level, level_id, target), (scope_rep_conc, scope_invalid, run_now) in self.rep_scopes.items():
+                self.run_count += 1
+                if run_now or not settings.RECALC_ASYNC:
+                    reps_filter |= get_recalc_reps_filter(level, [level_id], target)
+                    recalc_rep_conc = recalc_rep_conc or scope_rep_conc
+                    recalc_invalid = recalc_invalid or scope_invalid
+                else:
+                    schedule_recalc_reps(level, level_id, target, scope_rep_conc, scope_invalid)
+            if reps_filter:
+                reps = PCRReplicate.objects.filter(reps_filter)
+                # the rep recalc already updates the FSMCs of its reps
+                self.sample_targets.difference_update(
+                    reps.values_list('sample_extraction__sample', 'pcrreplicate_batch__target').distinct())
+                PCRReplicate.objects.recalc(reps, recalc_rep_conc, recalc_invalid)
+
+            # update the remaining FSMCs
+            FinalSampleMeanConcentration.objects.recalc(self.sample_targets)
+            self.run_count += len(self.sample_targets)
+
+        # flush runs on commit, with no caller to return the summary to
+        self.deduped_count = self.requested_count - self.run_count
+        logger.info("recalculation unit of work ran %s of %s requested recalculations (%s deduped)",
+                    self.run_count, self.requested_count, self.deduped_count)
+
+
+@contextmanager
+def recalc_unit_of_work():
+    """
+    runs the enclosed block in a transaction, running each distinct recalculation requested by its saves once on commit
+    :return: the RecalcUnitOfWork (the active one, if any), whose counts are set once it has been flushed
+    """
+    unit_of_work = RecalcUnitOfWork.get_active()
+    if unit_of_work is not None:
+        yield unit_of_work
+        return
+    unit_of_work = RecalcUnitOfWork()
+    _recalc_unit_of_work.active = unit_of_work
+    try:
+        with transaction.atomic():
+            transaction.on_commit(unit_of_work.flush)
+            yield unit_of_work
+    finally:
+        if RecalcUnitOfWork.get_active() is unit_of_work:
+            _recalc_unit_of_work.active = None
 
 
 class NonnegativeIntegerField(models.IntegerField):
@@ -153,6 +328,45 @@ class NameModel(HistoryModel):
         abstract = True
 
 
+class CalculationInputModel(HistoryModel):
+    """
+    An abstract base class model to detect changes to the fields that feed replicate calculations.
+    """
+
+    # the fields (by attname) whose values are used by PCRReplicate.calc_rep_conc or PCRReplicate.calc_invalid
+    calculation_input_fields = ()
+
+    # snapshot the calculation input values of every instance loaded from the database
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(CalculationInputModel, cls).from_db(db, field_names, values)
+        instance.snapshot_calculation_inputs()
+        return instance
+
+    def get_calculation_inputs(self):
+        return {field: getattr(self, field) for field in self.calculation_input_fields}
+
+    def snapshot_calculation_inputs(self):
+        # instances loaded without some input fields (e.g., with only() or defer()) cannot be compared
+        if self.get_deferred_fields().intersection(self.calculation_input_fields):
+            self._calculation_inputs = None
+        else:
+            self._calculation_inputs = self.get_calculation_inputs()
+
+    # the value a calculation input field had when the instance was loaded (None if there is no snapshot)
+    def get_loaded_calculation_input(self, field):
+        return (getattr(self, '_calculation_inputs', None) or {}).get(field)
+
+    # new instances, and instances without a snapshot, are always considered changed
+    @property
+    def calculation_inputs_changed(self):
+        old_inputs = getattr(self, '_calculation_inputs', None)
+        return old_inputs is None or old_inputs != self.get_calculation_inputs()
+
+    class Meta:
+        abstract = True
+
+
 ######
 #
 #  Samples
@@ -160,7 +374,7 @@ class NameModel(HistoryModel):
 ######
 
 
-class Sample(HistoryModel):
+class Sample(CalculationInputModel):
     """
     Sample
     """
@@ -201,31 +415,18 @@ class Sample(HistoryModel):
     record_type = models.ForeignKey('RecordType', models.PROTECT, default=1)
     history = HistoricalRecords(inherit=True, table_name='lili_samplehistory',
                                 custom_model_name=lambda x: f'{x}History')
+    calculation_input_fields = ('matrix_id', 'total_volume_or_mass_sampled', 'dissolution_volume',
+                                'post_dilution_volume', 'peg_neg_id', 'record_type_id')
 
     # override the save method to check if a rep calc value changed, and if so, recalc rep conc and rep invalid and FSMC
     def save(self, *args, **kwargs):
-
-        # do_recalc_reps = False
-        #
-        # # a value can only be changed if the instance already exists
-        # if self.pk:
-        #     old_sample = Sample.objects.get(id=self.pk)
-        #     if self.matrix.id != old_sample.matrix.id:
-        #         do_recalc_reps = True
-        #     if self.total_volume_or_mass_sampled != old_sample.total_volume_or_mass_sampled:
-        #         do_recalc_reps = True
-        #     if self.matrix.code == 'A' and self.dissolution_volume != old_sample.dissolution_volume:
-        #         do_recalc_reps = True
-        #     elif self.matrix.code == 'SM' and self.post_dilution_volume != old_sample.post_dilution_volume:
-        #         do_recalc_reps = True
+        do_recalc_reps = self.calculation_inputs_changed
 
         super(Sample, self).save(*args, **kwargs)
+        self.snapshot_calculation_inputs()
 
-        # if do_recalc_reps:
-        #     recalc_reps('Sample', self.id)
-
-        # ALWAYS recalc child PCR Replicates
-        recalc_reps('Sample', self.id)
+        if do_recalc_reps:
+            schedule_recalc_reps('Sample', self.id)
 
     def __str__(self):
         return str(self.id)
@@ -583,7 +784,7 @@ class Freezer(NameModel):
 ######
 
 
-class FinalConcentratedSampleVolume(HistoryModel):
+class FinalConcentratedSampleVolume(CalculationInputModel):
     """
     Final Concentrated Sample Volume
     """
@@ -600,26 +801,18 @@ class FinalConcentratedSampleVolume(HistoryModel):
     notes = models.TextField(blank=True)
     history = HistoricalRecords(inherit=True, table_name='lili_finalconcentratedsamplevolumehistory',
                                 custom_model_name=lambda x: f'{x}History')
+    calculation_input_fields = ('sample_id', 'final_concentrated_sample_volume')
 
     # override the save method to check if a rep calc value changed,
     # and if so, recalc rep conc and rep invalid and FSMC
     def save(self, *args, **kwargs):
-
-        # do_recalc_reps = False
-        #
-        # # a value can only be changed if the instance already exists
-        # if self.pk:
-        #     old_fcsv = FinalConcentratedSampleVolume.objects.get(id=self.pk)
-        #     if self.final_concentrated_sample_volume != old_fcsv.final_concentrated_sample_volume:
-        #         do_recalc_reps = True
+        do_recalc_reps = self.calculation_inputs_changed
 
         super(FinalConcentratedSampleVolume, self).save(*args, **kwargs)
+        self.snapshot_calculation_inputs()
 
-        # if do_recalc_reps:
-        #     recalc_reps('Sample', self.sample.id)
-
-        # ALWAYS recalc child PCR Replicates
-        recalc_reps('Sample', self.sample.id)
+        if do_recalc_reps:
+            schedule_recalc_reps('Sample', self.sample.id)
 
     def __str__(self):
         return str(self.id)
@@ -643,6 +836,184 @@ class ConcentrationType(NameModel):
         db_table = "lili_concentrationtype"
 
 
+class FinalSampleMeanConcentrationManager(models.Manager):
+
+    # recalculate the FSMCs of a set of sample-target combos (creating any that do not yet exist),
+    # saving only the ones whose value changed, and marking all of them as computed from their current input version
+    def recalc(self, sample_targets):
+        sample_targets = set(sample_targets)
+        if not sample_targets:
+            return 0
+        fsmcs = {(fsmc.sample_id, fsmc.target_id): fsmc for fsmc in self.filter(
+            sample__in={sample_id for sample_id, target_id in sample_targets},
+            target__in={target_id for sample_id, target_id in sample_targets})}
+        sample_mean_concs = self.calc_sample_mean_concs(sample_targets)
+        changed_count = 0
+        # the IDs of the unchanged FSMCs, grouped by the input version they were loaded with
+        computed_versions = {}
+        for sample_id, target_id in sample_targets:
+            fsmc = fsmcs.get((sample_id, target_id))
+            value = sample_mean_concs[(sample_id, target_id)]
+            if fsmc is None:
+                fsmc = self.model(sample_id=sample_id, target_id=target_id)
+                fsmc.final_sample_mean_concentration = value
+                fsmc.save()
+                changed_count += 1
+                continue
+            if value != fsmc.final_sample_mean_concentration:
+                fsmc.final_sample_mean_concentration = value
+                fsmc.computed_version = fsmc.input_version
+                # never write input_version back, in case it was bumped while this FSMC was being computed
+                fsmc.save(update_fields=['final_sample_mean_concentration', 'computed_version', 'modified_date'])
+                changed_count += 1
+            elif fsmc.computed_version < fsmc.input_version:
+                computed_versions.setdefault(fsmc.input_version, []).append(fsmc.id)
+        for input_version, fsmc_ids in computed_versions.items():
+            self.filter(id__in=fsmc_ids, computed_version__lt=input_version).update(computed_version=input_version)
+        return changed_count
+
+    # bring the FSMCs of a queryset up to date, recalculating (along with their reps) only the stale ones,
+    # meaning the ones whose inputs changed since they were computed
+    def recalc_stale(self, fsmcs):
+        stale_fsmcs = fsmcs.filter(computed_version__lt=F('input_version'))
+        sample_targets = set(stale_fsmcs.values_list('sample', 'target'))
+        if not sample_targets:
+            return 0
+        sample_ids = {sample_id for sample_id, target_id in sample_targets}
+        target_ids = {target_id for sample_id, target_id in sample_targets}
+        # the join to the stale FSMC of the sample and target of each rep keeps only the reps of the stale combos,
+        # rather than of every combination of their samples and targets
+        PCRReplicate.objects.recalc(PCRReplicate.objects.filter(
+            sample_extraction__sample__in=sample_ids, pcrreplicate_batch__target__in=target_ids,
+            sample_extraction__sample__finalsamplemeanconcentrations__target=F('pcrreplicate_batch__target'),
+            sample_extraction__sample__finalsamplemeanconcentrations__in=stale_fsmcs.values('id')))
+        # FSMCs without any reps are not reached by the rep recalc
+        self.recalc(stale_fsmcs.values_list('sample', 'target'))
+        return len(sample_targets)
+
+    # get the breakdown of the reps of a set of sample-target combos (see FSMC.sample_target_replicates)
+    # using one query for the reps and a few more for the invalid reasons of the invalid ones
+    def get_sample_target_replicates(self, sample_targets):
+        sample_targets = set(sample_targets)
+        reps_by_sample_target = {sample_target: [] for sample_target in sample_targets}
+        if sample_targets:
+            for rep in PCRReplicate.objects.filter(
+                    sample_extraction__sample__in={sample_id for sample_id, target_id in sample_targets},
+                    pcrreplicate_batch__target__in={target_id for sample_id, target_id in sample_targets}).annotate(
+                    sample=F('sample_extraction__sample')).annotate(
+                    target=F('pcrreplicate_batch__target')).annotate(
+                    re_pcr=F('pcrreplicate_batch__re_pcr')).annotate(
+                    analysis_batch=F('pcrreplicate_batch__extraction_batch__analysis_batch')).annotate(
+                    extraction_number=F('pcrreplicate_batch__extraction_batch__extraction_number')).annotate(
+                    replicate_number=F('pcrreplicate_batch__replicate_number')).values(
+                    'id', 'sample', 'target', 're_pcr', 'analysis_batch', 'extraction_number', 'replicate_number',
+                    'invalid', 'invalid_override', 'replicate_concentration', 'cq_value').order_by('id'):
+                if (rep['sample'], rep['target']) in reps_by_sample_target:
+                    reps_by_sample_target[(rep['sample'], rep['target'])].append(rep)
+
+        # only the invalid reps of batches that have not been redone need their invalid reasons
+        invalid_rep_ids = [rep['id'] for reps in reps_by_sample_target.values() for rep in reps
+                           if rep['re_pcr'] is None and rep['invalid'] and not rep['invalid_override']]
+        invalid_reasons = PCRReplicate.objects.get_invalid_reasons(
+            PCRReplicate.objects.filter(id__in=invalid_rep_ids).only('id', 'invalid')) if invalid_rep_ids else {}
+
+        def make_rep_identifier_object(rep_obj):
+            identifier_obj = {
+                "id": rep_obj['id'],
+                "analysis_batch": rep_obj['analysis_batch'],
+                "extraction_number": rep_obj['extraction_number'],
+                "replicate_number": rep_obj['replicate_number']
+            }
+            return identifier_obj
+
+        def any_controls_invalid(rep_obj):
+            # a rep could only be invalid if a parent control invalidated it or if the user overrode the validation,
+            # so ignore whether its own values are missing
+            reasons = dict(invalid_reasons[rep_obj['id']])
+            reasons.pop('cq_value_missing')
+            reasons.pop('gc_reaction_missing')
+            return any(val for val in reasons.values() if val is True)
+
+        sample_target_replicates = {}
+        for sample_target, reps in reps_by_sample_target.items():
+            invalid_override_invalids = []
+            qpcr_results_missing = []
+            concentration_calc_values_missing = []
+            positive_concentrations = []
+            negative_concentrations = []
+            controls_invalids = []
+            redones = []
+
+            for rep in reps:
+                # ignore 'redones' (batches that have been redone)
+                # in other words, only allow reps for batches that have not been redone
+                if rep['re_pcr'] is None:
+                    if rep['invalid'] is False:
+                        if rep['invalid_override']:
+                            invalid_override_invalids.append(make_rep_identifier_object(rep))
+                        elif rep['replicate_concentration'] is None:
+                            concentration_calc_values_missing.append(make_rep_identifier_object(rep))
+                        elif rep['replicate_concentration'] > Decimal('0'):
+                            positive_concentrations.append(make_rep_identifier_object(rep))
+                        else:
+                            # a replicate_concentration less than zero is impossible due to the model field definition
+                            negative_concentrations.append(make_rep_identifier_object(rep))
+                    else:
+                        if rep['cq_value'] is None:
+                            qpcr_results_missing.append(make_rep_identifier_object(rep))
+                        if rep['invalid_override'] or any_controls_invalid(rep):
+                            controls_invalids.append(make_rep_identifier_object(rep))
+                else:
+                    redones.append(make_rep_identifier_object(rep))
+
+            sample_target_replicates[sample_target] = {
+                "invalid_override_invalid_count": len(invalid_override_invalids),
+                "invalid_override_invalids": invalid_override_invalids,
+                "qpcr_results_missing_count": len(qpcr_results_missing),
+                "qpcr_results_missing": qpcr_results_missing,
+                "concentration_calc_values_missing_count": len(concentration_calc_values_missing),
+                "concentration_calc_values_missing": concentration_calc_values_missing,
+                "positive_concentration_count": len(positive_concentrations),
+                "positive_concentrations": positive_concentrations,
+                "negative_concentration_count": len(negative_concentrations),
+                "negative_concentrations": negative_concentrations,
+                "controls_invalid_count": len(controls_invalids),
+                "controls_invalids": controls_invalids,
+                "redone_count": len(redones),
+                "redones": redones
+            }
+        return sample_target_replicates
+
+    # calculate the sample mean concentrations of a set of sample-target combos (see FSMC.calc_sample_mean_conc)
+    def calc_sample_mean_concs(self, sample_targets):
+        sample_target_replicates = self.get_sample_target_replicates(sample_targets)
+        rep_ids = [rep['id'] for replicates in sample_target_replicates.values()
+                   for rep in replicates['positive_concentrations']]
+        replicate_concentrations = dict(PCRReplicate.objects.filter(id__in=rep_ids).values_list(
+            'id', 'replicate_concentration')) if rep_ids else {}
+
+        sample_mean_concs = {}
+        for sample_target, replicates in sample_target_replicates.items():
+            if (replicates['invalid_override_invalid_count'] == 0
+                    and replicates['qpcr_results_missing_count'] == 0
+                    and replicates['concentration_calc_values_missing_count'] == 0
+                    and replicates['controls_invalid_count'] == 0):
+
+                pos_reps_count = replicates['positive_concentration_count']
+                if pos_reps_count > 0:
+                    pos_replicate_concentrations = [
+                        replicate_concentrations[rep['id']] for rep in replicates['positive_concentrations']]
+                    sample_mean_concs[sample_target] = sum(pos_replicate_concentrations) / pos_reps_count
+                else:
+                    if replicates['negative_concentration_count'] > 0:
+                        sample_mean_concs[sample_target] = 0
+                    else:
+                        sample_mean_concs[sample_target] = None
+            else:
+                sample_mean_concs[sample_target] = None
+        return sample_mean_concs
+
+
 class FinalSampleMeanConcentration(HistoryModel):
     """
     Final Sample Mean Concentration
@@ -664,129 +1035,34 @@ class FinalSampleMeanConcentration(HistoryModel):
     def final_sample_mean_concentration_sci(self):
         return get_sci_val(self.final_sample_mean_concentration)
 
+    # whether the inputs of this FSMC changed since it was last computed
     @property
-    def sample_target_replicates(self):
-
-        def make_rep_identifier_object(rep_obj):
-            identifier_obj = {
-                "id": rep_obj.id,
-                "analysis_batch": rep_obj.pcrreplicate_batch.extraction_batch.analysis_batch.id,
-                "extraction_number": rep_obj.pcrreplicate_batch.extraction_batch.extraction_number,
-                "replicate_number": rep_obj.pcrreplicate_batch.replicate_number
-            }
-            return identifier_obj
-
-        total_count = 0
-        invalid_override_invalids = []
-        qpcr_results_missing = []
-        concentration_calc_values_missing = []
-        positive_concentrations = []
-        negative_concentrations = []
-        controls_invalids = []
-        redones = []
-        invalid_override_invalid_count = 0
-        qpcr_results_missing_count = 0
-        concentration_calc_values_missing_count = 0
-        positive_concentration_count = 0
-        negative_concentration_count = 0
-        controls_invalid_count = 0
-        redone_count = 0
-
-        reps = PCRReplicate.objects.filter(sample_extraction__sample=self.sample.id,
-                                           pcrreplicate_batch__target__exact=self.target)
-        for rep in reps:
-            total_count += 1
-            # ignore 'redones' (batches that have been redone)
-            # in other words, only allow reps for batches that have not been redone
-            if rep.pcrreplicate_batch.re_pcr is None:
-                if rep.invalid is False:
-                    if rep.invalid_override:
-                        invalid_override_invalid_count += 1
-                        invalid_override_invalids.append(make_rep_identifier_object(rep))
-                    elif rep.replicate_concentration is None:
-                        concentration_calc_values_missing_count += 1
-                        concentration_calc_values_missing.append(make_rep_identifier_object(rep))
-                    elif rep.replicate_concentration > Decimal('0'):
-                        positive_concentration_count += 1
-                        positive_concentrations.append(make_rep_identifier_object(rep))
-                    else:
-                        # a replicate_concentration less than zero is impossible due to the model field definition
-                        negative_concentration_count += 1
-                        negative_concentrations.append(make_rep_identifier_object(rep))
-                else:
-                    if rep.cq_value is None:
-                        qpcr_results_missing_count += 1
-                        qpcr_results_missing.append(make_rep_identifier_object(rep))
-                        invalid_reasons = rep.invalid_reasons
-                        invalid_reasons.pop('cq_value_missing')
-                        invalid_reasons.pop('gc_reaction_missing')
-                        if any(val for val in invalid_reasons.values() if val is True):
-                            controls_invalid_count += 1
-                            controls_invalids.append(make_rep_identifier_object(rep))
-                    else:
-                        # a cq_value less than zero is impossible due to the model field definition
-                        # so this rep could only be invalid if a parent control invalidated it
-                        # or if the user overrode the validation
-                        invalid_reasons = rep.invalid_reasons
-                        invalid_reasons.pop('cq_value_missing')
-                        invalid_reasons.pop('gc_reaction_missing')
-                        if any(val for val in invalid_reasons.values() if val is True):
-                            controls_invalid_count += 1
-                            controls_invalids.append(make_rep_identifier_object(rep))
-            else:
-                redone_count += 1
-                redones.append(make_rep_identifier_object(rep))
+    def recalc_pending(self):
+        return self.computed_version < self.input_version
 
-        data = {
-            "invalid_override_invalid_count": invalid_override_invalid_count,
-            "invalid_override_invalids": invalid_override_invalids,
-            "qpcr_results_missing_count": qpcr_results_missing_count,
-            "qpcr_results_missing": qpcr_results_missing,
-            "concentration_calc_values_missing_count": concentration_calc_values_missing_count,
-            "concentration_calc_values_missing": concentration_calc_values_missing,
-            "positive_concentration_count": positive_concentration_count,
-            "positive_concentrations": positive_concentrations,
-            "negative_concentration_count": negative_concentration_count,
-            "negative_concentrations": negative_concentrations,
-            "controls_invalid_count": controls_invalid_count,
-            "controls_invalids": controls_invalids,
-            "redone_count": redone_count,
-            "redones": redones
-        }
-        return data
+    @property
+    def sample_target_replicates(self):
+        return FinalSampleMeanConcentration.objects.get_sample_target_replicates(
+            [(self.sample_id, self.target_id)])[(self.sample_id, self.target_id)]
 
     final_sample_mean_concentration = NullableNonnegativeDecimalField120100()
     sample = models.ForeignKey('Sample', models.CASCADE, related_name='finalsamplemeanconcentrations')
     target = models.ForeignKey('Target', models.PROTECT, related_name='finalsamplemeanconcentrations')
+    # incremented whenever an input of this FSMC changes, and copied to computed_version when it is recomputed
+    input_version = models.PositiveIntegerField(default=0)
+    computed_version = models.PositiveIntegerField(default=0)
     history = HistoricalRecords(inherit=True, table_name='lili_finalsamplemeanconcentrationhistory',
-                                custom_model_name=lambda x: f'{x}History')
+                                custom_model_name=lambda x: f'{x}History',
+                                excluded_fields=['input_version', 'computed_version'])
+    objects = FinalSampleMeanConcentrationManager()
 
     # Calculate sample mean concentration for all samples whose target replicates are now in the database and all valid
     # Concentrations from replicates are used to determine the Mean Sample Concentration
     # by taking the average of positive replicates (negative replicates (value of "0") are ignored).
     # If all replicates are negative ("0"), then the Mean Sample Concentration is "0".
     def calc_sample_mean_conc(self):
-        sample_target_replicates = self.sample_target_replicates
-
-        if (sample_target_replicates['invalid_override_invalid_count'] == 0
-                and sample_target_replicates['qpcr_results_missing_count'] == 0
-                and sample_target_replicates['concentration_calc_values_missing_count'] == 0
-                and sample_target_replicates['controls_invalid_count'] == 0):
-
-            pos_reps_count = sample_target_replicates['positive_concentration_count']
-            if pos_reps_count > 0:
-                rep_ids = [rep['id'] for rep in sample_target_replicates['positive_concentrations']]
-                pos_replicate_concentrations = list(PCRReplicate.objects.filter(
-                    id__in=rep_ids).values_list(
-                    'replicate_concentration', flat=True))
-                return sum(pos_replicate_concentrations) / pos_reps_count
-            else:
-                if sample_target_replicates['negative_concentration_count'] > 0:
-                    return 0
-                else:
-                    return None
-        else:
-            return None
+        return FinalSampleMeanConcentration.objects.calc_sample_mean_concs(
+            [(self.sample_id, self.target_id)])[(self.sample_id, self.target_id)]
 
     def __str__(self):
         return str(self.id)
@@ -923,7 +1199,7 @@ class ExtractionMethod(NameModel):
         db_table = "lili_extractionmethod"
 
 
-class ExtractionBatch(HistoryModel):
+class ExtractionBatch(CalculationInputModel):
     """
     Extraction Batch
     """
@@ -953,6 +1229,9 @@ class ExtractionBatch(HistoryModel):
     inh_pos_nucleic_acid_type = models.ForeignKey('NucleicAcidType', models.PROTECT, null=True)
     history = HistoricalRecords(inherit=True, table_name='lili_extractionbatchhistory',
                                 custom_model_name=lambda x: f'{x}History')
+    calculation_input_fields = ('qpcr_reaction_volume', 'qpcr_template_volume', 'elution_volume',
+                                'extraction_volume', 'sample_dilution_factor', 'ext_pos_dna_cq_value',
+                                'ext_pos_dna_invalid')
 
     # override the save method to calculate invalid flag
     # and to check if a rep calc value changed, and if so, recalc rep conc and rep invalid and FSMC
@@ -964,35 +1243,14 @@ class ExtractionBatch(HistoryModel):
         if self.ext_pos_dna_cq_value is not None and self.ext_pos_dna_cq_value > 0:
             self.ext_pos_dna_invalid = False
 
-        # do_recalc_reps = False
-        # is_new = False if self.pk else True
-
-        # # a value can only be changed if the instance already exists
-        # if not is_new:
-        #     old_extraction_batch = ExtractionBatch.objects.get(id=self.pk)
-        #     if self.qpcr_reaction_volume != old_extraction_batch.qpcr_reaction_volume:
-        #         do_recalc_reps = True
-        #     if self.qpcr_template_volume != old_extraction_batch.qpcr_template_volume:
-        #         do_recalc_reps = True
-        #     if self.elution_volume != old_extraction_batch.elution_volume:
-        #         do_recalc_reps = True
-        #     if self.extraction_volume != old_extraction_batch.extraction_volume:
-        #         do_recalc_reps = True
-        #     if self.sample_dilution_factor != old_extraction_batch.sample_dilution_factor:
-        #         do_recalc_reps = True
+        do_recalc_reps = self.calculation_inputs_changed
 
         super(ExtractionBatch, self).save(*args, **kwargs)
+        self.snapshot_calculation_inputs()
 
-        # # Invalidate all child PCR Replicates if this (their parent Extraction Batch) is invalid
-        # if self.ext_pos_dna_invalid and not is_new:
-        #     PCRReplicate.objects.filter(sample_extraction__extraction_batch=self.id).update(invalid=True)
-        #     do_recalc_reps = True
-
-        # if not is_new:
-        #     recalc_reps('ExtractionBatch', self.id)
-
-        # ALWAYS recalc child PCR Replicates
-        recalc_reps('ExtractionBatch', self.id)
+        if do_recalc_reps:
+            ControlValidity.objects.refresh(self.id)
+            schedule_recalc_reps('ExtractionBatch', self.id)
 
     def __str__(self):
         return self.extraction_string
@@ -1003,7 +1261,7 @@ class ExtractionBatch(HistoryModel):
         verbose_name_plural = "extractionbatches"
 
 
-class ReverseTranscription(HistoryModel):
+class ReverseTranscription(CalculationInputModel):
     """
     Reverse Transcription
     """
@@ -1020,8 +1278,11 @@ class ReverseTranscription(HistoryModel):
     ext_pos_rna_rt_invalid = models.BooleanField(default=True)
     history = HistoricalRecords(inherit=True, table_name='lili_reversetranscriptionhistory',
                                 custom_model_name=lambda x: f'{x}History')
+    calculation_input_fields = ('extraction_batch_id', 'template_volume', 'reaction_volume', 're_rt_id',
+                                'ext_pos_rna_rt_cq_value', 'ext_pos_rna_rt_invalid')
 
     # override the save method to calculate invalid flag
+    # and to check if a rep calc value changed, and if so, recalc rep conc and rep invalid and FSMC
     def save(self, *args, **kwargs):
         # assess the invalid flag
         # invalid flag defaults to True (i.e., the RT is invalid)
@@ -1030,21 +1291,18 @@ class ReverseTranscription(HistoryModel):
         if self.ext_pos_rna_rt_cq_value is not None and self.ext_pos_rna_rt_cq_value > 0:
             self.ext_pos_rna_rt_invalid = False
 
-        # do_recalc_reps = False
-        # is_new = False if self.pk else True
-        super(ReverseTranscription, self).save(*args, **kwargs)
-
-        # # Invalidate all child PCR Replicates if this (their parent RT) is invalid
-        # if self.ext_pos_rna_rt_invalid and not is_new:
-        #     PCRReplicate.objects.filter(
-        #         sample_extraction__extraction_batch=self.extraction_batch.id).update(invalid=True)
-        #     do_recalc_reps = True
+        do_recalc_reps = self.calculation_inputs_changed
+        old_extraction_batch_id = self.get_loaded_calculation_input('extraction_batch_id')
 
-        # if do_recalc_reps:
-        #     recalc_reps('ExtractionBatch', self.extraction_batch.id)
+        super(ReverseTranscription, self).save(*args, **kwargs)
+        self.snapshot_calculation_inputs()
 
-        # ALWAYS recalc child PCR Replicates
-        recalc_reps('ExtractionBatch', self.extraction_batch.id)
+        if do_recalc_reps:
+            ControlValidity.objects.refresh(self.extraction_batch.id)
+            schedule_recalc_reps('ExtractionBatch', self.extraction_batch.id)
+            if old_extraction_batch_id is not None and old_extraction_batch_id != self.extraction_batch.id:
+                ControlValidity.objects.refresh(old_extraction_batch_id)
+                schedule_recalc_reps('ExtractionBatch', old_extraction_batch_id)
 
     def __str__(self):
         return str(self.id)
@@ -1054,6 +1312,11 @@ class ReverseTranscription(HistoryModel):
         unique_together = ("extraction_batch", "re_rt")
 
 
+@receiver(post_delete, sender=ReverseTranscription)
+def reversetranscription_delete(sender, instance, **kwargs):
+    ControlValidity.objects.refresh(instance.extraction_batch_id, create_missing=False)
+
+
 class SampleExtraction(HistoryModel):
     """
     Sample Extraction
@@ -1075,7 +1338,7 @@ class SampleExtraction(HistoryModel):
         ordering = ['sample', 'id']
 
 
-class PCRReplicateBatch(HistoryModel):
+class PCRReplicateBatch(CalculationInputModel):
     """
     Polymerase Chain Reaction Replicate Batch
     """
@@ -1115,6 +1378,9 @@ class PCRReplicateBatch(HistoryModel):
     re_pcr = models.ForeignKey('self', on_delete=models.CASCADE, null=True, related_name='pcrreplicatebatches')
     history = HistoricalRecords(inherit=True, table_name='lili_pcrreplicatebatchhistory',
                                 custom_model_name=lambda x: f'{x}History')
+    calculation_input_fields = ('extraction_batch_id', 'target_id', 're_pcr_id', 'ext_neg_cq_value',
+                                'ext_neg_invalid', 'rt_neg_cq_value', 'rt_neg_invalid', 'pcr_neg_cq_value',
+                                'pcr_neg_invalid')
 
     # override the save method to calculate invalid flags
     # and to check if a rep calc value changed, and if so, recalc rep conc and rep invalid and FSMC
@@ -1149,26 +1415,25 @@ class PCRReplicateBatch(HistoryModel):
         # sc = validated_data.get('standard_curve', None)
         self.pcr_pos_invalid = False
 
-        # do_recalc_reps = False
-        #
-        # # a value can only be changed if the instance already exists
-        # if self.pk:
-        #     old_pcrreplicate_batch = PCRReplicateBatch.objects.get(id=self.pk)
-        #     if self.target.id != old_pcrreplicate_batch.target.id:
-        #         do_recalc_reps = True
+        do_recalc_reps = self.calculation_inputs_changed
+        old_extraction_batch_id = self.get_loaded_calculation_input('extraction_batch_id')
+        old_target_id = self.get_loaded_calculation_input('target_id')
 
         super(PCRReplicateBatch, self).save(*args, **kwargs)
+        self.snapshot_calculation_inputs()
 
-        # if do_recalc_reps:
-        #     recalc_reps('PCRReplicateBatch', self.id)
+        if do_recalc_reps:
+            ControlValidity.objects.refresh(self.extraction_batch_id, self.target_id)
+            if old_extraction_batch_id is not None and (old_extraction_batch_id, old_target_id) != (
+                    self.extraction_batch_id, self.target_id):
+                ControlValidity.objects.refresh(old_extraction_batch_id, old_target_id)
 
-        # invalidate child PCR Replicates of parent Extraction Batch if any negative control is positive
-        if invalidate_reps:
-            PCRReplicate.objects.filter(
-                sample_extraction__extraction_batch=self.extraction_batch.id).update(invalid=True)
+            # invalidate child PCR Replicates of parent Extraction Batch if any negative control is positive
+            if invalidate_reps:
+                PCRReplicate.objects.invalidate(PCRReplicate.objects.filter(
+                    sample_extraction__extraction_batch=self.extraction_batch.id))
 
-        # ALWAYS recalc child PCR Replicates
-        recalc_reps('PCRReplicateBatch', self.id)
+            schedule_recalc_reps('PCRReplicateBatch', self.id)
 
     def __str__(self):
         return str(self.id)
@@ -1179,259 +1444,521 @@ class PCRReplicateBatch(HistoryModel):
         verbose_name_plural = "pcrreplicatebatches"
 
 
-class PCRReplicate(HistoryModel):
+@receiver(post_delete, sender=PCRReplicateBatch)
+def pcrreplicatebatch_delete(sender, instance, **kwargs):
+    ControlValidity.objects.refresh(instance.extraction_batch_id, instance.target_id, create_missing=False)
+
+
+class ControlValidityManager(models.Manager):
+
+    # recalculate the control validity of an extraction batch for one target or (by default) all of its targets
+    # (pass create_missing=False when the extraction batch itself might be in the middle of being deleted)
+    def refresh(self, extraction_batch_id, target_id=None, create_missing=True):
+        pcrreplicate_batches = PCRReplicateBatch.objects.filter(extraction_batch=extraction_batch_id)
+        existing = self.filter(extraction_batch=extraction_batch_id)
+        if target_id is not None:
+            pcrreplicate_batches = pcrreplicate_batches.filter(target=target_id)
+            existing = existing.filter(target=target_id)
+        existing = {control_validity.target_id: control_validity for control_validity in existing}
+
+        # **ALL** PCR Replicate Batch controls from the same parent Extraction Batch (and with the same target)
+        # are considered parent controls for a rep, so only whether any of them is invalid matters
+        targets = pcrreplicate_batches.values('target', 'target__nucleic_acid_type__name').annotate(
+            ext_neg_invalid_count=models.Count('id', filter=Q(ext_neg_invalid=True)),
+            rt_neg_invalid_count=models.Count('id', filter=Q(rt_neg_invalid=True)),
+            pcr_neg_invalid_count=models.Count('id', filter=Q(pcr_neg_invalid=True))).order_by('target')
+        eb = ExtractionBatch.objects.filter(id=extraction_batch_id).values('ext_pos_dna_invalid').first()
+        # only the active RT (the one with a null re_rt) of an extraction batch is valid
+        rt = ReverseTranscription.objects.filter(
+            extraction_batch=extraction_batch_id, re_rt=None).order_by('id').values('ext_pos_rna_rt_invalid').first()
+
+        control_validities = {}
+        for target in targets:
+            control_validity = existing.pop(target['target'], None)
+            if control_validity is None:
+                if not create_missing or eb is None:
+                    continue
+                control_validity = self.model(extraction_batch_id=extraction_batch_id, target_id=target['target'])
+            old_values = (control_validity.pk, control_validity.ext_neg_invalid, control_validity.rt_neg_invalid,
+                          control_validity.pcr_neg_invalid, control_validity.ext_pos_rna_rt_invalid,
+                          control_validity.ext_pos_dna_invalid, control_validity.controls_invalid)
+            control_validity.ext_neg_invalid = target['ext_neg_invalid_count'] > 0
+            control_validity.rt_neg_invalid = target['rt_neg_invalid_count'] > 0
+            control_validity.pcr_neg_invalid = target['pcr_neg_invalid_count'] > 0
+            control_validity.ext_pos_rna_rt_invalid = rt['ext_pos_rna_rt_invalid'] if rt else False
+            control_validity.ext_pos_dna_invalid = eb['ext_pos_dna_invalid'] if eb else True
+            nucleic_acid_type_name = target['target__nucleic_acid_type__name'].upper()
+            control_validity.controls_invalid = (
+                    control_validity.ext_neg_invalid or control_validity.rt_neg_invalid
+                    or control_validity.pcr_neg_invalid
+                    or (nucleic_acid_type_name == 'RNA' and control_validity.ext_pos_rna_rt_invalid)
+                    or (nucleic_acid_type_name == 'DNA' and control_validity.ext_pos_dna_invalid))
+            if old_values != (control_validity.pk, control_validity.ext_neg_invalid, control_validity.rt_neg_invalid,
+                              control_validity.pcr_neg_invalid, control_validity.ext_pos_rna_rt_invalid,
+                              control_validity.ext_pos_dna_invalid, control_validity.controls_invalid):
+                control_validity.save()
+            control_validities[(extraction_batch_id, target['target'])] = control_validity
+
+        # remove the rows of targets no longer used by any PCR replicate batch of the extraction batch
+        if existing:
+            self.filter(id__in=[control_validity.id for control_validity in existing.values()]).delete()
+        return control_validities
+
+    # get the control validities of a set of extraction batch-target combos, refreshing any that are missing
+    def get_for(self, extraction_batch_targets):
+        extraction_batch_targets = set(extraction_batch_targets)
+        extraction_batch_ids = {extraction_batch_id for extraction_batch_id, target_id in extraction_batch_targets}
+        target_ids = {target_id for extraction_batch_id, target_id in extraction_batch_targets}
+        control_validities = {
+            (control_validity.extraction_batch_id, control_validity.target_id): control_validity
+            for control_validity in self.filter(extraction_batch__in=extraction_batch_ids, target__in=target_ids)}
+        for extraction_batch_id in {extraction_batch_id for extraction_batch_id, target_id in extraction_batch_targets
+                                    if (extraction_batch_id, target_id) not in control_validities}:
+            control_validities.update(self.refresh(extraction_batch_id))
+        return control_validities
+
+
+class ControlValidity(models.Model):
+    """
+    Combined validity of the parent controls of the PCR replicates of an extraction batch and target,
+    maintained by the saves of PCRReplicateBatch, ReverseTranscription, and ExtractionBatch
+    """
+
+    extraction_batch = models.ForeignKey('ExtractionBatch', models.CASCADE, related_name='controlvalidities')
+    target = models.ForeignKey('Target', models.CASCADE, related_name='controlvalidities')
+    ext_neg_invalid = models.BooleanField(default=False)
+    rt_neg_invalid = models.BooleanField(default=False)
+    pcr_neg_invalid = models.BooleanField(default=False)
+    ext_pos_rna_rt_invalid = models.BooleanField(default=False)
+    ext_pos_dna_invalid = models.BooleanField(default=True)
+    # whether any of the above controls that apply to the nucleic acid type of the target is invalid
+    controls_invalid = models.BooleanField(default=True)
+
+    objects = ControlValidityManager()
+
+    def __str__(self):
+        return str(self.id)
+
+    class Meta:
+        db_table = "lili_controlvalidity"
+        unique_together = ("extraction_batch", "target")
+        verbose_name_plural = "controlvalidities"
+
+
+class PegNegValidityManager(models.Manager):
+
+    # recalculate the validity of a set of peg_neg-target combos, and propagate only the ones that flipped
+    # to the reps with the same target from the samples using that peg_neg (found through the Sample.peg_neg index):
+    # a newly invalid peg_neg invalidates them all with one UPDATE, a newly valid one has them re-evaluated;
+    # returns the sample-target combos of the invalidated reps, whose FSMCs the caller must recalc
+    # (pass create_missing=False when the peg_neg sample itself might be in the middle of being deleted)
+    def propagate(self, peg_neg_targets, create_missing=True):
+        peg_neg_targets = set(peg_neg_targets)
+        if not peg_neg_targets:
+            return set()
+        peg_neg_ids = {peg_neg_id for peg_neg_id, target_id in peg_neg_targets}
+        target_ids = {target_id for peg_neg_id, target_id in peg_neg_targets}
+
+        rep_counts = {(rep_count['sample_extraction__sample'], rep_count['pcrreplicate_batch__target']): rep_count
+                      for rep_count in PCRReplicate.objects.filter(
+                          sample_extraction__sample__in=peg_neg_ids, pcrreplicate_batch__target__in=target_ids).values(
+                          'sample_extraction__sample', 'pcrreplicate_batch__target').annotate(
+                          rep_count=models.Count('id'),
+                          invalid_count=models.Count('id', filter=Q(invalid=True))).order_by()}
+        existing = {(peg_neg_validity.peg_neg_id, peg_neg_validity.target_id): peg_neg_validity
+                    for peg_neg_validity in self.filter(peg_neg__in=peg_neg_ids, target__in=target_ids)}
+
+        newly_invalids = Q()
+        newly_valids = Q()
+        for peg_neg_id, target_id in peg_neg_targets:
+            rep_count = rep_counts.get((peg_neg_id, target_id))
+            # if even a single one of the peg_neg reps is invalid, or there are no peg_neg reps
+            # (because the peg_neg sample has not yet been extracted), the related data reps must be set to invalid
+            invalid = rep_count is None or rep_count['invalid_count'] > 0
+            peg_neg_validity = existing.get((peg_neg_id, target_id))
+            if peg_neg_validity is None:
+                if not create_missing:
+                    continue
+                # with no previous validity to compare to, propagate the current one either way
+                self.create(peg_neg_id=peg_neg_id, target_id=target_id, invalid=invalid)
+            elif peg_neg_validity.invalid != invalid:
+                peg_neg_validity.invalid = invalid
+                peg_neg_validity.save(update_fields=['invalid'])
+            else:
+                continue
+            dependents = Q(sample_extraction__sample__peg_neg=peg_neg_id, pcrreplicate_batch__target=target_id)
+            if invalid:
+                newly_invalids |= dependents
+            else:
+                newly_valids |= dependents
+
+        sample_targets = set()
+        if newly_invalids:
+            dependent_reps = PCRReplicate.objects.filter(newly_invalids, invalid=False)
+            sample_targets.update(dependent_reps.values_list(
+                'sample_extraction__sample', 'pcrreplicate_batch__target').distinct())
+            PCRReplicate.objects.invalidate(dependent_reps)
+        if newly_valids:
+            # the rep recalc updates the FSMCs of the reps it re-evaluates itself
+            PCRReplicate.objects.recalc(PCRReplicate.objects.filter(newly_valids), recalc_rep_conc=False)
+        return sample_targets
+
+
+class PegNegValidity(models.Model):
     """
-    Polymerase Chain Reaction Replicate
+    Combined validity of the reps of a peg_neg sample for a target,
+    maintained by the saves of those reps and propagated to the reps of the samples using that peg_neg
     """
 
-    @property
-    def gc_reaction_sci(self):
-        return get_sci_val(self.gc_reaction)
+    peg_neg = models.ForeignKey('Sample', models.CASCADE, related_name='pegnegvalidities')
+    target = models.ForeignKey('Target', models.CASCADE, related_name='pegnegvalidities')
+    # whether any rep of the peg_neg with the target is invalid, or there are none
+    invalid = models.BooleanField(default=True)
 
-    @property
-    def replicate_concentration_sci(self):
-        return get_sci_val(self.replicate_concentration)
+    objects = PegNegValidityManager()
 
-    @property
-    def invalid_reasons(self):
-        reasons = {}
-        if self.invalid:
-            pcrreplicate_batch = PCRReplicateBatch.objects.filter(id=self.pcrreplicate_batch.id).first()
-            # first check related peg_neg validity
-            # assume no related peg_neg, in which case this control does not apply
-            # but if there is a related peg_neg, check the validity of its reps with same target as this data rep
-            peg_neg_missings = []
-            peg_neg_invalids = []
-            peg_neg_not_extracted = False
-            sample = self.sample_extraction.sample
+    def __str__(self):
+        return str(self.id)
+
+    class Meta:
+        db_table = "lili_pegnegvalidity"
+        unique_together = ("peg_neg", "target")
+        verbose_name_plural = "pegnegvalidities"
+
+
+class PCRReplicateManager(models.Manager):
 
+    # set the invalid flag of a set of reps (regardless of any invalid_override, like an UPDATE would),
+    # recording the history of the reps that were still valid like a regular save would
+    def invalidate(self, reps):
+        reps = list(reps.filter(invalid=False))
+        for rep in reps:
+            rep.invalid = True
+            rep.modified_date = date.today()
+        self.bulk_update(reps, ['invalid', 'modified_date'], batch_size=500)
+        bulk_create_update_history(self.model, reps)
+        return len(reps)
+
+    # calculate the concentrations of a list of reps (selected along with their sample extraction, sample and matrix,
+    # extraction batch, inhibitions, and target and nucleic acid type), using two queries regardless of their number
+    # (with exact=False, as floats for uses where float precision is acceptable, see calc_rep_concs)
+    def calc_concs(self, reps, exact=True):
+        sample_ids = {rep.sample_extraction.sample_id for rep in reps}
+        extraction_batch_ids = {rep.sample_extraction.extraction_batch_id for rep in reps}
+        fcsvs = dict(FinalConcentratedSampleVolume.objects.filter(sample__in=sample_ids).values_list(
+            'sample', 'final_concentrated_sample_volume'))
+        # assume that there can be only one RT per EB, except when there is a re_rt,
+        # in which case the 'old' RT is no longer valid (the re_rt value must be null for the record to be valid)
+        rts = {}
+        for rt in ReverseTranscription.objects.filter(
+                extraction_batch__in=extraction_batch_ids, re_rt=None).order_by('id'):
+            rts.setdefault(rt.extraction_batch_id, rt)
+
+        eb_contexts = {}
+        sample_contexts = {}
+        rep_values = []
+        for rep in reps:
+            extr = rep.sample_extraction
+            sample = extr.sample
+            nucleic_acid_type_name = rep.pcrreplicate_batch.target.nucleic_acid_type.name.upper()
+            if extr.extraction_batch_id not in eb_contexts:
+                eb_contexts[extr.extraction_batch_id] = get_extraction_batch_context(
+                    extr.extraction_batch, rts.get(extr.extraction_batch_id))
+            if sample.id not in sample_contexts:
+                sample_contexts[sample.id] = get_sample_context(sample, sample.matrix.code, fcsvs.get(sample.id))
+            if nucleic_acid_type_name == 'DNA':
+                inhibition = extr.inhibition_dna
+            elif nucleic_acid_type_name == 'RNA':
+                inhibition = extr.inhibition_rna
+            else:
+                inhibition = None
+            rep_values.append({
+                "gc_reaction": rep.gc_reaction,
+                "extraction_batch_id": extr.extraction_batch_id,
+                "sample_id": sample.id,
+                "nucleic_acid_type_name": nucleic_acid_type_name,
+                "inhibition_dilution_factor": inhibition.dilution_factor if inhibition else None
+            })
+        return calc_rep_concs(rep_values, eb_contexts, sample_contexts, exact)
+
+    # recalculate the replicate_concentration and/or the invalid flag of a set of reps
+    # and then the FSMC of each affected sample-target combo,
+    # using a constant number of queries regardless of the number of reps
+    def recalc(self, reps, recalc_rep_conc=True, recalc_invalid=True):
+        reps = list(reps.select_related(
+            'sample_extraction__sample__matrix', 'sample_extraction__extraction_batch',
+            'sample_extraction__inhibition_dna', 'sample_extraction__inhibition_rna',
+            'pcrreplicate_batch__target__nucleic_acid_type'))
+        if not reps or not (recalc_rep_conc or recalc_invalid):
+            return 0
+
+        peg_neg_ids = set()
+        target_ids = set()
+        for rep in reps:
+            sample = rep.sample_extraction.sample
             # record_type 1 means regular data (not a control), record_type 2 means control data (not regular data)
             # only a regular data sample can potentially have a peg_neg control
-            # the inverse (a control data sample having a peg_neg control) is impossible
-            peg_neg_id = sample.peg_neg.id if sample.peg_neg is not None and sample.record_type.id == 1 else None
-            if peg_neg_id is not None:
-                target_id = pcrreplicate_batch.target.id
-                # only get reps with the same target as this data rep
-                peg_neg_rep_count = PCRReplicate.objects.filter(
-                    sample_extraction__sample=peg_neg_id, pcrreplicate_batch__target__exact=target_id).count()
-                # if there are no peg_neg reps, the the data rep must be set to invalid
-                if peg_neg_rep_count == 0:
-                    peg_neg_not_extracted = True
-                peg_neg_invalids = PCRReplicate.objects.filter(sample_extraction__sample=peg_neg_id,
-                                                               pcrreplicate_batch__target__exact=target_id,
-                                                               invalid=True, cq_value__isnull=False).annotate(
-                    sample=F('sample_extraction__sample')).annotate(
-                    analysis_batch=F('pcrreplicate_batch__extraction_batch__analysis_batch')).annotate(
-                    extraction_number=F('pcrreplicate_batch__extraction_batch__extraction_number')).annotate(
-                    replicate_number=F('pcrreplicate_batch__replicate_number')).annotate(
-                    target=F('pcrreplicate_batch__target')
-                ).values('sample', 'analysis_batch', 'extraction_number', 'replicate_number', 'target')
-                peg_neg_missings = PCRReplicate.objects.filter(sample_extraction__sample=peg_neg_id,
-                                                               pcrreplicate_batch__target__exact=target_id,
-                                                               cq_value__isnull=True).annotate(
-                    sample=F('sample_extraction__sample')).annotate(
-                    analysis_batch=F('pcrreplicate_batch__extraction_batch__analysis_batch')).annotate(
-                    extraction_number=F('pcrreplicate_batch__extraction_batch__extraction_number')).annotate(
-                    replicate_number=F('pcrreplicate_batch__replicate_number')).annotate(
-                    target=F('pcrreplicate_batch__target')
-                ).values('sample', 'analysis_batch', 'extraction_number', 'replicate_number', 'target')
+            if sample.peg_neg_id is not None and sample.record_type_id == 1:
+                peg_neg_ids.add(sample.peg_neg_id)
+            target_ids.add(rep.pcrreplicate_batch.target_id)
+
+        # fetch all the related values that cannot be selected along with the reps themselves
+        control_validities = ControlValidity.objects.get_for(
+            (rep.pcrreplicate_batch.extraction_batch_id, rep.pcrreplicate_batch.target_id) for rep in reps)
+        # the validity of each peg_neg rep, grouped by peg_neg sample and target
+        peg_neg_reps = {}
+        for rep_id, sample_id, target_id, invalid in self.filter(
+                sample_extraction__sample__in=peg_neg_ids, pcrreplicate_batch__target__in=target_ids).values_list(
+                'id', 'sample_extraction__sample', 'pcrreplicate_batch__target', 'invalid'):
+            peg_neg_reps.setdefault((sample_id, target_id), {})[rep_id] = invalid
+
+        if recalc_rep_conc:
+            new_rep_concs = {rep.id: rep_conc for rep, rep_conc in zip(reps, self.calc_concs(reps))}
+
+        # assess control reps before data reps, so that data reps see the new validity of their peg_neg reps
+        reps.sort(key=lambda x: x.sample_extraction.sample.record_type_id == 1)
+        changed_reps = []
+        changed_peg_negs = set()
+        for rep in reps:
+            extr = rep.sample_extraction
+            sample = extr.sample
+            pcrreplicate_batch = rep.pcrreplicate_batch
+            target = pcrreplicate_batch.target
+            nucleic_acid_type_name = target.nucleic_acid_type.name.upper()
+            old_values = (rep.replicate_concentration, rep.invalid)
+            if recalc_rep_conc:
+                rep.replicate_concentration = new_rep_concs[rep.id]
+
+            # see PCRReplicate.calc_invalid for the rules applied here
+            if recalc_invalid and rep.invalid_override_id is None:
+                if rep.cq_value is not None and rep.gc_reaction is not None:
+                    any_peg_neg_invalid = False
+                    if sample.peg_neg_id is not None and sample.record_type_id == 1:
+                        peg_neg_validities = peg_neg_reps.get((sample.peg_neg_id, target.id), {})
+                        any_peg_neg_invalid = not peg_neg_validities or any(peg_neg_validities.values())
+                    control_validity = control_validities.get((pcrreplicate_batch.extraction_batch_id, target.id))
+                    rep.invalid = (
+                            any_peg_neg_invalid or (control_validity.controls_invalid if control_validity else True)
+                            or rep.cq_value < Decimal('0') or rep.gc_reaction < Decimal('0'))
+                else:
+                    rep.invalid = True
+                if (sample.id, target.id) in peg_neg_reps:
+                    peg_neg_reps[(sample.id, target.id)][rep.id] = rep.invalid
+
+            if (rep.replicate_concentration, rep.invalid) != old_values:
+                rep.modified_date = date.today()
+                changed_reps.append(rep)
+                if rep.invalid != old_values[1] and sample.record_type_id == 2:
+                    changed_peg_negs.add((sample.id, target.id))
+
+        # only write (and record history for) the reps whose values actually changed
+        self.bulk_update(changed_reps, ['replicate_concentration', 'invalid', 'modified_date'], batch_size=500)
+        bulk_create_update_history(self.model, changed_reps)
+        self.filter(id__in=[rep.id for rep in reps], recalc_pending=True).update(recalc_pending=False)
+
+        sample_targets = {(rep.sample_extraction.sample_id, rep.pcrreplicate_batch.target_id) for rep in reps}
+        # propagate the peg_negs whose validity flipped to the reps of the samples using them
+        sample_targets.update(PegNegValidity.objects.propagate(changed_peg_negs))
+
+        # finally, update the FSMC of every affected sample-target combo exactly once
+        FinalSampleMeanConcentration.objects.recalc(sample_targets)
+
+        return len(changed_reps)
+
+    # get the invalid reasons of a list of reps (see PCRReplicate.invalid_reasons) using a few grouped queries,
+    # rather than about ten queries per invalid rep
+    def get_invalid_reasons(self, reps):
+        reps = list(reps)
+        invalid_reps = list(self.filter(id__in=[rep.id for rep in reps if rep.invalid]).select_related(
+            'sample_extraction__sample', 'pcrreplicate_batch__extraction_batch',
+            'pcrreplicate_batch__target__nucleic_acid_type'))
+
+        peg_neg_ids = set()
+        extraction_batch_ids = set()
+        target_ids = set()
+        for rep in invalid_reps:
+            sample = rep.sample_extraction.sample
+            # record_type 1 means regular data (not a control), record_type 2 means control data (not regular data)
+            # only a regular data sample can potentially have a peg_neg control
+            if sample.peg_neg_id is not None and sample.record_type_id == 1:
+                peg_neg_ids.add(sample.peg_neg_id)
+            extraction_batch_ids.add(rep.pcrreplicate_batch.extraction_batch_id)
+            target_ids.add(rep.pcrreplicate_batch.target_id)
+
+        # the reps of each peg_neg, grouped by peg_neg sample and target
+        peg_neg_reps = {}
+        for peg_neg_rep in self.filter(
+                sample_extraction__sample__in=peg_neg_ids, pcrreplicate_batch__target__in=target_ids).annotate(
+                sample=F('sample_extraction__sample')).annotate(
+                analysis_batch=F('pcrreplicate_batch__extraction_batch__analysis_batch')).annotate(
+                extraction_number=F('pcrreplicate_batch__extraction_batch__extraction_number')).annotate(
+                replicate_number=F('pcrreplicate_batch__replicate_number')).annotate(
+                target=F('pcrreplicate_batch__target')).values(
+                'sample', 'analysis_batch', 'extraction_number', 'replicate_number', 'target',
+                'invalid', 'cq_value').order_by('id'):
+            peg_neg_reps.setdefault((peg_neg_rep['sample'], peg_neg_rep['target']), []).append(peg_neg_rep)
+        # assume that there can be only one RT per EB, except when there is a re_rt,
+        # in which case the 'old' RT is no longer valid (the re_rt value must be null for the record to be valid)
+        rts = {}
+        for rt in ReverseTranscription.objects.filter(
+                extraction_batch__in=extraction_batch_ids, re_rt=None).order_by('id'):
+            rts.setdefault(rt.extraction_batch_id, rt)
+        # the sibling PCR replicate batches of each extraction batch and target
+        sibling_batches = {}
+        for pcrreplicate_batch in PCRReplicateBatch.objects.filter(
+                extraction_batch__in=extraction_batch_ids, target__in=target_ids).annotate(
+                analysis_batch=F('extraction_batch__analysis_batch')).annotate(
+                extraction_number=F('extraction_batch__extraction_number')).values(
+                'id', 'extraction_batch', 'analysis_batch', 'extraction_number', 'replicate_number', 'target',
+                'ext_neg_invalid', 'ext_neg_cq_value', 'rt_neg_invalid', 'rt_neg_cq_value',
+                'pcr_neg_invalid', 'pcr_neg_cq_value').order_by('id'):
+            sibling_batches.setdefault(
+                (pcrreplicate_batch['extraction_batch'], pcrreplicate_batch['target']), []).append(pcrreplicate_batch)
+
+        def make_peg_neg_rep_object(peg_neg_rep):
+            keys = ('sample', 'analysis_batch', 'extraction_number', 'replicate_number', 'target')
+            return {key: peg_neg_rep[key] for key in keys}
+
+        def make_sibling_batch_objects(sibling_batches_list):
+            # like the SQL UNION of values() this replaces, remove duplicates (a batch with more than one invalid or
+            # missing control) and order by the selected columns (where the model fields come before the annotations)
+            keys = ('replicate_number', 'target', 'analysis_batch', 'extraction_number')
+            rows = {tuple(sibling_batch[key] for key in keys) for sibling_batch in sibling_batches_list}
+            return [dict(zip(keys, row)) for row in sorted(rows)]
+
+        invalid_reasons = {}
+        for rep in invalid_reps:
+            reasons = {}
+            pcrreplicate_batch = rep.pcrreplicate_batch
+            extraction_batch = pcrreplicate_batch.extraction_batch
+            sample = rep.sample_extraction.sample
+            nucleic_acid_type_name = pcrreplicate_batch.target.nucleic_acid_type.name.upper()
 
             # Parent PegNeg Controls
 
-            if peg_neg_not_extracted:
-                reasons["peg_neg_not_extracted"] = True
-            else:
-                reasons["peg_neg_not_extracted"] = False
-            if len(peg_neg_invalids) > 0:
-                reasons["peg_neg_reps_invalid"] = True
-                reasons["peg_neg_reps_invalid_list"] = list(peg_neg_invalids)
-            else:
-                reasons["peg_neg_reps_invalid"] = False
-                reasons["peg_neg_reps_invalid_list"] = ""
-            if len(peg_neg_missings) > 0:
-                reasons["peg_neg_reps_missing"] = True
-                reasons["peg_neg_reps_missing_list"] = list(peg_neg_missings)
-            else:
-                reasons["peg_neg_reps_missing"] = False
-                reasons["peg_neg_reps_missing_list"] = ""
-
-            # then check all other controls applicable to this rep
+            peg_neg_invalids = []
+            peg_neg_missings = []
+            peg_neg_not_extracted = False
+            if sample.peg_neg_id is not None and sample.record_type_id == 1:
+                # only get reps with the same target as this data rep
+                peg_neg_target_reps = peg_neg_reps.get((sample.peg_neg_id, pcrreplicate_batch.target_id), [])
+                # if there are no peg_neg reps, the the data rep must be set to invalid
+                peg_neg_not_extracted = len(peg_neg_target_reps) == 0
+                peg_neg_invalids = [make_peg_neg_rep_object(peg_neg_rep) for peg_neg_rep in peg_neg_target_reps
+                                    if peg_neg_rep['invalid'] and peg_neg_rep['cq_value'] is not None]
+                peg_neg_missings = [make_peg_neg_rep_object(peg_neg_rep) for peg_neg_rep in peg_neg_target_reps
+                                    if peg_neg_rep['cq_value'] is None]
+            reasons["peg_neg_not_extracted"] = peg_neg_not_extracted
+            reasons["peg_neg_reps_invalid"] = len(peg_neg_invalids) > 0
+            reasons["peg_neg_reps_invalid_list"] = peg_neg_invalids if len(peg_neg_invalids) > 0 else ""
+            reasons["peg_neg_reps_missing"] = len(peg_neg_missings) > 0
+            reasons["peg_neg_reps_missing_list"] = peg_neg_missings if len(peg_neg_missings) > 0 else ""
 
             # Parent ExtractionBatch Controls
 
-            # ext_pos_dna is a special case that only applies if the target of the pcrreplicate_batch is RNA
-            if pcrreplicate_batch.target.nucleic_acid_type.name.upper() == 'DNA':
-                if pcrreplicate_batch.extraction_batch.ext_pos_dna_cq_value is None:
-                    reasons["ext_pos_dna_missing"] = True
-                else:
-                    reasons["ext_pos_dna_missing"] = False
-                if (pcrreplicate_batch.extraction_batch.ext_pos_dna_cq_value is not None
-                        and not pcrreplicate_batch.extraction_batch.ext_pos_dna_cq_value > Decimal('0')):
-                    reasons["ext_pos_dna_invalid"] = True
-                else:
-                    reasons["ext_pos_dna_invalid"] = False
+            # ext_pos_dna is a special case that only applies if the target of the pcrreplicate_batch is DNA
+            ext_pos_dna_cq_value = extraction_batch.ext_pos_dna_cq_value
+            if nucleic_acid_type_name == 'DNA':
+                reasons["ext_pos_dna_missing"] = ext_pos_dna_cq_value is None
+                reasons["ext_pos_dna_invalid"] = (
+                        ext_pos_dna_cq_value is not None and not ext_pos_dna_cq_value > Decimal('0'))
             else:
                 reasons["ext_pos_dna_missing"] = False
                 reasons["ext_pos_dna_invalid"] = False
             # ext_pos_rt_rna is a special case that only applies if the target of the pcrreplicate_batch is RNA
-            if pcrreplicate_batch.target.nucleic_acid_type.name.upper() == 'RNA':
-                rt = ReverseTranscription.objects.filter(
-                    extraction_batch=pcrreplicate_batch.extraction_batch.id, re_rt=None).first()
-                if rt and rt.ext_pos_rna_rt_cq_value is None:
-                    reasons["ext_rt_pos_rna_missing"] = True
-                else:
-                    reasons["ext_rt_pos_rna_missing"] = False
-                if rt and rt.ext_pos_rna_rt_cq_value is not None and not rt.ext_pos_rna_rt_cq_value > Decimal('0'):
-                    reasons["ext_rt_pos_rna_invalid"] = True
-                else:
-                    reasons["ext_rt_pos_rna_invalid"] = False
+            if nucleic_acid_type_name == 'RNA':
+                rt = rts.get(extraction_batch.id)
+                reasons["ext_rt_pos_rna_missing"] = bool(rt and rt.ext_pos_rna_rt_cq_value is None)
+                reasons["ext_rt_pos_rna_invalid"] = bool(
+                    rt and rt.ext_pos_rna_rt_cq_value is not None and not rt.ext_pos_rna_rt_cq_value > Decimal('0'))
             else:
                 reasons["ext_rt_pos_rna_missing"] = False
                 reasons["ext_rt_pos_rna_invalid"] = False
 
             # Parent Sibling PCRReplicateBatch Controls
 
-            ext_neg_invalids = PCRReplicateBatch.objects.filter(
-                extraction_batch=pcrreplicate_batch.extraction_batch.id,
-                target=pcrreplicate_batch.target.id,
-                ext_neg_invalid=True,
-                ext_neg_cq_value__isnull=False
-            ).exclude(id=pcrreplicate_batch.id
-                      ).annotate(analysis_batch=F('extraction_batch__analysis_batch')
-                                 ).annotate(extraction_number=F('extraction_batch__extraction_number')
-                                            ).values('analysis_batch', 'extraction_number', 'replicate_number',
-                                                     'target')
-            ext_neg_missings = PCRReplicateBatch.objects.filter(
-                extraction_batch=pcrreplicate_batch.extraction_batch.id,
-                target=pcrreplicate_batch.target.id,
-                ext_neg_cq_value__isnull=True
-            ).exclude(id=pcrreplicate_batch.id).annotate(analysis_batch=F('extraction_batch__analysis_batch')
-                                                         ).annotate(
-                extraction_number=F('extraction_batch__extraction_number')
-            ).values('analysis_batch', 'extraction_number', 'replicate_number', 'target')
-
-            # rt_neg is a special case that only applies if the target of the pcrreplicate_batch is RNA
-            if self.pcrreplicate_batch.target.nucleic_acid_type.id == 2:
-                rt_neg_invalids = PCRReplicateBatch.objects.filter(
-                    extraction_batch=pcrreplicate_batch.extraction_batch.id,
-                    target=pcrreplicate_batch.target.id,
-                    rt_neg_invalid=True,
-                    rt_neg_cq_value__isnull=False,
-                    target__nucleic_acid_type=2
-                ).exclude(id=pcrreplicate_batch.id).annotate(analysis_batch=F('extraction_batch__analysis_batch')
-                                                             ).annotate(
-                    extraction_number=F('extraction_batch__extraction_number')
-                    ).values('analysis_batch', 'extraction_number', 'replicate_number', 'target')
-                rt_neg_missings = PCRReplicateBatch.objects.filter(
-                    extraction_batch=pcrreplicate_batch.extraction_batch.id,
-                    target=pcrreplicate_batch.target.id,
-                    rt_neg_cq_value__isnull=True,
-                    target__nucleic_acid_type=2
-                ).exclude(id=pcrreplicate_batch.id).annotate(analysis_batch=F('extraction_batch__analysis_batch')
-                                                             ).annotate(
-                    extraction_number=F('extraction_batch__extraction_number')
-                ).values('analysis_batch', 'extraction_number', 'replicate_number', 'target')
-            else:
-                rt_neg_invalids = PCRReplicateBatch.objects.none()
-                rt_neg_missings = PCRReplicateBatch.objects.none()
-
-            pcr_neg_invalids = PCRReplicateBatch.objects.filter(
-                extraction_batch=pcrreplicate_batch.extraction_batch.id,
-                target=pcrreplicate_batch.target.id,
-                pcr_neg_invalid=True,
-                pcr_neg_cq_value__isnull=False
-            ).exclude(id=pcrreplicate_batch.id).annotate(analysis_batch=F('extraction_batch__analysis_batch')
-                                                         ).annotate(
-                extraction_number=F('extraction_batch__extraction_number')
-            ).values('analysis_batch', 'extraction_number', 'replicate_number', 'target')
-            pcr_neg_missings = PCRReplicateBatch.objects.filter(
-                extraction_batch=pcrreplicate_batch.extraction_batch.id,
-                target=pcrreplicate_batch.target.id,
-                pcr_neg_cq_value__isnull=True
-            ).exclude(id=pcrreplicate_batch.id).annotate(analysis_batch=F('extraction_batch__analysis_batch')
-                                                         ).annotate(
-                extraction_number=F('extraction_batch__extraction_number')
-            ).values('analysis_batch', 'extraction_number', 'replicate_number', 'target')
-
-            if len(ext_neg_invalids) > 0 or len(rt_neg_invalids) > 0 or len(pcr_neg_invalids) > 0:
-                reasons["sibling_pcr_rep_controls_invalid"] = True
-                reasons["sibling_pcr_rep_controls_invalid_list"] = list(
-                    ext_neg_invalids.union(rt_neg_invalids).union(pcr_neg_invalids))
-            else:
-                reasons["sibling_pcr_rep_controls_invalid"] = False
-                reasons["sibling_pcr_rep_controls_invalid_list"] = ""
-            if len(ext_neg_missings) > 0 or len(rt_neg_missings) > 0 or len(pcr_neg_missings) > 0:
-                reasons["sibling_pcr_rep_controls_missing"] = True
-                reasons["sibling_pcr_rep_controls_missing_list"] = list(
-                    ext_neg_missings.union(rt_neg_missings).union(pcr_neg_missings))
-            else:
-                reasons["sibling_pcr_rep_controls_missing"] = False
-                reasons["sibling_pcr_rep_controls_missing_list"] = ""
+            siblings = [sibling_batch for sibling_batch in sibling_batches.get(
+                (extraction_batch.id, pcrreplicate_batch.target_id), []) if sibling_batch['id'] != pcrreplicate_batch.id]
+            sibling_invalids = []
+            sibling_missings = []
+            for sibling_batch in siblings:
+                controls = ['ext_neg', 'pcr_neg']
+                # rt_neg is a special case that only applies if the target of the pcrreplicate_batch is RNA
+                if pcrreplicate_batch.target.nucleic_acid_type_id == 2:
+                    controls.append('rt_neg')
+                for control in controls:
+                    if sibling_batch[control + '_cq_value'] is None:
+                        sibling_missings.append(sibling_batch)
+                    elif sibling_batch[control + '_invalid']:
+                        sibling_invalids.append(sibling_batch)
+            reasons["sibling_pcr_rep_controls_invalid"] = len(sibling_invalids) > 0
+            reasons["sibling_pcr_rep_controls_invalid_list"] = (
+                make_sibling_batch_objects(sibling_invalids) if len(sibling_invalids) > 0 else "")
+            reasons["sibling_pcr_rep_controls_missing"] = len(sibling_missings) > 0
+            reasons["sibling_pcr_rep_controls_missing_list"] = (
+                make_sibling_batch_objects(sibling_missings) if len(sibling_missings) > 0 else "")
 
             # Parent PCRReplicateBatch Controls
 
-            if pcrreplicate_batch.ext_neg_cq_value is None:
-                reasons["ext_neg_missing"] = True
-            else:
-                reasons["ext_neg_missing"] = False
-            if pcrreplicate_batch.ext_neg_cq_value is not None and pcrreplicate_batch.ext_neg_cq_value > Decimal('0'):
-                reasons["ext_neg_invalid"] = True
-            else:
-                reasons["ext_neg_invalid"] = False
+            reasons["ext_neg_missing"] = pcrreplicate_batch.ext_neg_cq_value is None
+            reasons["ext_neg_invalid"] = (
+                    pcrreplicate_batch.ext_neg_cq_value is not None and pcrreplicate_batch.ext_neg_cq_value > Decimal('0'))
             # rt_neg is a special case that only applies if the target of the pcrreplicate_batch is RNA
             if pcrreplicate_batch.rt_neg_invalid:
-                if pcrreplicate_batch.rt_neg_cq_value is None:
-                    reasons["rt_neg_missing"] = True
-                else:
-                    reasons["rt_neg_missing"] = False
-                if pcrreplicate_batch.rt_neg_cq_value is not None and pcrreplicate_batch.rt_neg_cq_value > Decimal('0'):
-                    reasons["rt_neg_invalid"] = True
-                else:
-                    reasons["rt_neg_invalid"] = False
+                reasons["rt_neg_missing"] = pcrreplicate_batch.rt_neg_cq_value is None
+                reasons["rt_neg_invalid"] = (
+                        pcrreplicate_batch.rt_neg_cq_value is not None
+                        and pcrreplicate_batch.rt_neg_cq_value > Decimal('0'))
             else:
                 reasons["rt_neg_missing"] = False
                 reasons["rt_neg_invalid"] = False
-            if pcrreplicate_batch.pcr_neg_cq_value is None:
-                reasons["pcr_neg_missing"] = True
-            else:
-                reasons["pcr_neg_missing"] = False
-            if pcrreplicate_batch.pcr_neg_cq_value is not None and pcrreplicate_batch.pcr_neg_cq_value > Decimal('0'):
-                reasons["pcr_neg_invalid"] = True
-            else:
-                reasons["pcr_neg_invalid"] = False
+            reasons["pcr_neg_missing"] = pcrreplicate_batch.pcr_neg_cq_value is None
+            reasons["pcr_neg_invalid"] = (
+                    pcrreplicate_batch.pcr_neg_cq_value is not None and pcrreplicate_batch.pcr_neg_cq_value > Decimal('0'))
 
             # Self Values
 
-            if self.cq_value is None:
-                reasons["cq_value_missing"] = True
-            else:
-                reasons["cq_value_missing"] = False
-            if self.gc_reaction is None:
-                reasons["gc_reaction_missing"] = True
-            else:
-                reasons["gc_reaction_missing"] = False
-            if self.invalid_override is not None:
-                reasons["invalid_override"] = True
-            else:
-                reasons["invalid_override"] = False
+            reasons["cq_value_missing"] = rep.cq_value is None
+            reasons["gc_reaction_missing"] = rep.gc_reaction is None
+            reasons["invalid_override"] = rep.invalid_override_id is not None
 
-        else:
-            reasons = {
-                "peg_neg_not_extracted": False,
-                "peg_neg_reps_invalid": False, "peg_neg_reps_invalid_list": False,
-                "peg_neg_reps_missing": False, "peg_neg_reps_missing_list": False,
-                "ext_pos_dna_missing": False, "ext_pos_dna_invalid": False,
-                "ext_rt_pos_rna_missing": False, "ext_rt_pos_rna_invalid": False,
-                "sibling_pcr_rep_controls_invalid": False, "sibling_pcr_rep_controls_invalid_list": False,
-                "sibling_pcr_rep_controls_missing": False, "sibling_pcr_rep_controls_missing_list": False,
-                "ext_neg_missing": False, "ext_neg_invalid": False,
-                "rt_neg_missing": False, "rt_neg_invalid": False,
-                "pcr_neg_missing": False, "pcr_neg_invalid": False,
-                "cq_value_missing": False, "gc_reaction_missing": False,
-                "invalid_override": False
-            }
+            invalid_reasons[rep.id] = reasons
 
-        return reasons
+        for rep in reps:
+            if rep.id not in invalid_reasons:
+                invalid_reasons[rep.id] = {
+                    "peg_neg_not_extracted": False,
+                    "peg_neg_reps_invalid": False, "peg_neg_reps_invalid_list": False,
+                    "peg_neg_reps_missing": False, "peg_neg_reps_missing_list": False,
+                    "ext_pos_dna_missing": False, "ext_pos_dna_invalid": False,
+                    "ext_rt_pos_rna_missing": False, "ext_rt_pos_rna_invalid": False,
+                    "sibling_pcr_rep_controls_invalid": False, "sibling_pcr_rep_controls_invalid_list": False,
+                    "sibling_pcr_rep_controls_missing": False, "sibling_pcr_rep_controls_missing_list": False,
+                    "ext_neg_missing": False, "ext_neg_invalid": False,
+                    "rt_neg_missing": False, "rt_neg_invalid": False,
+                    "pcr_neg_missing": False, "pcr_neg_invalid": False,
+                    "cq_value_missing": False, "gc_reaction_missing": False,
+                    "invalid_override": False
+                }
+        return invalid_reasons
+
+
+class PCRReplicate(HistoryModel):
+    """
+    Polymerase Chain Reaction Replicate
+    """
+
+    @property
+    def gc_reaction_sci(self):
+        return get_sci_val(self.gc_reaction)
+
+    @property
+    def replicate_concentration_sci(self):
+        return get_sci_val(self.replicate_concentration)
+
+    @property
+    def invalid_reasons(self):
+        return PCRReplicate.objects.get_invalid_reasons([self])[self.id]
 
     @property
     def missing_calculation_values(self):
@@ -1523,9 +2050,10 @@ class PCRReplicate(HistoryModel):
     invalid = models.BooleanField(default=True)
     invalid_override = models.ForeignKey(
         settings.AUTH_USER_MODEL, models.PROTECT, null=True, related_name='pcrreplicates')
+    recalc_pending = models.BooleanField(default=False)
     history = HistoricalRecords(inherit=True, table_name='lili_pcrreplicatehistory',
-                                custom_model_name=lambda x: f'{x}History')
-    # objects = PCRReplicateManager()
+                                custom_model_name=lambda x: f'{x}History', excluded_fields=['recalc_pending'])
+    objects = PCRReplicateManager()
 
     # override the save method to assign or calculate concentration_unit, replicate_concentration, and invalid flag
     def save(self, *args, **kwargs):
@@ -1547,11 +2075,26 @@ class PCRReplicate(HistoryModel):
                 sample=self.sample_extraction.sample, target=self.pcrreplicate_batch.target,
                 created_by=self.created_by, modified_by=self.modified_by)
 
+        # if a recalculation unit of work is active, leave the recalculations below to it,
+        # so that they are run only once per sample-target combo (and peg_neg) when its transaction is committed
+        unit_of_work = RecalcUnitOfWork.get_active()
+        if unit_of_work is not None:
+            unit_of_work.add_sample_target(self.sample_extraction.sample.id, self.pcrreplicate_batch.target.id)
+            if self.sample_extraction.sample.record_type_id == 2:
+                unit_of_work.add_peg_neg_target(self.sample_extraction.sample.id, self.pcrreplicate_batch.target.id)
+            return
+
         # then update final sample mean concentration
         # if all the valid related reps have replicate_concentration values the FSMC will be calculated
         # else not all valid related reps have replicate_concentration values, so FSMC will be set to null
         fsmc.final_sample_mean_concentration = fsmc.calc_sample_mean_conc()
-        fsmc.save()
+        fsmc.save(update_fields=['final_sample_mean_concentration', 'modified_date'])
+
+        # if the rep comes from a peg_neg sample, propagate any change of the validity of that peg_neg
+        # to the related reps with the same target from samples using that peg_neg
+        if self.sample_extraction.sample.record_type_id == 2:
+            FinalSampleMeanConcentration.objects.recalc(PegNegValidity.objects.propagate(
+                [(self.sample_extraction.sample.id, self.pcrreplicate_batch.target.id)]))
 
     # get the concentration_unit
     def get_conc_unit(self, sample_id):
@@ -1568,71 +2111,28 @@ class PCRReplicate(HistoryModel):
     # by taking the average of positive replicates (negative replicates (value of "0") are ignored).
     # If all replicates are negative ("0"), then the Mean Sample Concentration is "0".
     def calc_rep_conc(self):
-        # ensure that all necessary values are not null, otherwise return null
-        # aside from the following, all other necessary fields are required (not nullable) at time of creation
-        # all reps must have gc_reaction and inhibition_dilution_factor
-        # reps with matrix F, W, or WW must have final_concentrated_sample_volume
-        # reps with matrix A must have dissolution_volume
-        # reps with matrix SM must have post_dilution_volume
-        if self.gc_reaction is not None and self.inhibition_dilution_factor is not None:
-            if self.gc_reaction > Decimal('0'):
-                sample = self.sample_extraction.sample
-                matrix = sample.matrix.code
-                fcsv = None
-
-                if matrix in ['F', 'W', 'WW']:
-                    fcsv = FinalConcentratedSampleVolume.objects.filter(sample=sample.id).first()
-                    if not fcsv or fcsv.final_concentrated_sample_volume is None:
-                        return None
-                elif matrix == 'A' and sample.dissolution_volume is None:
-                    return None
-                elif matrix == 'SM' and sample.post_dilution_volume is None:
-                    return None
-
-                nucleic_acid_type_name = self.pcrreplicate_batch.target.nucleic_acid_type.name.upper()
-                extr = self.sample_extraction
-                eb = self.sample_extraction.extraction_batch
-
-                # first apply the universal expressions
-                prelim_value = (self.gc_reaction / eb.qpcr_reaction_volume) * (
-                        eb.qpcr_reaction_volume / eb.qpcr_template_volume) * (
-                                       eb.elution_volume / eb.extraction_volume) * (
-                                   eb.sample_dilution_factor)
-                if nucleic_acid_type_name == 'DNA':
-                    prelim_value = prelim_value * extr.inhibition_dna.dilution_factor
-                # apply the RT the expression if applicable
-                elif nucleic_acid_type_name == 'RNA':
-                    # assume that there can be only one RT per EB, except when there is a re_rt,
-                    # in which case the 'old' RT is no longer valid and would have a RT ID value in the re_rt field
-                    # that references the only valid RT;
-                    # in other words, the re_rt value must be null for the record to be valid
-                    rt = ReverseTranscription.objects.filter(extraction_batch=eb, re_rt=None).first()
-                    dl = extr.inhibition_rna.dilution_factor
-                    prelim_value = prelim_value * dl * (rt.reaction_volume / rt.template_volume)
-                # then apply the final volume-or-mass ratio expression (note: liquid_manure does not use this)
-                if matrix in ['F', 'W', 'WW']:
-                    prelim_value = prelim_value * (
-                            fcsv.final_concentrated_sample_volume / sample.total_volume_or_mass_sampled)
-                elif matrix == 'A':
-                    prelim_value = prelim_value * (sample.dissolution_volume / sample.total_volume_or_mass_sampled)
-                elif matrix == 'SM':
-                    prelim_value = prelim_value * (sample.post_dilution_volume / sample.total_volume_or_mass_sampled)
-                # finally, apply the unit-cancelling expression
-                if matrix in ['A', 'F', 'W', 'WW']:
-                    # 1,000 microliters per 1 milliliter
-                    final_value = prelim_value * 1000
-                elif matrix == 'LM':
-                    # 1,000,000 microliters per 1 liter
-                    final_value = prelim_value * 1000000
-                else:
-                    # solid manure
-                    final_value = prelim_value
-                return final_value
-            else:
-                # a gc_reaction less than zero is impossible due to the model field definition
-                return 0
-        else:
-            return None
+        extraction_batch = self.sample_extraction.extraction_batch
+        sample = self.sample_extraction.sample
+        nucleic_acid_type_name = self.pcrreplicate_batch.target.nucleic_acid_type.name
+        rt = None
+        if nucleic_acid_type_name.upper() == 'RNA':
+            # assume that there can be only one RT per EB, except when there is a re_rt,
+            # in which case the 'old' RT is no longer valid and would have a RT ID value in the re_rt field
+            # that references the only valid RT;
+            # in other words, the re_rt value must be null for the record to be valid
+            rt = ReverseTranscription.objects.filter(extraction_batch=extraction_batch, re_rt=None).first()
+        fcsv = FinalConcentratedSampleVolume.objects.filter(sample=sample.id).first()
+        rep = {
+            "gc_reaction": self.gc_reaction,
+            "extraction_batch_id": extraction_batch.id,
+            "sample_id": sample.id,
+            "nucleic_acid_type_name": nucleic_acid_type_name,
+            "inhibition_dilution_factor": self.inhibition_dilution_factor
+        }
+        eb_contexts = {extraction_batch.id: get_extraction_batch_context(extraction_batch, rt)}
+        sample_contexts = {sample.id: get_sample_context(
+            sample, sample.matrix.code, fcsv.final_concentrated_sample_volume if fcsv else None)}
+        return calc_rep_concs([rep], eb_contexts, sample_contexts)[0]
 
     def calc_invalid(self):
         # assess the invalid flags
@@ -1673,57 +2173,23 @@ class PCRReplicate(HistoryModel):
                         any_peg_neg_invalid = True
 
                 # then check all other controls applicable to this rep
-                rna_pos_invalid = False
-                dna_pos_invalid = False
-
-                # # just for debugging
-                # ext_neg_invalids = PCRReplicateBatch.objects.filter(
-                #     extraction_batch=pcrreplicate_batch.extraction_batch.id,
-                #     target=pcrreplicate_batch.target.id).values_list('id', 'ext_neg_invalid')
-                # rt_neg_invalids = PCRReplicateBatch.objects.filter(
-                #     extraction_batch=pcrreplicate_batch.extraction_batch.id,
-                #     target=pcrreplicate_batch.target.id).values_list('id', 'rt_neg_invalid')
-                # pcr_neg_invalids = PCRReplicateBatch.objects.filter(
-                #     extraction_batch=pcrreplicate_batch.extraction_batch.id,
-                #     target=pcrreplicate_batch.target.id).values_list('id', 'pcr_neg_invalid')
-
-                ext_neg_invalid = any(list(PCRReplicateBatch.objects.filter(
-                    extraction_batch=pcrreplicate_batch.extraction_batch.id,
-                    target=pcrreplicate_batch.target.id
-                ).values_list('ext_neg_invalid', flat=True)))
-                rt_neg_invalid = any(list(PCRReplicateBatch.objects.filter(
-                    extraction_batch=pcrreplicate_batch.extraction_batch.id,
-                    target=pcrreplicate_batch.target.id
-                ).values_list('rt_neg_invalid', flat=True)))
-                pcr_neg_invalid = any(list(PCRReplicateBatch.objects.filter(
-                    extraction_batch=pcrreplicate_batch.extraction_batch.id,
-                    target=pcrreplicate_batch.target.id
-                ).values_list('pcr_neg_invalid', flat=True)))
-                if pcrreplicate_batch.target.nucleic_acid_type.name.upper() == 'RNA':
-                    rt = ReverseTranscription.objects.filter(
-                        extraction_batch=pcrreplicate_batch.extraction_batch.id, re_rt=None).first()
-                    rna_pos_invalid = rt.ext_pos_rna_rt_invalid if rt else False
-                if pcrreplicate_batch.target.nucleic_acid_type.name.upper() == 'DNA':
-                    dna_pos_invalid = pcrreplicate_batch.extraction_batch.ext_pos_dna_invalid
+                # (NOTE: **ALL** PCR Replicate Batch controls from the same parent Extraction Batch are considered,
+                # as well as the active RT positive control for RNA targets and the DNA ext_pos for DNA targets)
+                control_validity = ControlValidity.objects.get_for(
+                    [(pcrreplicate_batch.extraction_batch_id, pcrreplicate_batch.target_id)]).get(
+                    (pcrreplicate_batch.extraction_batch_id, pcrreplicate_batch.target_id))
+                controls_invalid = control_validity.controls_invalid if control_validity else True
                 if (
                         not any_peg_neg_invalid and
-                        not dna_pos_invalid and
-                        not rna_pos_invalid and
-                        not ext_neg_invalid and
-                        not rt_neg_invalid and
-                        not pcr_neg_invalid and
+                        not controls_invalid and
                         self.cq_value is not None and self.cq_value >= Decimal('0') and
                         self.gc_reaction is not None and self.gc_reaction >= Decimal('0')
                 ):
                     # this rep is valid
                     return False
                 else:
-                    # if the rep itself comes from a peg_neg sample, and it is invalid,
-                    # then invalidate all related reps with the same target from samples using that peg_neg
-                    if sample.record_type.id == 2:
-                        PCRReplicate.objects.filter(
-                            sample_extraction__sample__peg_neg__id=self.sample_extraction.sample.id,
-                            pcrreplicate_batch__target__id=self.pcrreplicate_batch.target.id).update(invalid=True)
+                    # (if the rep itself comes from a peg_neg sample, its validity is propagated to the related reps
+                    # with the same target from samples using that peg_neg when it is saved)
                     return True
             else:
                 return True
@@ -1738,6 +2204,18 @@ class PCRReplicate(HistoryModel):
         unique_together = ("sample_extraction", "pcrreplicate_batch")
 
 
+@receiver(post_delete, sender=PCRReplicate)
+def pcrreplicate_delete(sender, instance, **kwargs):
+    sample_id = SampleExtraction.objects.filter(
+        id=instance.sample_extraction_id, sample__record_type=2).values_list('sample', flat=True).first()
+    if sample_id is not None:
+        target_id = PCRReplicateBatch.objects.filter(
+            id=instance.pcrreplicate_batch_id).values_list('target', flat=True).first()
+        if target_id is not None:
+            FinalSampleMeanConcentration.objects.recalc(
+                PegNegValidity.objects.propagate([(sample_id, target_id)], create_missing=False))
+
+
 class StandardCurve(HistoryModel):
     """
     Standard Curve
@@ -1759,7 +2237,7 @@ class StandardCurve(HistoryModel):
         db_table = "lili_standardcurve"
 
 
-class Inhibition(HistoryModel):
+class Inhibition(CalculationInputModel):
     """
     Inhibition
     """
@@ -1772,25 +2250,17 @@ class Inhibition(HistoryModel):
     dilution_factor = models.IntegerField(null=True, blank=True, validators=[MINVAL_ZERO])
     history = HistoricalRecords(inherit=True, table_name='lili_inhibitionhistory',
                                 custom_model_name=lambda x: f'{x}History')
+    calculation_input_fields = ('dilution_factor',)
 
     # override the save method to check if a rep calc value changed, and if so, recalc rep conc and rep invalid and FSMC
     def save(self, *args, **kwargs):
-
-        # do_recalc_reps = False
-        #
-        # # a value can only be changed if the instance already exists
-        # if self.pk:
-        #     old_inhibition = Inhibition.objects.get(id=self.pk)
-        #     if self.dilution_factor != old_inhibition.dilution_factor:
-        #         do_recalc_reps = True
+        do_recalc_reps = self.calculation_inputs_changed
 
         super(Inhibition, self).save(*args, **kwargs)
+        self.snapshot_calculation_inputs()
 
-        # if do_recalc_reps:
-        #     recalc_reps('Inhibition', self.id)
-
-        # ALWAYS recalc child PCR Replicates
-        recalc_reps('Inhibition', self.id)
+        if do_recalc_reps:
+            schedule_recalc_reps('Inhibition', self.id)
 
     def __str__(self):
         return str(self.id)
@@ -1818,6 +2288,55 @@ class Target(NameModel):
         db_table = "lili_target"
 
 
+######
+#
+#  Recalculations
+#
+######
+
+
+class PendingRecalcManager(models.Manager):
+
+    # start a celery worker to run the pending recalculations, unless older ones are still waiting for one,
+    # in which case the worker that runs those will also run this one
+    # (older ones locked by a running worker are skipped, since that worker has already claimed its recalculations)
+    def start_worker(self, pending_id):
+        with transaction.atomic():
+            waiting = self.filter(id__lt=pending_id).select_for_update(skip_locked=True).exists()
+        if not waiting:
+            # imported here because the tasks module depends on this one
+            from liliapi.tasks import recalc_pending
+            recalc_pending.apply_async(countdown=settings.RECALC_COUNTDOWN)
+
+
+class PendingRecalc(models.Model):
+    """
+    Pending Recalculation of PCR Replicates (and their FSMCs) queued by a save of one of their parent records
+    """
+
+    level = models.CharField(max_length=128)
+    level_id = models.IntegerField()
+    target = models.IntegerField(null=True, blank=True)
+    recalc_rep_conc = models.BooleanField(default=True)
+    recalc_invalid = models.BooleanField(default=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = PendingRecalcManager()
+
+    def __str__(self):
+        return str(self.id)
+
+    class Meta:
+        db_table = "lili_pendingrecalc"
+        unique_together = ("level", "level_id", "target")
+        ordering = ['id']
+        constraints = [
+            # the unique_together above does not apply to a null target (all targets), since nulls are never equal
+            models.UniqueConstraint(fields=['level', 'level_id'], condition=Q(target__isnull=True),
+                                    name='lili_pendingrecalc_unique_all_targets')
+        ]
+
+
 ######
 #
 #  Misc
@@ -1892,6 +2411,151 @@ class OtherAnalysis(HistoryModel):
         verbose_name_plural = "otheranalyses"
 
 
+class ReportFileManager(models.Manager):
+
+    # returns the current version of the data the reports are built from: a hash of the latest history record
+    # of each of the models involved, which changes whenever any of their records is created, changed, or deleted
+    def get_data_version(self):
+        data_models = [Sample, FinalConcentratedSampleVolume, FinalSampleMeanConcentration, Study, Matrix, SampleType,
+                       Unit, AnalysisBatch, ExtractionBatch, ReverseTranscription, SampleExtraction, Inhibition,
+                       PCRReplicateBatch, PCRReplicate, Target]
+        latest_history_ids = [str(data_model.history.aggregate(latest=models.Max('history_id'))['latest'])
+                              for data_model in data_models]
+        return hashlib.sha1(",".join(latest_history_ids).encode('utf-8')).hexdigest()
+
+    # returns the cache key of a report request: a hash of its report type and its (normalized) parameters
+    def get_cache_key(self, report_type_id, **params):
+        request = json.dumps({"report_type": report_type_id, "params": params}, sort_keys=True)
+        return hashlib.sha1(request.encode('utf-8')).hexdigest()
+
+    # returns the idempotency key of a report request by a user: a hash of its cache key and the user
+    def get_idempotency_key(self, cache_key, user):
+        return hashlib.sha1("{0}:{1}".format(cache_key, user.id).encode('utf-8')).hexdigest()
+
+    # returns the report file of a report request by a user that is still in progress, if any
+    def get_in_progress(self, idempotency_key):
+        return self.filter(idempotency_key=idempotency_key, status=1).first()
+
+    # returns the completed report file of a report request made against the current data, if any
+    def get_cached(self, cache_key, data_version):
+        return self.filter(cache_key=cache_key, data_version=data_version, status=2).exclude(file='').first()
+
+    # returns the IDs of the completed report files that are still valid for the current data
+    def get_valid_cached_ids(self):
+        return list(self.filter(data_version=self.get_data_version(), status=2).exclude(
+            cache_key='').values_list('id', flat=True))
+
+    # return the completed report file of a report request if it is cached,
+    # or the report file of the same request by the same user if it is still in progress (and False),
+    # or else create a new report file for it, to be generated by a task (and True)
+    def get_or_create_for_request(self, report_type_id, user, **params):
+        cache_key = self.get_cache_key(report_type_id, **params)
+        data_version = self.get_data_version()
+        report_file = self.get_cached(cache_key, data_version)
+        if report_file:
+            return report_file, False
+        idempotency_key = self.get_idempotency_key(cache_key, user)
+        report_file = self.get_in_progress(idempotency_key)
+        if report_file:
+            return report_file, False
+        # the ID of the task generating the report is chosen here, so that it is recorded before the task is sent
+        try:
+            with transaction.atomic():
+                report_file = self.create(report_type_id=report_type_id, status_id=1, cache_key=cache_key,
+                                          data_version=data_version, idempotency_key=idempotency_key,
+                                          task_id=str(uuid.uuid4()), created_by=user, modified_by=user)
+        except IntegrityError:
+            # the same request was made at the same time (e.g. by a double click), and its report file created first
+            report_file = self.get_in_progress(idempotency_key)
+            if report_file is None:
+                raise
+            return report_file, False
+        return report_file, True
+
+    # returns the report files still in progress longer than the timeout of their report type after they were requested
+    # (the timeouts of the report types are in REPORT_TASK_TIMEOUTS, and TASK_TIMEOUT is that of all the others)
+    def get_timed_out(self):
+        now = timezone.now()
+        timeouts = settings.REPORT_TASK_TIMEOUTS
+        timed_out = Q(~Q(report_type__in=list(timeouts)),
+                      requested_datetime__lt=now - timedelta(seconds=settings.TASK_TIMEOUT))
+        for report_type_id, timeout in timeouts.items():
+            timed_out |= Q(report_type=report_type_id, requested_datetime__lt=now - timedelta(seconds=timeout))
+        return self.filter(timed_out, status=1)
+
+    # returns the metrics of the phases of the most recent completed report files of each report type (up to runs of
+    # each), aggregated by report type name and phase: the number of runs of the phase, and the mean, median,
+    # and max of each metric (see liliapi.reports.ReportProgress)
+    def get_phase_metrics_summary(self, runs=50):
+        summary = OrderedDict()
+        for report_type in ReportType.objects.order_by('id'):
+            report_files = self.filter(report_type=report_type, status=2).exclude(
+                phase_metrics='').order_by('-id').values_list('phase_metrics', flat=True)[:runs]
+            phases = OrderedDict()
+            run_count = 0
+            for phase_metrics in report_files:
+                run_count += 1
+                for phase in json.loads(phase_metrics):
+                    phases.setdefault(phase['phase'], []).append(phase)
+            summary[report_type.name] = OrderedDict([('runs', run_count), ('phases', OrderedDict())])
+            for name, phase_runs in phases.items():
+                phase_summary = OrderedDict([('runs', len(phase_runs))])
+                for metric in ('wall_seconds', 'queries', 'query_seconds', 'peak_memory', 'rows'):
+                    values = [phase[metric] for phase in phase_runs if phase.get(metric) is not None]
+                    phase_summary[metric] = OrderedDict([
+                        ('mean', statistics.mean(values) if values else None),
+                        ('median', statistics.median(values) if values else None),
+                        ('max', max(values) if values else None)
+                    ])
+                summary[report_type.name]['phases'][name] = phase_summary
+        return summary
+
+    # returns the IDs of the report files to be deleted by the retention policies (see REPORT_RETENTION_* settings):
+    # those older than the max age, then those beyond the most recent of their report type or of their user, and then
+    # the oldest of the rest until the total size of the report files is within the quota
+    # (the report files in progress and those still valid cached results are never deleted, but they count among
+    # the most recent, and in the total size, along with the other_bytes of the other files in the report storage)
+    def get_expired_ids(self, other_bytes=0):
+        max_age_days = settings.REPORT_RETENTION_MAX_AGE_DAYS
+        max_per_type = settings.REPORT_RETENTION_MAX_PER_TYPE
+        max_per_user = settings.REPORT_RETENTION_MAX_PER_USER
+        max_bytes = settings.REPORT_RETENTION_MAX_BYTES
+        oldest_date = date.today() - timedelta(days=max_age_days) if max_age_days is not None else None
+        kept_ids = set(self.get_valid_cached_ids())
+
+        expired_ids = []
+        deletable = []
+        # the bytes quota also counts the other files in the storage of the reports, like the parts of reports
+        # generated in chunks that are still in progress
+        total_bytes = other_bytes
+        type_counts = Counter()
+        user_counts = Counter()
+        for report_file in self.values(
+                'id', 'report_type', 'created_by', 'created_date', 'status', 'file_size').order_by('-id'):
+            kept = report_file['status'] == 1 or report_file['id'] in kept_ids
+            if (not kept and oldest_date is not None and report_file['created_date'] is not None
+                    and report_file['created_date'] < oldest_date):
+                expired_ids.append(report_file['id'])
+                continue
+            type_counts[report_file['report_type']] += 1
+            user_counts[report_file['created_by']] += 1
+            if not kept and ((max_per_type is not None and type_counts[report_file['report_type']] > max_per_type)
+                             or (max_per_user is not None and user_counts[report_file['created_by']] > max_per_user)):
+                expired_ids.append(report_file['id'])
+                continue
+            total_bytes += report_file['file_size'] or 0
+            if not kept:
+                deletable.append(report_file)
+
+        if max_bytes is not None:
+            for report_file in reversed(deletable):
+                if total_bytes <= max_bytes:
+                    break
+                expired_ids.append(report_file['id'])
+                total_bytes -= report_file['file_size'] or 0
+        return sorted(expired_ids)
+
+
 class ReportFile(HistoryModel):
     """
     File created and stored on the server when a report is requested
@@ -1910,15 +2574,43 @@ class ReportFile(HistoryModel):
     report_type = models.ForeignKey('ReportType', models.PROTECT, related_name='reportfiles')
     status = models.ForeignKey('Status', models.PROTECT, related_name='reportfiles')
     fail_reason = models.TextField(blank=True)
+    # the content type and content encoding (gzip or blank) of the file, and its size in bytes (compressed, if gzipped)
+    content_type = models.CharField(max_length=128, blank=True)
+    content_encoding = models.CharField(max_length=32, blank=True)
+    file_size = models.BigIntegerField(null=True, blank=True)
+    # the parameters of the request and the version of the data the report was requested against (see the manager)
+    cache_key = models.CharField(max_length=64, blank=True, db_index=True)
+    data_version = models.CharField(max_length=64, blank=True)
+    # the request and the user, so that a request repeated while its report file is in progress is not duplicated
+    idempotency_key = models.CharField(max_length=64, blank=True)
+    # the ID of the task generating the report and when the report was requested (see the report watchdog task)
+    task_id = models.CharField(max_length=255, blank=True)
+    requested_datetime = models.DateTimeField(default=timezone.now, null=True, blank=True)
+    # the progress of the report task: its current phase, the rows written so far of the total rows (if known),
+    # and the time since it started (recorded at intervals, see liliapi.reports.ReportProgress)
+    phase = models.CharField(max_length=32, blank=True)
+    rows_processed = models.PositiveIntegerField(default=0)
+    rows_total = models.PositiveIntegerField(null=True, blank=True)
+    started_datetime = models.DateTimeField(null=True, blank=True)
+    elapsed_seconds = models.FloatField(null=True, blank=True)
+    # the metrics of the phases of the report task, as a JSON list (see liliapi.reports.ReportProgress)
+    phase_metrics = models.TextField(blank=True)
     history = HistoricalRecords(inherit=True, table_name='lili_reportfilehistory',
                                 custom_model_name=lambda x: f'{x}History')
 
+    objects = ReportFileManager()
+
     def __str__(self):
         return str(self.name)
 
     class Meta:
         db_table = "lili_reportfile"
         ordering = ['-id']
+        constraints = [
+            # only one report file of the same request by the same user can be in progress at a time
+            models.UniqueConstraint(fields=['idempotency_key'], condition=Q(status=1) & ~Q(idempotency_key=''),
+                                    name='lili_reportfile_unique_in_progress')
+        ]
 
 
 @receiver(post_delete, sender=ReportFile)
@@ -0,0 +1,11 @@
+from rest_framework.negotiation import DefaultContentNegotiation
+
+
+class ReportContentNegotiation(DefaultContentNegotiation):
+    """
+    Ignores the format query parameter, which the report requests use for the format of the report file
+    rather than for the format of the response
+    """
+
+    def filter_renderers(self, renderers, format):
+        return renderers
@@ -0,0 +1,460 @@
+import io
+import csv
+import gzip
+import json
+import tempfile
+import time
+import tracemalloc
+from decimal import Decimal
+from collections import OrderedDict
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+
+
+######
+#
+#  Report Writers
+#
+#  The report tasks write their rows into a ReportWriter as they pull them from the database,
+#  rather than building the whole report as Python lists and dicts and dumping it at the end,
+#  so that the memory a report needs does not grow with the size of the report
+#
+######
+
+
+# the number of objects pulled from a server-side cursor (and serialized) at a time
+REPORT_CHUNK_SIZE = 500
+
+# where the parts of the reports generated in chunks are kept until they are merged
+REPORT_PARTS_LOCATION = 'reports/parts/'
+
+# the least number of seconds between two recordings of the rows processed by a report task
+REPORT_PROGRESS_INTERVAL = 5
+
+# the phases that end a report task
+REPORT_FINAL_PHASES = ('complete', 'failed')
+
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return float(obj)
+        return json.JSONEncoder.default(self, obj)
+
+
+def iter_chunks(queryset, chunk_size=REPORT_CHUNK_SIZE):
+    """
+    yields the objects of a queryset in lists of chunk_size objects, pulled from a server-side cursor
+    :param queryset: the queryset
+    :param chunk_size: the number of objects per list
+    :return: a generator of lists of objects
+    """
+    chunk = []
+    for obj in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(obj)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_serialized(queryset, serializer_class, chunk_size=REPORT_CHUNK_SIZE):
+    """
+    yields the serialized objects of a queryset, serializing them one chunk at a time
+    (so that list serializers can still fetch related data for a whole chunk at once)
+    :param queryset: the queryset
+    :param serializer_class: the serializer class of the objects
+    :param chunk_size: the number of objects serialized at a time
+    :return: a generator of the serialized objects
+    """
+    for chunk in iter_chunks(queryset, chunk_size):
+        for item in serializer_class(chunk, many=True).data:
+            yield item
+
+
+# returned by a pivot value function to leave a row out of that pivot table
+PIVOT_SKIP = object()
+
+
+def pivot_rows(rows, row_key, row_fields, column_key, value_functions, columns=(), missing=None):
+    """
+    pivots a single pass over a list of rows into any number of tables, one per value function,
+    in which each distinct row key is a row, and each distinct column key is a column
+    (the values of the row fields are taken from the first row of each row key to be included in a table,
+    and the value of each cell from the last row of its row key and column key)
+    :param rows: an iterable of the (dict) rows, in the order of the table rows
+    :param row_key: the name of the field whose values are the rows of the tables
+    :param row_fields: a list of (name, field) tuples of the leading columns of the table rows
+    :param column_key: the name of the field whose values are the columns of the tables
+    :param value_functions: a list of (table name, function) tuples, where the function returns the value of a row
+        for the table (or PIVOT_SKIP to leave the row out of the table)
+    :param columns: the columns that every table row must have, even if none of its rows have that column key
+    :param missing: the value of the columns a table row has no rows for
+    :return: an OrderedDict of table name to the list of table rows (OrderedDicts, with the pivoted columns sorted)
+    """
+    tables = OrderedDict((name, OrderedDict()) for name, function in value_functions)
+    for row in rows:
+        for name, function in value_functions:
+            value = function(row)
+            if value is PIVOT_SKIP:
+                continue
+            table_row = tables[name].get(row[row_key])
+            if table_row is None:
+                table_row = tables[name][row[row_key]] = (
+                    OrderedDict((field_name, row[field]) for field_name, field in row_fields), {})
+            table_row[1][row[column_key]] = value
+
+    pivoted = OrderedDict()
+    for name, table in tables.items():
+        pivoted[name] = []
+        for fields, values in table.values():
+            for column in columns:
+                values.setdefault(column, missing)
+            table_row = OrderedDict(fields)
+            table_row.update(sorted(values.items()))
+            pivoted[name].append(table_row)
+    return pivoted
+
+
+class ReportProgress(object):
+    """
+    Records the progress of a report task on its ReportFile: the phase whenever it changes, but the rows processed
+    at most once every REPORT_PROGRESS_INTERVAL seconds (rather than once per row), along with the elapsed time
+    (the progress is written with update queries, so that it does not add history records to the report file,
+    and so that the chunks of a report generated in parallel can all add their rows to it)
+
+    Once started (or resumed), it also records the metrics of each phase of the task in the phase_metrics of the
+    report file, as a JSON list: the wall time, the number and time of the SQL queries, the peak memory allocated
+    (if REPORT_TASK_TRACE_MEMORY is set, see tracemalloc), and the rows processed
+    """
+
+    def __init__(self, report_file, interval=REPORT_PROGRESS_INTERVAL):
+        self.report_file = report_file
+        self.interval = interval
+        self.pending_rows = 0
+        self.recorded_time = time.monotonic()
+        # the metrics of the phases so far, and those of the phase in progress (None unless the task is instrumented)
+        self.phase_metrics = []
+        self.phase = None
+        self.tracing = False
+        self.recording = False
+
+    def record(self, **fields):
+        # the fields are also set on the report file object, so that later saves of it do not undo the progress
+        if self.report_file.started_datetime is not None:
+            fields['elapsed_seconds'] = (timezone.now() - self.report_file.started_datetime).total_seconds()
+        for name, value in fields.items():
+            setattr(self.report_file, name, value)
+        # the pending rows are added to the rows recorded so far (which may include those of other chunks)
+        if 'rows_processed' not in fields and self.pending_rows:
+            self.report_file.rows_processed += self.pending_rows
+            fields['rows_processed'] = F('rows_processed') + self.pending_rows
+        self.pending_rows = 0
+        # the queries recording the progress are not counted in the metrics of the phase
+        self.recording = True
+        try:
+            type(self.report_file).objects.filter(pk=self.report_file.pk).update(**fields)
+        finally:
+            self.recording = False
+        self.recorded_time = time.monotonic()
+
+    def time_query(self, execute, sql, params, many, context):
+        # a database execute wrapper, counting and timing the queries of the phase in progress
+        if self.recording or self.phase is None:
+            return execute(sql, params, many, context)
+        start_time = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.phase['queries'] += 1
+            self.phase['query_seconds'] += time.perf_counter() - start_time
+
+    def instrument(self):
+        connection.execute_wrappers.append(self.time_query)
+        if settings.REPORT_TASK_TRACE_MEMORY and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+
+    def uninstrument(self):
+        if self.time_query in connection.execute_wrappers:
+            connection.execute_wrappers.remove(self.time_query)
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+        self.phase = None
+
+    def begin_phase(self, phase):
+        self.phase = OrderedDict([('phase', phase), ('start_time', time.perf_counter()), ('queries', 0),
+                                  ('query_seconds', 0.0), ('rows', 0)])
+        if tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    def end_phase(self):
+        # the peak memory is the most memory allocated at once during the phase (of the memory allocated since the
+        # task was instrumented, and before Python 3.9, since the start of the task rather than of the phase)
+        phase = self.phase
+        self.phase_metrics.append(OrderedDict([
+            ('phase', phase['phase']),
+            ('wall_seconds', round(time.perf_counter() - phase['start_time'], 3)),
+            ('queries', phase['queries']),
+            ('query_seconds', round(phase['query_seconds'], 3)),
+            ('peak_memory', tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None),
+            ('rows', phase['rows'])
+        ]))
+
+    def start(self, phase):
+        self.report_file.started_datetime = timezone.now()
+        self.phase_metrics = []
+        self.instrument()
+        self.begin_phase(phase)
+        self.record(phase=phase, rows_processed=0, rows_total=None, started_datetime=self.report_file.started_datetime,
+                    phase_metrics='')
+
+    def resume(self, phase):
+        # for a task continuing the report of another task, adding the metrics of its phases to those of the other
+        self.phase_metrics = json.loads(self.report_file.phase_metrics) if self.report_file.phase_metrics else []
+        self.instrument()
+        self.begin_phase(phase)
+        self.record(phase=phase)
+
+    def stop(self):
+        # for a task handing the report over to other tasks (the phase in progress is continued by them)
+        self.uninstrument()
+
+    def set_phase(self, phase, rows_total=None):
+        fields = {'phase': phase}
+        if rows_total is not None:
+            fields['rows_total'] = rows_total
+        if self.phase is not None:
+            self.end_phase()
+            if phase in REPORT_FINAL_PHASES:
+                self.uninstrument()
+            else:
+                self.begin_phase(phase)
+            fields['phase_metrics'] = json.dumps(self.phase_metrics)
+        self.record(**fields)
+
+    def add_rows(self, count=1):
+        self.pending_rows += count
+        if self.phase is not None:
+            self.phase['rows'] += count
+        if time.monotonic() - self.recorded_time >= self.interval:
+            self.record()
+
+    def flush(self):
+        if self.pending_rows:
+            self.record()
+
+
+class ReportWriter(object):
+    """
+    Writes a report into a temporary file as it is generated, as JSON (the same as json.dumps of the whole report
+    would give), NDJSON (one JSON value per line), or CSV, optionally gzipped,
+    and then saves that file to a ReportFile
+    """
+
+    # the extension and content type of each format (the gzipped variants add '.gz' to the format name)
+    FORMATS = {
+        'json': ('json', 'application/json'),
+        'ndjson': ('ndjson', 'application/x-ndjson'),
+        'csv': ('csv', 'text/csv')
+    }
+    GZIP_SUFFIX = '.gz'
+
+    @classmethod
+    def get_formats(cls):
+        return list(cls.FORMATS) + [report_format + cls.GZIP_SUFFIX for report_format in cls.FORMATS]
+
+    def __init__(self, report_format='json', default=None, progress=None):
+        if report_format not in self.get_formats():
+            raise ValueError("Unknown report format: {0}".format(report_format))
+        self.gzip = report_format.endswith(self.GZIP_SUFFIX)
+        self.report_format = report_format[:-len(self.GZIP_SUFFIX)] if self.gzip else report_format
+        # the default function for values the DecimalEncoder cannot encode (note that it replaces the Decimal handling)
+        self.default = default
+        # the ReportProgress of the report task, if any, to which the written rows are added
+        self.progress = progress
+        self.row_count = 0
+        self.file = tempfile.TemporaryFile()
+        # the text is encoded (and compressed, if gzipped) on its way into the file
+        self.stream = gzip.GzipFile(fileobj=self.file, mode='wb') if self.gzip else self.file
+        self.text = io.TextIOWrapper(self.stream, encoding='utf-8', newline='')
+
+    @property
+    def extension(self):
+        return self.FORMATS[self.report_format][0] + (self.GZIP_SUFFIX if self.gzip else '')
+
+    @property
+    def content_type(self):
+        return self.FORMATS[self.report_format][1]
+
+    @property
+    def content_encoding(self):
+        return 'gzip' if self.gzip else ''
+
+    def dumps(self, value):
+        return json.dumps(value, cls=DecimalEncoder, default=self.default)
+
+    def write(self, text):
+        self.text.write(text)
+
+    def count_row(self):
+        self.row_count += 1
+        if self.progress is not None:
+            self.progress.add_rows()
+
+    def get_csv_value(self, value):
+        # nested values are written as JSON, and Decimals the same way they are in JSON
+        if value is None:
+            return ''
+        elif isinstance(value, (dict, list)):
+            return self.dumps(value)
+        elif isinstance(value, Decimal):
+            return self.default(value) if self.default else float(value)
+        return value
+
+    def write_csv(self, rows, section=None):
+        # the columns are those of the first row (preceded by the section, if any)
+        csv_writer = csv.writer(self.text)
+        columns = None
+        for row in rows:
+            if not isinstance(row, dict):
+                row = {'value': row}
+            if columns is None:
+                columns = list(row)
+                csv_writer.writerow((['section'] if section is not None else []) + columns)
+            csv_writer.writerow(([section] if section is not None else []) +
+                                [self.get_csv_value(row.get(column)) for column in columns])
+            self.count_row()
+
+    def write_array(self, rows):
+        # JSON: the rows as an array; NDJSON: each row on its own line
+        if self.report_format == 'ndjson':
+            for row in rows:
+                self.write(self.dumps(row) + '\n')
+                self.count_row()
+        else:
+            self.write('[')
+            for index, row in enumerate(rows):
+                self.write((', ' if index else '') + self.dumps(row))
+                self.count_row()
+            self.write(']')
+
+    def write_rows(self, rows):
+        """
+        writes a report that is a list of rows
+        :param rows: an iterable of the rows
+        """
+        if self.report_format == 'csv':
+            self.write_csv(rows)
+        else:
+            self.write_array(rows)
+
+    def write_sections(self, sections):
+        """
+        writes a report that is made of named lists of rows
+        (in NDJSON, each row is written on its own line, along with the name of its section;
+        in CSV, the rows of each section are written under their own header row, with the name of their section)
+        :param sections: an iterable of (name, iterable of the rows) tuples
+        """
+        if self.report_format == 'csv':
+            for name, rows in sections:
+                self.write_csv(rows, section=name)
+        elif self.report_format == 'ndjson':
+            for name, rows in sections:
+                self.write_array(
+                    dict({'section': name}, **row) if isinstance(row, dict) else {'section': name, 'value': row}
+                    for row in rows)
+        else:
+            self.write('{')
+            for index, (name, rows) in enumerate(sections):
+                self.write((', ' if index else '') + self.dumps(name) + ': ')
+                self.write_array(rows)
+            self.write('}')
+
+    def finish(self):
+        # flush the text (and the end of the gzip stream) into the file, and return the size of the file
+        self.text.flush()
+        self.text.detach()
+        if self.gzip:
+            self.stream.close()
+        return self.file.tell()
+
+    def save(self, report_file, file_name):
+        """
+        saves the written report to a report file (copying it to the storage in chunks), recording its content type,
+        content encoding, and (compressed) size on the report file, and closes the writer
+        :param report_file: the ReportFile (which the caller must still save)
+        :param file_name: the name of the file, without its extension
+        :return: the name of the saved file
+        """
+        new_file_name = file_name + "." + self.extension
+        try:
+            if self.progress is not None:
+                self.progress.set_phase('saving')
+            report_file.file_size = self.finish()
+            report_file.content_type = self.content_type
+            report_file.content_encoding = self.content_encoding
+            self.file.seek(0)
+            report_file.file.save(new_file_name, File(self.file), save=False)
+        finally:
+            self.close()
+        return new_file_name
+
+    def save_part(self, part_name):
+        """
+        saves the written report (which must be NDJSON) as a part of a report generated in chunks, and closes the writer
+        :param part_name: the name of the part, without its extension
+        :return: the name of the saved part in the storage
+        """
+        try:
+            if self.progress is not None:
+                self.progress.flush()
+            self.finish()
+            self.file.seek(0)
+            return default_storage.save(REPORT_PARTS_LOCATION + part_name + "." + self.extension, File(self.file))
+        finally:
+            self.close()
+
+    def close(self):
+        self.file.close()
+
+
+def iter_report_parts(part_names):
+    """
+    yields the rows of the parts of a report generated in chunks, in the order of the parts
+    :param part_names: the names of the saved parts (see ReportWriter.save_part)
+    :return: a generator of the rows
+    """
+    for part_name in part_names:
+        with default_storage.open(part_name, 'rb') as part:
+            for line in part:
+                yield json.loads(line.decode('utf-8'))
+
+
+def delete_report_parts(part_names):
+    for part_name in part_names:
+        default_storage.delete(part_name)
+
+
+def get_report_part_sizes():
+    """
+    measures the saved parts of the reports generated in chunks in the storage, including the parts left behind by
+    report tasks that failed or were terminated before merging them
+    :return: a dict of the name of each part to a tuple of the ID of its report file and its size in bytes
+    """
+    if not default_storage.exists(REPORT_PARTS_LOCATION):
+        return {}
+    part_sizes = {}
+    for file_name in default_storage.listdir(REPORT_PARTS_LOCATION)[1]:
+        # the parts are named for the ID of their report file and the index of their chunk (see ReportWriter.save_part)
+        report_file_id = file_name.split('_')[0]
+        if report_file_id.isdigit():
+            part_name = REPORT_PARTS_LOCATION + file_name
+            part_sizes[part_name] = (int(report_file_id), default_storage.size(part_name))
+    return part_sizes
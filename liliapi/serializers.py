@@ -2,7 +2,7 @@ from datetime import datetime
 from queue import PriorityQueue
 from rest_framework import serializers
 from rest_framework.settings import api_settings
-from django.db.models import Max
+from django.db.models import Manager, Max
 from liliapi.models import *
 
 
@@ -129,19 +129,43 @@ class ConcentrationTypeSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'created_date', 'created_by', 'modified_date', 'modified_by',)
 
 
+class FinalSampleMeanConcentrationListSerializer(serializers.ListSerializer):
+
+    # build the sample target replicates of all the FSMCs at once (rather than one FSMC at a time),
+    # and pass them to the child serializer through the context
+    def to_representation(self, data):
+        fsmcs = list(data.all() if isinstance(data, Manager) else data)
+        self.context.setdefault('sample_target_replicates', {}).update(
+            FinalSampleMeanConcentration.objects.get_sample_target_replicates(
+                [(fsmc.sample_id, fsmc.target_id) for fsmc in fsmcs]))
+        return [self.child.to_representation(fsmc) for fsmc in fsmcs]
+
+
 class FinalSampleMeanConcentrationSerializer(serializers.ModelSerializer):
+
+    # use the sample target replicates already built by the list serializer, if any
+    def get_sample_target_replicates(self, obj):
+        sample_target_replicates = self.context.get('sample_target_replicates', {})
+        sample_target = (obj.sample_id, obj.target_id)
+        if sample_target in sample_target_replicates:
+            return sample_target_replicates[sample_target]
+        return obj.sample_target_replicates
+
     created_by = serializers.StringRelatedField()
     modified_by = serializers.StringRelatedField()
     final_sample_mean_concentration = NullableRStrip100DecimalField()
     target_string = serializers.StringRelatedField(source='target')
     collaborator_sample_id = serializers.CharField(source='sample.collaborator_sample_id', read_only=True)
     collection_start_date = serializers.DateField(source='sample.collection_start_date', read_only=True)
+    sample_target_replicates = serializers.SerializerMethodField()
+    recalc_pending = serializers.BooleanField(read_only=True)
 
     class Meta:
         model = FinalSampleMeanConcentration
         fields = ('id', 'final_sample_mean_concentration', 'final_sample_mean_concentration_sci', 'sample', 'target',
                   'target_string', 'collaborator_sample_id', 'collection_start_date', 'sample_target_replicates',
-                  'created_date', 'created_by', 'modified_date', 'modified_by',)
+                  'recalc_pending', 'created_date', 'created_by', 'modified_date', 'modified_by',)
+        list_serializer_class = FinalSampleMeanConcentrationListSerializer
 
 
 class FinalSampleMeanConcentrationResultsSerializer(serializers.ModelSerializer):
@@ -151,12 +175,13 @@ class FinalSampleMeanConcentrationResultsSerializer(serializers.ModelSerializer)
     target_string = serializers.StringRelatedField(source='target')
     collaborator_sample_id = serializers.CharField(source='sample.collaborator_sample_id', read_only=True)
     collection_start_date = serializers.DateField(source='sample.collection_start_date', read_only=True)
+    recalc_pending = serializers.BooleanField(read_only=True)
 
     class Meta:
         model = FinalSampleMeanConcentration
         fields = ('sample', 'target', 'target_string', 'id', 'result', 'final_sample_mean_concentration',
                   'final_sample_mean_concentration_sci', 'collaborator_sample_id', 'collection_start_date',
-                  'created_date', 'created_by', 'modified_date', 'modified_by',)
+                  'recalc_pending', 'created_date', 'created_by', 'modified_date', 'modified_by',)
 
 
 ######
@@ -1104,8 +1129,11 @@ class ReverseTranscriptionListSerializer(serializers.ListSerializer):
 
     # bulk create
     def create(self, validated_data):
-        rts = [ReverseTranscription(**item) for item in validated_data]
-        return ReverseTranscription.objects.bulk_create(rts)
+        rts = ReverseTranscription.objects.bulk_create([ReverseTranscription(**item) for item in validated_data])
+        # bulk_create skips the model save, so update the control validity of each affected extraction batch here
+        for extraction_batch_id in {rt.extraction_batch_id for rt in rts}:
+            ControlValidity.objects.refresh(extraction_batch_id)
+        return rts
 
     # bulk update
     def update(self, instance, validated_data):
@@ -1225,6 +1253,13 @@ class SampleExtractionSerializer(serializers.ModelSerializer):
 
 class PCRReplicateListSerializer(serializers.ListSerializer):
 
+    # resolve the invalid reasons of all the reps at once (rather than one rep at a time),
+    # and pass them to the child serializer through the context
+    def to_representation(self, data):
+        reps = list(data.all() if isinstance(data, Manager) else data)
+        self.context.setdefault('invalid_reasons', {}).update(PCRReplicate.objects.get_invalid_reasons(reps))
+        return [self.child.to_representation(rep) for rep in reps]
+
     # bulk update
     def update(self, instance, validated_data):
         # Maps for id->instance and id->data item.
@@ -1247,20 +1282,7 @@ class PCRReplicateListSerializer(serializers.ListSerializer):
                 data['invalid'] = self.child.calc_invalid()
                 self.child.update(pcrrep, data)
                 ret.append(self.child)
-
-                # if the rep is a peg_neg, find all data reps related to that peg_neg and recalc their invalid flags
-                sample = self.child.sample_extraction.sample
-                if sample.record_type.id == 2 and sample.peg_neg is None:
-                    related_sample_ids = list(Sample.objects.filter(peg_neg=sample.id).values_list('id', flat=True))
-                    related_ext_ids = SampleExtraction.objects.filter(sample__in=related_sample_ids)
-                    reps = PCRReplicate.objects.filter(sample_extraction__in=related_ext_ids,
-                                                       pcrreplicate_batch__target__exact=
-                                                       self.child.pcrreplicate_batch.target.id)
-                    # calculate the invalidity
-                    for rep in reps:
-                        if rep.invalid_override is None:
-                            rep.invalid = rep.calc_invalid()
-                            rep.save()
+                # (if the rep is a peg_neg, saving it propagates any change of its validity to the related data reps)
 
         return ret
 
@@ -1269,6 +1291,7 @@ class PCRReplicateListSerializer(serializers.ListSerializer):
     sample = serializers.PrimaryKeyRelatedField(source='sample_extraction.sample', read_only=True)
     peg_neg = serializers.PrimaryKeyRelatedField(source='sample_extraction.sample.peg_neg', read_only=True)
     invalid_override_string = serializers.StringRelatedField(source='invalid_override')
+    recalc_pending = serializers.BooleanField(read_only=True)
 
     class Meta:
         model = PCRReplicate
@@ -1276,7 +1299,7 @@ class PCRReplicateListSerializer(serializers.ListSerializer):
                   'pcrreplicate_batch', 'cq_value', 'gc_reaction', 'gc_reaction_sci', 'replicate_concentration',
                   'replicate_concentration_sci', 'concentration_unit', 'missing_calculation_values',
                   'calculation_values', 'invalid', 'invalid_override', 'invalid_override_string', 'invalid_reasons',
-                  'created_date', 'created_by', 'modified_date', 'modified_by',)
+                  'recalc_pending', 'created_date', 'created_by', 'modified_date', 'modified_by',)
         extra_kwargs = {
             'concentration_unit': {'required': False}
         }
@@ -1307,23 +1330,16 @@ class PCRReplicateSerializer(serializers.ModelSerializer):
         else:
             instance.invalid = validated_data.get('invalid', instance.invalid)
 
-        # if the rep is a peg_neg, find all data reps related to that peg_neg and recalc their invalid flags
-        sample = instance.sample_extraction.sample
-        if sample.record_type.id == 2 and sample.peg_neg is None:
-            related_sample_ids = list(Sample.objects.filter(peg_neg=sample.id).values_list('id', flat=True))
-            related_ext_ids = SampleExtraction.objects.filter(sample__in=related_sample_ids)
-            reps = PCRReplicate.objects.filter(sample_extraction__in=related_ext_ids,
-                                               pcrreplicate_batch__target__exact=instance.pcrreplicate_batch.target.id)
-            # calculate the invalidity
-            for rep in reps:
-                if rep.invalid_override is None:
-                    rep.invalid = rep.calc_invalid()
-                    rep.save()
-
+        # if the rep is a peg_neg, saving it propagates any change of its validity to the related data reps
         instance.save()
 
         return instance
 
+    # use the invalid reasons already resolved by the list serializer, if any
+    def get_invalid_reasons(self, obj):
+        invalid_reasons = self.context.get('invalid_reasons', {})
+        return invalid_reasons[obj.id] if obj.id in invalid_reasons else obj.invalid_reasons
+
     created_by = serializers.StringRelatedField()
     modified_by = serializers.StringRelatedField()
     cq_value = NullableRStrip10DecimalField()
@@ -1332,6 +1348,8 @@ class PCRReplicateSerializer(serializers.ModelSerializer):
     sample = serializers.PrimaryKeyRelatedField(source='sample_extraction.sample', read_only=True)
     peg_neg = serializers.PrimaryKeyRelatedField(source='sample_extraction.sample.peg_neg', read_only=True)
     invalid_override_string = serializers.StringRelatedField(source='invalid_override')
+    invalid_reasons = serializers.SerializerMethodField()
+    recalc_pending = serializers.BooleanField(read_only=True)
 
     class Meta:
         model = PCRReplicate
@@ -1339,7 +1357,7 @@ class PCRReplicateSerializer(serializers.ModelSerializer):
                   'pcrreplicate_batch', 'cq_value', 'gc_reaction', 'gc_reaction_sci', 'replicate_concentration',
                   'replicate_concentration_sci', 'concentration_unit', 'missing_calculation_values',
                   'calculation_values', 'invalid', 'invalid_override', 'invalid_override_string', 'invalid_reasons',
-                  'created_date', 'created_by', 'modified_date', 'modified_by',)
+                  'recalc_pending', 'created_date', 'created_by', 'modified_date', 'modified_by',)
         list_serializer_class = PCRReplicateListSerializer
         extra_kwargs = {
             'concentration_unit': {'required': False}
@@ -1471,9 +1489,11 @@ class PCRReplicateBatchSerializer(serializers.ModelSerializer):
                 response_errors.append(serializer.errors)
         if is_valid:
             # now that all items are proven valid, save and return them to the user
-            instance.save()
-            for item in valid_data:
-                item.save()
+            # (in one unit of work, so that each recalculation triggered by the saves is only run once)
+            with recalc_unit_of_work():
+                instance.save()
+                for item in valid_data:
+                    item.save()
             return instance
         else:
             raise serializers.ValidationError(jsonify_errors(response_errors))
@@ -2066,12 +2086,14 @@ class ReportFileSerializer(serializers.ModelSerializer):
     report_type_string = serializers.StringRelatedField()
     status_string = serializers.StringRelatedField()
 
-
     class Meta:
         model = ReportFile
         fields = ('id', 'name', 'file', 'report_type', 'report_type_string', 'status', 'status_string', 'fail_reason',
-                  'created_date', 'created_by', 'modified_date', 'modified_by',)
-        read_only_fields = ('name',)
+                  'content_type', 'content_encoding', 'file_size', 'requested_datetime', 'phase', 'rows_processed',
+                  'rows_total', 'started_datetime', 'elapsed_seconds', 'created_date', 'created_by', 'modified_date',
+                  'modified_by',)
+        read_only_fields = ('name', 'content_type', 'content_encoding', 'file_size', 'requested_datetime', 'phase',
+                            'rows_processed', 'rows_total', 'started_datetime', 'elapsed_seconds',)
 
 
 class ReportTypeSerializer(serializers.ModelSerializer):
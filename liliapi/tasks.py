@@ -1,105 +1,425 @@
-import json
-from time import sleep
-from datetime import datetime, timedelta
-from collections import Counter, OrderedDict
-from django.db.models import Q, Case, When, Value, Count, Sum, Min, Max, Avg, FloatField, CharField
-from django.db.models.functions import Cast
-from django.core.files.base import ContentFile
-from liliapi.aggregates import Median
+import logging
+from datetime import datetime
+from itertools import chain
+from django.db import transaction
+from django.db.models import Q, Value, Count, Min, Max, Avg, FloatField, CharField, IntegerField, DecimalField
+from django.db.models import Exists, OuterRef, Subquery
+from django.db.models.functions import Cast, Concat
+from liliapi.aggregates import Median, Percentile
+from liliapi.reports import ReportWriter, ReportProgress, iter_serialized, pivot_rows, PIVOT_SKIP
+from liliapi.reports import iter_report_parts, delete_report_parts, get_report_part_sizes
 from liliapi.serializers import *
 from liliapi.models import *
-from celery import shared_task, current_app
-from celery.result import AsyncResult
+from celery import shared_task, current_app, chord
+from celery.exceptions import Ignore
+
+
+logger = logging.getLogger(__name__)
 
 
 LIST_DELIMETER = settings.LIST_DELIMETER
 
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return json.JSONEncoder.default(self, obj)
-
-
-def purge_old_reports(report_type_id):
-    # remove all reports older than one week
-    one_week_ago = datetime.strftime(datetime.now() - timedelta(7), '%Y-%m-%d')
-    ReportFile.objects.filter(created_date__lt=one_week_ago).delete()
-
-    # remove all remaining reports of this report type except the most recent ten
-    if ReportFile.objects.filter(report_type=report_type_id).count() > 10:
-        reports_to_keep = ReportFile.objects.filter(report_type=report_type_id).order_by('-id')[:10]
-        ReportFile.objects.filter(report_type=report_type_id).exclude(pk__in=reports_to_keep).delete()
-
-
-@shared_task(name='monitor_task')
-def monitor_task(task_id, datetimestart_str, report_file_id):
-    sleep(settings.TASK_SLEEP)
-    task = AsyncResult(task_id)
-    print('monitoring task ID ' + str(task) + ' for report ID ' + str(report_file_id))
-    if task.status in ['PENDING', 'RECEIVED', 'STARTED']:
-        datetimestart = datetime.strptime(datetimestart_str, '%Y-%m-%d_%H:%M:%S')
-        datetimediff = datetime.now() - datetimestart
-        message = 'task ID ' + str(task) + ' for report ID ' + str(report_file_id) + ' has state ' + str(task.status)
-        message += ' at ' + str(datetimediff.total_seconds()) + ' seconds after it started'
-        print(message)
-        if datetimediff.total_seconds() >= settings.TASK_TIMEOUT:
-            message = 'timeout reached, terminating task ID ' + str(task) + ' for report ID ' + str(report_file_id)
-            print(message)
-            current_app.control.revoke(task_id, terminate=True)
-            report_file = ReportFile.objects.filter(id=report_file_id).first()
-            report_file.status = Status.objects.filter(id=3).first()
-            report_file.save()
-            return message
+# the results of the controls in the control results report
+CONTROL_POSITIVE = "Positive"
+CONTROL_NEGATIVE = "Negative"
+CONTROL_NO_RESULT = "No Result"
+CONTROL_NOT_ANALYZED = "Not Analyzed"
+
+
+def get_control_result(cq_value, positive=CONTROL_POSITIVE):
+    # a control with a cq_value above zero is positive, a control with a cq_value of zero is negative
+    if cq_value is not None and cq_value > Decimal('0'):
+        return positive
+    elif cq_value is not None and cq_value == Decimal('0'):
+        return CONTROL_NEGATIVE
+    return CONTROL_NO_RESULT
+
+
+def get_ext_neg_result(control):
+    # a positive RT Neg also makes the Ext Neg positive
+    if control['rt_neg_cq_value'] is not None and control['rt_neg_cq_value'] > Decimal('0'):
+        return CONTROL_POSITIVE
+    return get_control_result(control['ext_neg_cq_value'])
+
+
+def get_pcr_neg_result(control):
+    return get_control_result(control['pcr_neg_cq_value'])
+
+
+def get_pcr_pos_result(control):
+    # a positive PCR Pos is reported as its cq_value
+    return get_control_result(control['pcr_pos_cq_value'], positive=control['pcr_pos_cq_value'])
+
+
+def get_ext_pos_result(control):
+    # the Ext Pos is only reported for extraction batches that have an active RT (or no RT at all)
+    if control['has_rt'] and not control['has_active_rt']:
+        return PIVOT_SKIP
+    # a positive Ext Pos is reported as the cq_value of the nucleic acid type of the target
+    rna_cq_value = control['ext_pos_rna_rt_cq_value']
+    dna_cq_value = control['extraction_batch__ext_pos_dna_cq_value']
+    nucleic_acid_type_name = control['target__nucleic_acid_type__name']
+    if rna_cq_value is not None and rna_cq_value > Decimal('0') and nucleic_acid_type_name == 'RNA':
+        return rna_cq_value
+    elif dna_cq_value is not None and dna_cq_value > Decimal('0') and nucleic_acid_type_name == 'DNA':
+        return dna_cq_value
+    elif dna_cq_value is not None and dna_cq_value == Decimal('0'):
+        return CONTROL_NEGATIVE
+    return CONTROL_NO_RESULT
+
+
+# the leading columns of each row (extraction batch) of the control results tables
+CONTROL_RESULTS_ROW_FIELDS = [
+    ("analysis_batch", 'extraction_batch__analysis_batch'),
+    ("analysis_batch_string", 'extraction_batch__analysis_batch__name'),
+    ("extraction_number", 'extraction_batch__extraction_number'),
+    ("pcrreplicate_batch", 'id')
+]
+
+# the control results tables, and the function returning the result of a PCR replicate batch for each table
+# (a new control type only needs its values added to the control results query and its function added here)
+CONTROL_RESULTS = [
+    ("ext_neg", get_ext_neg_result),
+    ("pcr_neg", get_pcr_neg_result),
+    ("pcr_pos", get_pcr_pos_result),
+    ("ext_pos", get_ext_pos_result)
+]
+
+
+# the concentration statistics of the results summary report, and the aggregate of each
+RESULTS_SUMMARY_CONCENTRATION_STATISTICS = [
+    ('max_concentration', Max('final_sample_mean_concentration')),
+    ('min_concentration', Min('final_sample_mean_concentration')),
+    ('median_concentration', Median('final_sample_mean_concentration')),
+    ('average_concentration', Avg('final_sample_mean_concentration')),
+    ('min_concentration_positive', Min('final_sample_mean_concentration',
+                                       filter=Q(final_sample_mean_concentration__gt=0))),
+    ('median_concentration_positive', Median('final_sample_mean_concentration',
+                                             filter=Q(final_sample_mean_concentration__gt=0))),
+    ('average_concentration_positive', Avg('final_sample_mean_concentration',
+                                           filter=Q(final_sample_mean_concentration__gt=0))),
+    ('p10_concentration', Percentile('final_sample_mean_concentration', 0.1)),
+    ('p25_concentration', Percentile('final_sample_mean_concentration', 0.25)),
+    ('p75_concentration', Percentile('final_sample_mean_concentration', 0.75)),
+    ('p90_concentration', Percentile('final_sample_mean_concentration', 0.9))
+]
+
+
+def get_results_summary_rows(rows):
+    # drop the field sorting the totals row last, and set the percent_positive of the totals row
+    for row in rows:
+        all_targets = row.pop('all_targets')
+        if all_targets and 'percent_positive' in row:
+            row['percent_positive'] = (
+                (row['positive_count'] / row['sample_count']) * 100 if row['positive_count'] else 0)
+        yield row
+
+
+# the metrics of the quality control report, and the field each is computed from
+QC_SAMPLE_COUNT_METRICS = [
+    ("Sample Matrix", 'matrix'),
+    ("Sample Type", 'sample_type'),
+    ("Meter Reading Unit", 'meter_reading_unit'),
+    ("Total Volume Sampled Unit Initial", 'total_volume_sampled_unit_initial')
+]
+QC_SAMPLE_MIN_MAX_METRICS = [
+    ("Post Dilution Volume", 'post_dilution_volume'),
+    ("Total Volume or Mass Sampled", 'total_volume_or_mass_sampled'),
+    ("Final Concentrated Sample Volume", 'finalconcentratedsamplevolume__final_concentrated_sample_volume')
+]
+QC_EXTRACTION_COUNT_METRICS = [
+    ("Extraction Volume", 'extraction_volume'),
+    ("Elution Volume", 'elution_volume'),
+    ("RT Template Volume", 'rt_template_volume'),
+    ("RT Reaction Volume", 'rt_reaction_volume'),
+    ("qPCR Template Volume", 'qpcr_template_volume'),
+    ("qPCR Reaction Volume", 'qpcr_reaction_volume')
+]
+
+
+def get_qc_sample_stats(queryset):
+    """
+    returns the sample-level QC summary stats of the samples of a queryset: the counts of each categorical field
+    and the min and max of each numeric field, all computed in one query, a union of one aggregate per metric,
+    each giving rows of (sort, metric, value, count, min, max)
+    (the min and max queries come first, since the types of the union columns are those of its first query;
+    their null counts are typed, since PostgreSQL would otherwise resolve the count column of the first two as text,
+    and aggregated, since a cast alone would be grouped by, and so give no rows without any samples)
+    :param queryset: the queryset of the samples
+    :return: a list of dicts of the metric, value, count, min, and max of each row
+    """
+    sample_stats_queries = []
+    for sort, (metric, field) in enumerate(QC_SAMPLE_MIN_MAX_METRICS, len(QC_SAMPLE_COUNT_METRICS)):
+        # without any grouped field, each of these gives exactly one row (even without any samples)
+        sample_stats_queries.append(queryset.annotate(
+            sort=Value(sort, IntegerField()), metric=Value(metric, CharField()), value=Value(None, CharField())
+        ).values('sort', 'metric', 'value').annotate(
+            count=Max(Cast(Value(None), IntegerField())), min=Min(field), max=Max(field)).order_by())
+    for sort, (metric, field) in enumerate(QC_SAMPLE_COUNT_METRICS):
+        sample_stats_queries.append(queryset.annotate(
+            sort=Value(sort, IntegerField()), metric=Value(metric, CharField()), value=F(field + '__name')
+        ).values('sort', 'metric', 'value').annotate(
+            count=Count(field), min=Value(None, DecimalField()), max=Value(None, DecimalField())).order_by())
+    return [{
+        "metric": stat['metric'],
+        "value": stat['value'],
+        "count": stat['count'],
+        "min": stat['min'],
+        "max": stat['max']
+    } for stat in sample_stats_queries[0].union(*sample_stats_queries[1:], all=True).order_by('sort', 'value')]
+
+
+@shared_task(name='recalc_pending_task')
+def recalc_pending():
+    # claim all the pending recalculations at once, so that a concurrent worker cannot run the same ones,
+    # and only delete them along with their recalculation, so that they stay pending if it fails
+    pendings = []
+    changed_count = 0
+    try:
+        with transaction.atomic():
+            pendings = list(PendingRecalc.objects.select_for_update(skip_locked=True))
+            if pendings:
+                # merge the claimed recalculations into a single set of reps, so each rep is recalculated only once
+                level_ids = {}
+                for pending in pendings:
+                    level_ids.setdefault((pending.level, pending.target), []).append(pending.level_id)
+                reps_filter = Q()
+                for (level, target), ids in level_ids.items():
+                    reps_filter |= get_recalc_reps_filter(level, ids, target)
+                recalc_rep_conc = any(pending.recalc_rep_conc for pending in pendings)
+                recalc_invalid = any(pending.recalc_invalid for pending in pendings)
+
+                changed_count = PCRReplicate.objects.recalc(
+                    PCRReplicate.objects.filter(reps_filter), recalc_rep_conc, recalc_invalid)
+                PendingRecalc.objects.filter(id__in=[pending.id for pending in pendings]).delete()
+    finally:
+        # recalculations queued while this one was running did not start a worker of their own,
+        # and if this one failed, its recalculations are still pending and are retried by the next worker
+        # (the ones claimed by a concurrent worker are left to it)
+        with transaction.atomic():
+            next_pending = PendingRecalc.objects.select_for_update(skip_locked=True).first()
+        if next_pending:
+            PendingRecalc.objects.start_worker(next_pending.id)
+
+    if not pendings:
+        return "recalc_pending_task found no pending recalculations"
+    message = "recalc_pending_task ran {0} pending recalculations and changed {1} replicates".format(
+        len(pendings), changed_count)
+    return message
+
+
+def get_inhibition_report_queryset(sample):
+    queryset = SampleExtraction.objects.all()
+    if sample is not None:
+        if LIST_DELIMETER in sample:
+            sample_list = sample.split(',')
+            queryset = queryset.filter(sample__in=sample_list)
         else:
-            message = 'task ID ' + str(task) + ' for report ID ' + str(report_file_id) + ' is still running'
-            print(message)
-            try:
-                return message
-            finally:
-                monitor_task(task.id, datetimestart_str, report_file_id)
-    else:
-        message = 'monitoring task ID ' + str(task) + ' for report ID ' + str(report_file_id)
-        message += ' completed with status ' + str(task.status)
-        print(message)
-        return message
+            queryset = queryset.filter(sample__exact=sample)
+    return queryset
+
+
+def get_inhibition_report_rows(queryset):
+    queryset = queryset.select_related(
+        'sample__study', 'extraction_batch__analysis_batch', 'extraction_batch__inh_pos_nucleic_acid_type',
+        'inhibition_dna', 'inhibition_rna')
+    return iter_serialized(queryset, SampleExtractionReportSerializer)
+
+
+def get_individual_sample_report_queryset(sample, target):
+    queryset = FinalSampleMeanConcentration.objects.all()
+    # filter by sample IDs, exact list
+    if sample is not None:
+        sample_list = sample.split(',')
+        queryset = queryset.filter(sample__in=sample_list)
+    # filter by target IDs, exact list
+    if target is not None:
+        target_list = target.split(',')
+        queryset = queryset.filter(target__in=target_list)
+    return queryset
+
+
+def get_individual_sample_report_rows(queryset):
+    # recalc reps validity, of all the FSMCs at once
+    PCRReplicate.objects.recalc(PCRReplicate.objects.filter(
+        sample_extraction__sample__in=queryset.values('sample'),
+        pcrreplicate_batch__target__in=queryset.values('target')), recalc_rep_conc=False)
+    return iter_serialized(queryset.select_related('sample', 'target', 'created_by', 'modified_by'),
+                           FinalSampleMeanConcentrationResultsSerializer)
+
+
+# the reports that can be generated in chunks of samples (each a queryset with a sample field, ordered by sample),
+# by the name of their task, and the functions returning the queryset of a report and the rows of a queryset
+CHUNKED_REPORTS = {
+    "generate_inhibition_report_task": (get_inhibition_report_queryset, get_inhibition_report_rows),
+    "individual_sample_report_task": (get_individual_sample_report_queryset, get_individual_sample_report_rows)
+}
+
+
+def get_report_sample_ranges(queryset):
+    """
+    splits the samples of a report into the chunks to be generated in parallel, if there are enough samples
+    (REPORT_TASK_CHUNK_SIZE per chunk, but no more than REPORT_TASK_MAX_CHUNKS chunks)
+    :param queryset: the queryset of the report
+    :return: a list of (first sample ID, last sample ID) tuples, or an empty list if the report is a single chunk
+    """
+    sample_ids = list(queryset.order_by('sample_id').values_list('sample_id', flat=True).distinct())
+    chunk_count = min(-(-len(sample_ids) // settings.REPORT_TASK_CHUNK_SIZE), settings.REPORT_TASK_MAX_CHUNKS)
+    if chunk_count < 2:
+        return []
+    chunk_size = -(-len(sample_ids) // chunk_count)
+    return [(sample_ids[index], sample_ids[min(index + chunk_size, len(sample_ids)) - 1])
+            for index in range(0, len(sample_ids), chunk_size)]
+
+
+def get_chunked_report(report_name, report_args, sample_ranges, report_file_id, file_name, report_format):
+    # a chord of one task per chunk, and a final task merging their parts into the report file
+    return chord(
+        [generate_report_chunk.s(report_name, report_args, sample_range, report_file_id, index)
+         for index, sample_range in enumerate(sample_ranges)],
+        merge_report_chunks.s(report_name, report_file_id, file_name, report_format))
+
+
+@shared_task(name="report_chunk_task")
+def generate_report_chunk(report_name, report_args, sample_range, report_file_id, index):
+    # the parts are always NDJSON, so that the merge can write the rows of the parts in any format
+    try:
+        # the watchdog only revokes the merge task (which took over the ID of the report task), so a chunk of a report
+        # that is no longer in progress stops here
+        report_file = ReportFile.objects.filter(id=report_file_id).first()
+        if report_file is None or report_file.status_id != 1:
+            return {"error": "the report is no longer in progress"}
+        get_queryset, get_rows = CHUNKED_REPORTS[report_name]
+        queryset = get_queryset(*report_args).filter(sample__gte=sample_range[0], sample__lte=sample_range[1])
+        # the rows of every chunk are added to the rows processed of the report file
+        writer = ReportWriter('ndjson', progress=ReportProgress(report_file))
+        writer.write_rows(get_rows(queryset))
+        return {"part": writer.save_part("{0}_{1}".format(report_file_id, index))}
+    except Exception as exc:
+        return {"error": str(exc)}
 
 
-@shared_task(name="generate_inhibition_report_task")
-def generate_inhibition_report(sample, report_file_id, username):
+@shared_task(name="merge_report_chunks_task")
+def merge_report_chunks(chunk_results, report_name, report_file_id, file_name, report_format='json'):
     report_file = ReportFile.objects.filter(id=report_file_id).first()
+    progress = ReportProgress(report_file)
+    part_names = [chunk_result['part'] for chunk_result in chunk_results if 'part' in chunk_result]
 
     try:
-        purge_old_reports(report_file.report_type.id)
+        # a report failed by the watchdog keeps its own fail reason
+        if report_file is None or report_file.status_id != 1:
+            return "{0} was no longer in progress and no file was created".format(report_name)
+        errors = [chunk_result['error'] for chunk_result in chunk_results if 'error' in chunk_result]
+        if errors:
+            raise Exception(errors[0])
+
+        # the rows were already counted by the chunks, so the merged rows are not counted again
+        progress.resume('merging')
+        writer = ReportWriter(report_format)
+        writer.write_rows(iter_report_parts(part_names))
+        datetimenow = datetime.today().strftime('%Y-%m-%d_%H:%M:%S')
+        new_file_name = writer.save(report_file, file_name + "_" + datetimenow)
+
+        progress.set_phase('complete')
+        report_file.status = Status.objects.filter(id=2).first()
+        report_file.save()
+        return "{0} completed and created file {1}".format(report_name, new_file_name)
+
     except Exception as exc:
-        message = "generate_inhibition_report_task failed and no file was created, error message: {0}".format(exc)
+        message = "{0} failed and no file was created, error message: {1}".format(report_name, exc)
+        progress.set_phase('failed')
         report_file.status = Status.objects.filter(id=3).first()
         report_file.fail_reason = message
         report_file.save()
         return message
 
-    try:
-        queryset = SampleExtraction.objects.all()
-        if sample is not None:
-            if LIST_DELIMETER in sample:
-                sample_list = sample.split(',')
-                queryset = queryset.filter(sample__in=sample_list)
-            else:
-                queryset = queryset.filter(sample__exact=sample)
+    finally:
+        delete_report_parts(part_names)
+
+
+@shared_task(name='report_retention_task')
+def report_retention():
+    # run periodically by celery beat (see CELERY_BEAT_SCHEDULE), rather than at the start of every report task,
+    # this deletes the report files expired by the retention policies in batches, with one query per batch
+    # (their files are removed by the post_delete signal of each report file)
+    # the parts left behind by chunked report tasks that failed or were terminated are deleted first,
+    # and the parts of the reports still in progress count towards the bytes quota
+    part_sizes = get_report_part_sizes()
+    in_progress_ids = set(ReportFile.objects.filter(
+        id__in={report_file_id for report_file_id, size in part_sizes.values()}, status=1).values_list('id', flat=True))
+    delete_report_parts([part_name for part_name, (report_file_id, size) in part_sizes.items()
+                         if report_file_id not in in_progress_ids])
+    expired_ids = ReportFile.objects.get_expired_ids(
+        sum(size for report_file_id, size in part_sizes.values() if report_file_id in in_progress_ids))
+    batch_size = settings.REPORT_RETENTION_BATCH_SIZE
+    deleted_count = 0
+    for index in range(0, len(expired_ids), batch_size):
+        # reports that started again since their IDs were read are skipped, so count only the ones deleted
+        deleted, deleted_counts = ReportFile.objects.filter(
+            id__in=expired_ids[index:index + batch_size]).exclude(status=1).delete()
+        deleted_count += deleted_counts.get(ReportFile._meta.label, 0)
+    message = 'deleted {0} expired report files'.format(deleted_count)
+    logger.info(message)
+    return message
+
+
+@shared_task(name='report_watchdog_task')
+def report_watchdog():
+    # run periodically by celery beat (see CELERY_BEAT_SCHEDULE), so that no worker is taken up between the scans,
+    # this revokes the tasks of all the timed out reports at once, and marks those reports failed in a single update
+    timed_out = list(ReportFile.objects.get_timed_out().values_list('id', 'task_id'))
+    if not timed_out:
+        return 'no report tasks timed out'
+
+    report_file_ids = [report_file_id for report_file_id, task_id in timed_out]
+    task_ids = [task_id for report_file_id, task_id in timed_out if task_id]
+    if task_ids:
+        current_app.control.revoke(task_ids, terminate=True)
+    ReportFile.objects.filter(id__in=report_file_ids, status=1).update(
+        status=Status.objects.filter(id=3).first(), phase='failed',
+        fail_reason='timeout reached, the task generating the report was terminated')
+    message = 'timeout reached, terminated the tasks of report IDs ' + ', '.join(map(str, report_file_ids))
+    logger.warning(message)
+    return message
+
+
+@shared_task(bind=True, name="generate_inhibition_report_task")
+def generate_inhibition_report(self, sample, report_file_id, username, report_format='json'):
+    report_file = ReportFile.objects.filter(id=report_file_id).first()
 
-        data = SampleExtractionReportSerializer(queryset, many=True).data
+    progress = ReportProgress(report_file)
+    try:
+        progress.start('querying')
+        queryset = get_inhibition_report_queryset(sample)
+
+        # split a large report into chunks of samples generated in parallel (this task is replaced by them)
+        sample_ranges = get_report_sample_ranges(queryset)
+        if sample_ranges:
+            progress.set_phase('writing', rows_total=queryset.count())
+            progress.stop()
+            return self.replace(get_chunked_report(
+                "generate_inhibition_report_task", [sample], sample_ranges, report_file_id,
+                "InhibitionReport_" + username, report_format))
+
+        # write the rows as they are serialized, one chunk at a time
+        progress.set_phase('writing', rows_total=queryset.count())
+        writer = ReportWriter(report_format, progress=progress)
+        writer.write_rows(get_inhibition_report_rows(queryset))
         datetimenow = datetime.today().strftime('%Y-%m-%d_%H:%M:%S')
-        new_file_name = "InhibitionReport_" + username + "_" + datetimenow + ".json"
-        new_file_content = ContentFile(json.dumps(data, cls=DecimalEncoder))
+        new_file_name = writer.save(report_file, "InhibitionReport_" + username + "_" + datetimenow)
 
-        report_file.file.save(new_file_name, new_file_content)
+        progress.set_phase('complete')
         report_file.status = Status.objects.filter(id=2).first()
         report_file.save()
         return "generate_inhibition_report_task completed and created file {0}".format(new_file_name)
 
+    except Ignore:
+        # the task was replaced by the chunks of the report
+        raise
     except Exception as exc:
         message = "generate_inhibition_report_task failed and no file was created, error message: {0}".format(exc)
+        progress.set_phase('failed')
         report_file.status = Status.objects.filter(id=3).first()
         report_file.fail_reason = message
         report_file.save()
@@ -107,22 +427,16 @@ def generate_inhibition_report(sample, report_file_id, username):
 
 
 @shared_task(name="results_summary_report_task")
-def generate_results_summary_report(sample, target, statistic, report_file_id, username):
+def generate_results_summary_report(sample, target, statistic, report_file_id, username, report_format='json'):
     report_file = ReportFile.objects.filter(id=report_file_id).first()
 
+    progress = ReportProgress(report_file)
     try:
-        purge_old_reports(report_file.report_type.id)
-    except Exception as exc:
-        message = "results_summary_report_task failed and no file was created, error message: {0}".format(exc)
-        report_file.status = Status.objects.filter(id=3).first()
-        report_file.fail_reason = message
-        report_file.save()
-        return message
-
-    try:
+        progress.start('querying')
         STATISTICS = ['sample_count', 'positive_count', 'percent_positive', 'max_concentration', 'min_concentration',
                       'median_concentration', 'average_concentration', 'min_concentration_positive',
-                      'median_concentration_positive', 'average_concentration_positive']
+                      'median_concentration_positive', 'average_concentration_positive', 'p10_concentration',
+                      'p25_concentration', 'p75_concentration', 'p90_concentration']
 
         queryset = FinalSampleMeanConcentration.objects.all()
         # filter by sample IDs, exact list
@@ -142,29 +456,20 @@ def generate_results_summary_report(sample, target, statistic, report_file_id, u
         # get the requested statistics, exact list
         statistic_list = statistic.split(LIST_DELIMETER) if statistic is not None else STATISTICS
 
-        # set aside a parallel query for totals
-        totals_queryset = queryset
-        total_sample_count = totals_queryset.aggregate(Count('sample_id', distinct=True))['sample_id__count']
+        # bring the FSMCs up to date (along with the validity of their reps), only if any of them are stale
+        FinalSampleMeanConcentration.objects.recalc_stale(queryset)
 
-        # recalc reps validity
-        for fsmc in queryset:
-            recalc_reps('FinalSampleMeanConcentration', fsmc.sample.id, target=fsmc.target.id, recalc_rep_conc=False)
-
-        # get binary count of all positive samples if necessary
-        total_pos_count = None
-        if ('positive_count' in statistic_list
-                or ('percent_positive' in statistic_list and 'positive_count' not in statistic_list)):
-            total_pos_count = queryset.values(
-                'sample').annotate(conc=Sum('final_sample_mean_concentration')).filter(conc__gt=0).count()
+        # the rows by target and the totals row for all targets are computed together in one query,
+        # as the union of the query grouped by target and the query of the totals
+        # (the totals row is sorted last, and the sorting field is left out of the report)
+        totals_queryset = queryset.values(target_name=Value('All targets', CharField())).annotate(
+            target_id=Value(None, IntegerField()), all_targets=Value(1, IntegerField()))
 
         # group by target name
         queryset = queryset.values(target_name=F('target__name')).order_by('target_name')
 
         # include the target id
-        queryset = queryset.annotate(target_id=F('target__id'))
-
-        # initialize the totals row and include the totals target id field to match the main queryset for later merging
-        totals = {'target_name': 'All targets', 'target_id': None}
+        queryset = queryset.annotate(target_id=F('target__id'), all_targets=Value(0, IntegerField()))
 
         # calculate the requested statistics per object
         if ('sample_count' in statistic_list
@@ -172,130 +477,87 @@ def generate_results_summary_report(sample, target, statistic, report_file_id, u
             # include the sample_count by target
             queryset = queryset.annotate(sample_count=Count('id'))
             # include the sample_count for all targets
-            totals['sample_count'] = total_sample_count
+            totals_queryset = totals_queryset.annotate(sample_count=Count('sample', distinct=True))
         if ('positive_count' in statistic_list
                 or ('percent_positive' in statistic_list and 'positive_count' not in statistic_list)):
             # include the positive_count by target
             queryset = queryset.annotate(positive_count=Count('id', filter=Q(final_sample_mean_concentration__gt=0)))
-            # include the positive_count for all targets
-            totals['positive_count'] = total_pos_count
+            # include the positive_count for all targets, meaning the samples positive for any target
+            # (concentrations are never negative, so these are the samples with a positive sum of concentrations)
+            totals_queryset = totals_queryset.annotate(
+                positive_count=Count('sample', distinct=True, filter=Q(final_sample_mean_concentration__gt=0)))
         if 'percent_positive' in statistic_list:
             # include the percent_positive by target
             queryset = queryset.annotate(
                 percent_positive=(Cast('positive_count', FloatField()) / Cast('sample_count', FloatField()) * 100))
-            # include the percent_positive for all targets
-            totals['percent_positive'] = (total_pos_count / total_sample_count) * 100 if total_pos_count else 0
-        if 'max_concentration' in statistic_list:
-            # include the max_concentration by target
-            queryset = queryset.annotate(max_concentration=Max('final_sample_mean_concentration'))
-            # include the max_concentration for all targets
-            totals['max_concentration'] = totals_queryset.aggregate(
-                Max('final_sample_mean_concentration'))['final_sample_mean_concentration__max']
-        if 'min_concentration' in statistic_list:
-            # include the min_concentration by target
-            queryset = queryset.annotate(min_concentration=Min('final_sample_mean_concentration'))
-            # include the min_concentration for all targets
-            totals['min_concentration'] = totals_queryset.aggregate(
-                Min('final_sample_mean_concentration'))['final_sample_mean_concentration__min']
-        if 'median_concentration' in statistic_list:
-            # include the median_concentration by target
-            queryset = queryset.annotate(median_concentration=Median('final_sample_mean_concentration'))
-            # include the median_concentration for all targets
-            totals['median_concentration'] = totals_queryset.aggregate(
-                Median('final_sample_mean_concentration'))['final_sample_mean_concentration__median']
-        if 'average_concentration' in statistic_list:
-            # include the average_concentration by target
-            queryset = queryset.annotate(average_concentration=Avg('final_sample_mean_concentration'))
-            # include the average_concentration for all targets
-            totals['average_concentration'] = totals_queryset.aggregate(
-                Avg('final_sample_mean_concentration'))['final_sample_mean_concentration__avg']
-        if 'min_concentration_positive' in statistic_list:
-            # include the min_concentration_positive by target
-            queryset = queryset.annotate(
-                min_concentration_positive=Min('final_sample_mean_concentration',
-                                               filter=Q(final_sample_mean_concentration__gt=0)))
-            # include the min_concentration_positive for all targets
-            totals['min_concentration_positive'] = totals_queryset.aggregate(
-                final_sample_mean_concentration__min=Min('final_sample_mean_concentration', filter=Q(
-                    final_sample_mean_concentration__gt=0)))['final_sample_mean_concentration__min']
-        if 'median_concentration_positive' in statistic_list:
-            # include the median_concentration_positive by target
-            queryset = queryset.annotate(median_concentration_positive=Median(
-                'final_sample_mean_concentration', filter=Q(final_sample_mean_concentration__gt=0)))
-            # include the median_concentration_positive for all targets
-            totals['median_concentration_positive'] = totals_queryset.aggregate(
-                final_sample_mean_concentration__median=Median('final_sample_mean_concentration', filter=Q(
-                    final_sample_mean_concentration__gt=0)))['final_sample_mean_concentration__median']
-        if 'average_concentration_positive' in statistic_list:
-            # include the average_concentration_positive by target
-            queryset = queryset.annotate(
-                average_concentration_positive=Avg('final_sample_mean_concentration',
-                                                   filter=Q(final_sample_mean_concentration__gt=0)))
-            # include the average_concentration_positive for all targets
-            totals['average_concentration_positive'] = totals_queryset.aggregate(
-                final_sample_mean_concentration__avg=Avg('final_sample_mean_concentration', filter=Q(
-                    final_sample_mean_concentration__gt=0)))['final_sample_mean_concentration__avg']
-
-        data = list(queryset)
-        data.append(totals)
-
+            # include the percent_positive for all targets (set from its counts below)
+            totals_queryset = totals_queryset.annotate(percent_positive=Value(None, FloatField()))
+        # the concentration statistics for all targets are the same aggregates as by target, just not grouped
+        for statistic_name, aggregate in RESULTS_SUMMARY_CONCENTRATION_STATISTICS:
+            if statistic_name in statistic_list:
+                queryset = queryset.annotate(**{statistic_name: aggregate})
+                totals_queryset = totals_queryset.annotate(**{statistic_name: aggregate})
+
+        queryset = queryset.order_by().union(totals_queryset.order_by(), all=True).order_by(
+            'all_targets', 'target_name')
+
+        # the number of rows is not known until the query has been run
+        progress.set_phase('writing')
+        writer = ReportWriter(report_format, progress=progress)
+        writer.write_rows(get_results_summary_rows(queryset.iterator()))
         datetimenow = datetime.today().strftime('%Y-%m-%d_%H:%M:%S')
-        new_file_name = "ResultsSummaryReport_" + username + "_" + datetimenow + ".json"
-        new_file_content = ContentFile(json.dumps(data, cls=DecimalEncoder))
+        new_file_name = writer.save(report_file, "ResultsSummaryReport_" + username + "_" + datetimenow)
 
-        report_file.file.save(new_file_name, new_file_content)
+        progress.set_phase('complete')
         report_file.status = Status.objects.filter(id=2).first()
         report_file.save()
         return "results_summary_report_task completed and created file {0}".format(new_file_name)
 
     except Exception as exc:
         message = "results_summary_report_task failed and no file was created, error message: {0}".format(exc)
+        progress.set_phase('failed')
         report_file.status = Status.objects.filter(id=3).first()
         report_file.fail_reason = message
         report_file.save()
         return message
 
 
-@shared_task(name="individual_sample_report_task")
-def generate_individual_sample_report(sample, target, report_file_id, username):
+@shared_task(bind=True, name="individual_sample_report_task")
+def generate_individual_sample_report(self, sample, target, report_file_id, username, report_format='json'):
     report_file = ReportFile.objects.filter(id=report_file_id).first()
 
+    progress = ReportProgress(report_file)
     try:
-        purge_old_reports(report_file.report_type.id)
-    except Exception as exc:
-        message = "individual_sample_report_task failed and no file was created, error message: {0}".format(exc)
-        report_file.status = Status.objects.filter(id=3).first()
-        report_file.fail_reason = message
-        report_file.save()
-        return message
-
-    try:
-        queryset = FinalSampleMeanConcentration.objects.all()
-        # filter by sample IDs, exact list
-        if sample is not None:
-            sample_list = sample.split(',')
-            queryset = queryset.filter(sample__in=sample_list)
-        # filter by target IDs, exact list
-        if target is not None:
-            target_list = target.split(',')
-            queryset = queryset.filter(target__in=target_list)
-        # recalc reps validity
-        for fsmc in queryset:
-            recalc_reps('FinalSampleMeanConcentration', fsmc.sample.id, target=fsmc.target.id,
-                        recalc_rep_conc=False)
-
-        data = FinalSampleMeanConcentrationResultsSerializer(queryset, many=True).data
+        progress.start('querying')
+        queryset = get_individual_sample_report_queryset(sample, target)
+
+        # split a large report into chunks of samples generated in parallel (this task is replaced by them)
+        sample_ranges = get_report_sample_ranges(queryset)
+        if sample_ranges:
+            progress.set_phase('writing', rows_total=queryset.count())
+            progress.stop()
+            return self.replace(get_chunked_report(
+                "individual_sample_report_task", [sample, target], sample_ranges, report_file_id,
+                "IndividualSampleReport_" + username, report_format))
+
+        # write the rows as they are serialized, one chunk at a time
+        progress.set_phase('writing', rows_total=queryset.count())
+        writer = ReportWriter(report_format, progress=progress)
+        writer.write_rows(get_individual_sample_report_rows(queryset))
         datetimenow = datetime.today().strftime('%Y-%m-%d_%H:%M:%S')
-        new_file_name = "IndividualSampleReport_" + username + "_" + datetimenow + ".json"
-        new_file_content = ContentFile(json.dumps(data, cls=DecimalEncoder))
+        new_file_name = writer.save(report_file, "IndividualSampleReport_" + username + "_" + datetimenow)
 
-        report_file.file.save(new_file_name, new_file_content)
+        progress.set_phase('complete')
         report_file.status = Status.objects.filter(id=2).first()
         report_file.save()
         return "individual_sample_report_task completed and created file {0}".format(new_file_name)
 
+    except Ignore:
+        # the task was replaced by the chunks of the report
+        raise
     except Exception as exc:
         message = "individual_sample_report_task failed and no file was created, error message: {0}".format(exc)
+        progress.set_phase('failed')
         report_file.status = Status.objects.filter(id=3).first()
         report_file.fail_reason = message
         report_file.save()
@@ -303,182 +565,78 @@ def generate_individual_sample_report(sample, target, report_file_id, username):
 
 
 @shared_task(name="quality_control_report_task")
-def generate_quality_control_report(samples, report_file_id, username):
+def generate_quality_control_report(samples, report_file_id, username, report_format='json'):
     report_file = ReportFile.objects.filter(id=report_file_id).first()
 
+    progress = ReportProgress(report_file)
     try:
-        purge_old_reports(report_file.report_type.id)
-    except Exception as exc:
-        message = "quality_control_report_task failed and no file was created, error message: {0}".format(exc)
-        report_file.status = Status.objects.filter(id=3).first()
-        report_file.fail_reason = message
-        report_file.save()
-        return message
-
-    try:
-        data = {}
-
+        progress.start('recalculating')
         queryset = Sample.objects.all()
         if samples is not None:
             queryset = queryset.filter(id__in=samples)
 
-        # recalc reps validity
-        for sample in queryset:
-            recalc_reps('Sample', sample.id, recalc_rep_conc=False)
-
-        matrix_counts = queryset.values('matrix__name').order_by().annotate(count=Count('matrix'))
-        sample_type_counts = queryset.values('sample_type__name').order_by().annotate(count=Count('sample_type'))
-        meter_reading_unit_counts = queryset.values(
-            'meter_reading_unit__name').order_by().annotate(
-            count=Count('meter_reading_unit'))
-        total_volume_sampled_unit_initial_counts = queryset.values(
-            'total_volume_sampled_unit_initial__name').order_by().annotate(
-            count=Count('total_volume_sampled_unit_initial'))
-        post_dilution_volume_min = queryset.aggregate(min=Min('post_dilution_volume'))
-        post_dilution_volume_max = queryset.aggregate(max=Max('post_dilution_volume'))
-        total_volume_or_mass_sampled_min = queryset.aggregate(min=Min('total_volume_or_mass_sampled'))
-        total_volume_or_mass_sampled_max = queryset.aggregate(max=Max('total_volume_or_mass_sampled'))
-        final_concentrated_sample_volume_min = queryset.aggregate(
-            min=Min('finalconcentratedsamplevolume__final_concentrated_sample_volume'))
-        final_concentrated_sample_volume_max = queryset.aggregate(
-            max=Max('finalconcentratedsamplevolume__final_concentrated_sample_volume'))
-
-        # Sample-level QC summary stats
-        sample_stats = []
-        for matrix in matrix_counts:
-            sample_stats.append({
-                "metric": "Sample Matrix",
-                "value": matrix['matrix__name'],
-                "count": matrix['count'],
-                "min": None,
-                "max": None
-            })
-        for sample_type in sample_type_counts:
-            sample_stats.append({
-                "metric": "Sample Type",
-                "value": sample_type['sample_type__name'],
-                "count": sample_type['count'],
-                "min": None,
-                "max": None
-            })
-        for unit in meter_reading_unit_counts:
-            sample_stats.append({
-                "metric": "Meter Reading Unit",
-                "value": unit['meter_reading_unit__name'],
-                "count": unit['count'],
-                "min": None,
-                "max": None
-            })
-        for unit in total_volume_sampled_unit_initial_counts:
-            sample_stats.append({
-                "metric": "Total Volume Sampled Unit Initial",
-                "value": unit['total_volume_sampled_unit_initial__name'],
-                "count": unit['count'],
-                "min": None,
-                "max": None
-            })
-        sample_stats.append({
-            "metric": "Post Dilution Volume",
-            "value": None,
-            "count": None,
-            "min": post_dilution_volume_min['min'],
-            "max": post_dilution_volume_max['max']
-        })
-        sample_stats.append({
-            "metric": "Total Volume or Mass Sampled",
-            "value": None,
-            "count": None,
-            "min": total_volume_or_mass_sampled_min['min'],
-            "max": total_volume_or_mass_sampled_max['max']
-        })
-        sample_stats.append({
-            "metric": "Final Concentrated Sample Volume",
-            "value": None,
-            "count": None,
-            "min": final_concentrated_sample_volume_min['min'],
-            "max": final_concentrated_sample_volume_max['max']
-        })
-        data['sample_quality_control'] = sample_stats
-
         # ExtractionBatch-level raw values
         if samples is not None:
             eb_raw_data = ExtractionBatch.objects.filter(analysis_batch__samples__in=samples)
         else:
             eb_raw_data = ExtractionBatch.objects.all()
 
-        # recalc reps validity
-        for eb in eb_raw_data:
-            recalc_reps('ExtractionBatch', eb.id, recalc_rep_conc=False)
+        # recalc reps validity of the samples and of the extraction batches, all at once
+        PCRReplicate.objects.recalc(PCRReplicate.objects.filter(
+            get_recalc_reps_filter('Sample', queryset.values('id'))
+            | get_recalc_reps_filter('ExtractionBatch', eb_raw_data.values('id'))), recalc_rep_conc=False)
+
+        progress.set_phase('aggregating')
+        # Sample-level QC summary stats
+        sample_stats = get_qc_sample_stats(queryset)
 
         eb_raw_data = eb_raw_data.filter(reversetranscriptions__re_rt__isnull=True).annotate(
             rt_template_volume=F('reversetranscriptions__template_volume'))
         eb_raw_data = eb_raw_data.filter(reversetranscriptions__re_rt__isnull=True).annotate(
             rt_reaction_volume=F('reversetranscriptions__reaction_volume'))
 
-        eb_raw_data = eb_raw_data.values('analysis_batch', 'extraction_number', 'extraction_volume', 'elution_volume',
-                                         'rt_template_volume', 'rt_reaction_volume', 'qpcr_template_volume',
-                                         'qpcr_reaction_volume'
-                                         ).order_by('analysis_batch', 'extraction_number').distinct()
-        data['extraction_raw_data'] = list(eb_raw_data)
+        eb_raw_fields = ('analysis_batch', 'extraction_number', 'extraction_volume', 'elution_volume',
+                         'rt_template_volume', 'rt_reaction_volume', 'qpcr_template_volume', 'qpcr_reaction_volume')
 
         # ExtractionBatch-level QC summary stats
-        extraction_volumes = Counter(list(eb_raw_data.values_list('extraction_volume', flat=True)))
-        elution_volumes = Counter(list(eb_raw_data.values_list('elution_volume', flat=True)))
-        rt_template_volumes = Counter(list(eb_raw_data.values_list('rt_template_volume', flat=True)))
-        rt_reaction_volumes = Counter(list(eb_raw_data.values_list('rt_reaction_volume', flat=True)))
-        qpcr_template_volumes = Counter(list(eb_raw_data.values_list('qpcr_template_volume', flat=True)))
-        qpcr_reaction_volumes = Counter(list(eb_raw_data.values_list('qpcr_reaction_volume', flat=True)))
-
-        extraction_stats = []
-        for key, value in extraction_volumes.items():
-            extraction_stats.append({
-                "metric": "Extraction Volume",
-                "value": key,
-                "count": value
-            })
-        for key, value in elution_volumes.items():
-            extraction_stats.append({
-                "metric": "Elution Volume",
-                "value": key,
-                "count": value
-            })
-        for key, value in rt_template_volumes.items():
-            extraction_stats.append({
-                "metric": "RT Template Volume",
-                "value": key,
-                "count": value
-            })
-        for key, value in rt_reaction_volumes.items():
-            extraction_stats.append({
-                "metric": "RT Reaction Volume",
-                "value": key,
-                "count": value
-            })
-        for key, value in qpcr_template_volumes.items():
-            extraction_stats.append({
-                "metric": "qPCR Template Volume",
-                "value": key,
-                "count": value
-            })
-        for key, value in qpcr_reaction_volumes.items():
-            extraction_stats.append({
-                "metric": "qPCR Reaction Volume",
-                "value": key,
-                "count": value
-            })
-        data['extraction_quality_control'] = extraction_stats
-
+        # the number of distinct raw data rows with each value of each field, all computed in one query,
+        # a union of one grouped aggregate per field (each raw data row is identified by its values joined together)
+        eb_raw_row = Concat(*chain.from_iterable(
+            (Value('|'), Cast(field, CharField())) for field in eb_raw_fields), output_field=CharField())
+        extraction_stats_queries = []
+        for sort, (metric, field) in enumerate(QC_EXTRACTION_COUNT_METRICS):
+            extraction_stats_queries.append(eb_raw_data.annotate(
+                sort=Value(sort, IntegerField()), metric=Value(metric, CharField()), value=F(field)
+            ).values('sort', 'metric', 'value').annotate(count=Count(eb_raw_row, distinct=True)).order_by())
+        extraction_stats = [{
+            "metric": stat['metric'],
+            "value": stat['value'],
+            "count": stat['count']
+        } for stat in extraction_stats_queries[0].union(
+            *extraction_stats_queries[1:], all=True).order_by('sort', 'value')]
+
+        eb_raw_data = eb_raw_data.values(*eb_raw_fields).order_by('analysis_batch', 'extraction_number').distinct()
+
+        # write the extraction raw data as it is pulled from the database
+        # (the number of rows is not known until the raw data query has been run)
+        progress.set_phase('writing')
+        writer = ReportWriter(report_format, progress=progress)
+        writer.write_sections([
+            ('sample_quality_control', sample_stats),
+            ('extraction_raw_data', eb_raw_data.iterator()),
+            ('extraction_quality_control', extraction_stats)
+        ])
         datetimenow = datetime.today().strftime('%Y-%m-%d_%H:%M:%S')
-        new_file_name = "QualityControlReport_" + username + "_" + datetimenow + ".json"
-        new_file_content = ContentFile(json.dumps(data, cls=DecimalEncoder))
+        new_file_name = writer.save(report_file, "QualityControlReport_" + username + "_" + datetimenow)
 
-        report_file.file.save(new_file_name, new_file_content)
+        progress.set_phase('complete')
         report_file.status = Status.objects.filter(id=2).first()
         report_file.save()
         return "quality_control_report_task completed and created file {0}".format(new_file_name)
 
     except Exception as exc:
         message = "quality_control_report_task failed and no file was created, error message: {0}".format(exc)
+        progress.set_phase('failed')
         report_file.status = Status.objects.filter(id=3).first()
         report_file.fail_reason = message
         report_file.save()
@@ -486,302 +644,105 @@ def generate_quality_control_report(samples, report_file_id, username):
 
 
 @shared_task(name="control_results_report_task")
-def generate_control_results_report(sample_ids, target_ids, report_file_id, username):
+def generate_control_results_report(sample_ids, target_ids, report_file_id, username, report_format='json'):
     report_file = ReportFile.objects.filter(id=report_file_id).first()
 
+    progress = ReportProgress(report_file)
     try:
-        purge_old_reports(report_file.report_type.id)
-    except Exception as exc:
-        message = "control_results_report_task failed and no file was created, error message: {0}".format(exc)
-        report_file.status = Status.objects.filter(id=3).first()
-        report_file.fail_reason = message
-        report_file.save()
-        return message
-
-    try:
+        progress.start('recalculating')
         targets = Target.objects.all().values('id', 'name').order_by('name')
         if target_ids:
             targets = Target.objects.filter(id__in=target_ids).values('id', 'name').order_by('name')
         target_names = [target['name'] for target in targets]
 
-        # recalc reps validity once for use by all the control queries below
+        # recalc reps validity once for use by all the control queries below, for all the batches at once
         queryset = PCRReplicateBatch.objects.all()
         if sample_ids:
-            queryset = queryset.filter(pcrreplicates__sample_extraction__sample__in=sample_ids)
+            queryset = queryset.filter(id__in=PCRReplicate.objects.filter(
+                sample_extraction__sample__in=sample_ids).values('pcrreplicate_batch'))
         if target_ids:
             queryset = queryset.filter(target__in=target_ids)
-        for pcrrep_batch in queryset:
-            recalc_reps('PCRReplicateBatch', pcrrep_batch.id, recalc_rep_conc=False)
-
-        pos = "Positive"
-        neg = "Negative"
-        nr = "No Result"
-        na = "Not Analyzed"
-
-        # PCRReplicateBatch-level controls
-        # Ext Neg
-        ext_negs = PCRReplicateBatch.objects.all().annotate(
-            result=Case(
-                When(rt_neg_cq_value__gt=0, then=Value(pos)),
-                When(ext_neg_cq_value__gt=0, then=Value(pos)),
-                When(ext_neg_cq_value__exact=0, then=Value(neg)),
-                default=Value(nr), output_field=CharField()
-            )).annotate(pcrreplicate_batch=F('id')).values(
-            'extraction_batch__id', 'extraction_batch__analysis_batch', 'extraction_batch__analysis_batch__name',
-            'extraction_batch__extraction_number', 'replicate_number', 'target__name', 'pcrreplicate_batch', 'result'
-        ).order_by('extraction_batch__analysis_batch', 'extraction_batch__id')
-        if sample_ids:
-            ext_negs = ext_negs.filter(pcrreplicates__sample_extraction__sample__in=sample_ids)
-        if target_ids:
-            ext_negs = ext_negs.filter(target__in=target_ids)
-        ext_neg_results = {}
-        for ext_neg in ext_negs:
-            # if the EB is already included in our local dict, just append the current target to it
-            if ext_neg_results.get(ext_neg['extraction_batch__id'], None) is not None:
-                data = ext_neg_results[ext_neg['extraction_batch__id']]
-                data[ext_neg['target__name']] = ext_neg['result']
-            # otherwise, add the EB to our local dict and append the current target to it
-            else:
-                data = {
-                    "analysis_batch_string": ext_neg['extraction_batch__analysis_batch__name'],
-                    "analysis_batch": ext_neg['extraction_batch__analysis_batch'],
-                    "extraction_number": ext_neg['extraction_batch__extraction_number'],
-                    # "replicate_number": ext_neg['replicate_number'],
-                    "pcrreplicate_batch": ext_neg['pcrreplicate_batch'],
-                    ext_neg['target__name']: ext_neg['result']
-                }
-            ext_neg_results[ext_neg['extraction_batch__id']] = data
-        # convert the dict of dicts into a list of dicts
-        ext_neg_results_list = list(ext_neg_results.values())
-        ext_neg_results_list_ordered = []
-        # include targets not analyzed
-        for ext_neg_result in ext_neg_results_list:
-            for target in targets:
-                if target['name'] not in ext_neg_result:
-                    ext_neg_result[target['name']] = na
-            ext_neg_result_ids = OrderedDict({
-                "analysis_batch": ext_neg_result.pop('analysis_batch'),
-                "analysis_batch_string": ext_neg_result.pop('analysis_batch_string'),
-                "extraction_number": ext_neg_result.pop('extraction_number'),
-                "pcrreplicate_batch": ext_neg_result.pop('pcrreplicate_batch')
-            })
-            ext_neg_result_targets = OrderedDict(sorted(ext_neg_result.items()))
-            ext_neg_results_list_ordered.append(OrderedDict(**ext_neg_result_ids, **ext_neg_result_targets))
-
-        # PCR Neg
-        pcr_negs = PCRReplicateBatch.objects.all().annotate(
-            result=Case(
-                When(pcr_neg_cq_value__gt=0, then=Value(pos)),
-                When(pcr_neg_cq_value__exact=0, then=Value(neg)),
-                default=Value(nr), output_field=CharField()
-            )).annotate(pcrreplicate_batch=F('id')).values(
-            'extraction_batch__id', 'extraction_batch__analysis_batch', 'extraction_batch__analysis_batch__name',
-            'extraction_batch__extraction_number', 'replicate_number', 'target__name', 'pcrreplicate_batch', 'result'
-        ).order_by('extraction_batch__analysis_batch', 'extraction_batch__id')
-        if sample_ids:
-            pcr_negs = pcr_negs.filter(pcrreplicates__sample_extraction__sample__in=sample_ids)
-        if target_ids:
-            pcr_negs = pcr_negs.filter(target__in=target_ids)
-        pcr_neg_results = {}
-        for pcr_neg in pcr_negs:
-            # if the EB is already included in our local dict, just append the current target to it
-            if pcr_neg_results.get(pcr_neg['extraction_batch__id'], None) is not None:
-                data = pcr_neg_results[pcr_neg['extraction_batch__id']]
-                data[pcr_neg['target__name']] = pcr_neg['result']
-            # otherwise, add the EB to our local dict and append the current target to it
-            else:
-                data = {
-                    "analysis_batch_string": pcr_neg['extraction_batch__analysis_batch__name'],
-                    "analysis_batch": pcr_neg['extraction_batch__analysis_batch'],
-                    "extraction_number": pcr_neg['extraction_batch__extraction_number'],
-                    # "replicate_number": pcr_neg['replicate_number'],
-                    "pcrreplicate_batch": pcr_neg['pcrreplicate_batch'],
-                    pcr_neg['target__name']: pcr_neg['result']
-                }
-            pcr_neg_results[pcr_neg['extraction_batch__id']] = data
-        # convert the dict of dicts into a list of dicts
-        pcr_neg_results_list = list(pcr_neg_results.values())
-        pcr_neg_results_list_ordered = []
-        # include targets not analyzed
-        for pcr_neg_result in pcr_neg_results_list:
-            for target in targets:
-                if target['name'] not in pcr_neg_result:
-                    pcr_neg_result[target['name']] = na
-            pcr_neg_result_ids = OrderedDict({
-                "analysis_batch": pcr_neg_result.pop('analysis_batch'),
-                "analysis_batch_string": pcr_neg_result.pop('analysis_batch_string'),
-                "extraction_number": pcr_neg_result.pop('extraction_number'),
-                "pcrreplicate_batch": pcr_neg_result.pop('pcrreplicate_batch')
-            })
-            pcr_neg_result_targets = OrderedDict(sorted(pcr_neg_result.items()))
-            pcr_neg_results_list_ordered.append(OrderedDict(**pcr_neg_result_ids, **pcr_neg_result_targets))
-
-        # PCR Pos
-        pcr_poss = PCRReplicateBatch.objects.all().annotate(
-            result=Case(
-                When(pcr_pos_cq_value__gt=0, then=Value('pcr_pos_cq_value')),
-                When(pcr_pos_cq_value__exact=0, then=Value(neg)),
-                default=Value(nr), output_field=CharField()
-            )).annotate(pcrreplicate_batch=F('id')).values(
-            'extraction_batch__id', 'extraction_batch__analysis_batch', 'extraction_batch__analysis_batch__name',
-            'extraction_batch__extraction_number', 'replicate_number', 'target__name', 'pcrreplicate_batch', 'result',
-            'pcr_pos_cq_value').order_by('extraction_batch__analysis_batch', 'extraction_batch__id')
-        if sample_ids:
-            pcr_poss = pcr_poss.filter(pcrreplicates__sample_extraction__sample__in=sample_ids)
-        if target_ids:
-            pcr_poss = pcr_poss.filter(target__in=target_ids)
-        pcr_pos_results = {}
-        for pcr_pos in pcr_poss:
-            # if the EB is already included in our local dict, just append the current target to it
-            if pcr_pos_results.get(pcr_pos['extraction_batch__id'], None) is not None:
-                data = pcr_pos_results[pcr_pos['extraction_batch__id']]
-                if pcr_pos['result'] == 'pcr_pos_cq_value':
-                    pcr_pos['result'] = pcr_pos['pcr_pos_cq_value']
-                data[pcr_pos['target__name']] = pcr_pos['result']
-            # otherwise, add the EB to our local dict and append the current target to it
-            else:
-                if pcr_pos['result'] == 'pcr_pos_cq_value':
-                    pcr_pos['result'] = pcr_pos['pcr_pos_cq_value']
-                data = {
-                    "analysis_batch_string": pcr_pos['extraction_batch__analysis_batch__name'],
-                    "analysis_batch": pcr_pos['extraction_batch__analysis_batch'],
-                    "extraction_number": pcr_pos['extraction_batch__extraction_number'],
-                    # "replicate_number": pcr_pos['replicate_number'],
-                    "pcrreplicate_batch": pcr_pos['pcrreplicate_batch'],
-                    pcr_pos['target__name']: pcr_pos['result']
-                }
-            pcr_pos_results[pcr_pos['extraction_batch__id']] = data
-        # convert the dict of dicts into a list of dicts
-        pcr_pos_results_list = list(pcr_pos_results.values())
-        pcr_pos_results_list_ordered = []
-        # include targets not analyzed
-        for pcr_pos_result in pcr_pos_results_list:
-            for target in targets:
-                if target['name'] not in pcr_pos_result:
-                    pcr_pos_result[target['name']] = na
-            pcr_pos_result_ids = OrderedDict({
-                "analysis_batch": pcr_pos_result.pop('analysis_batch'),
-                "analysis_batch_string": pcr_pos_result.pop('analysis_batch_string'),
-                "extraction_number": pcr_pos_result.pop('extraction_number'),
-                "pcrreplicate_batch": pcr_pos_result.pop('pcrreplicate_batch')
-            })
-            pcr_pos_result_targets = OrderedDict(sorted(pcr_pos_result.items()))
-            pcr_pos_results_list_ordered.append(OrderedDict(**pcr_pos_result_ids, **pcr_pos_result_targets))
-
-        # ExtractionBatch-level controls
-        # Ext Pos
-        ext_poss = PCRReplicateBatch.objects.filter(
-            extraction_batch__reversetranscriptions__re_rt__isnull=True
-        ).annotate(
-            ext_pos_rna_rt_cq_value=F('extraction_batch__reversetranscriptions__ext_pos_rna_rt_cq_value')
-        ).annotate(
-            result=Case(
-                When(Q(ext_pos_rna_rt_cq_value__gt=0) & Q(target__nucleic_acid_type__name__exact='RNA'),
-                     then=Value('ext_pos_rna_rt_cq_value')),
-                When(Q(extraction_batch__ext_pos_dna_cq_value__gt=0) & Q(target__nucleic_acid_type__name__exact='DNA'),
-                     then=Value('ext_pos_dna_cq_value')),
-                When(extraction_batch__ext_pos_dna_cq_value__exact=0, then=Value(neg)),
-                default=Value(nr), output_field=CharField()
-            )).annotate(pcrreplicate_batch=F('id')).values(
-            'extraction_batch__id', 'extraction_batch__analysis_batch', 'extraction_batch__analysis_batch__name',
-            'extraction_batch__extraction_number', 'replicate_number', 'target__name', 'pcrreplicate_batch', 'result',
-            'ext_pos_rna_rt_cq_value', 'extraction_batch__ext_pos_dna_cq_value'
-        ).order_by('extraction_batch__analysis_batch', 'extraction_batch__id')
-        if sample_ids:
-            ext_poss = ext_poss.filter(pcrreplicates__sample_extraction__sample__in=sample_ids)
-        if target_ids:
-            ext_poss = ext_poss.filter(target__in=target_ids)
-        ext_pos_results = {}
-        for ext_pos in ext_poss:
-            # if the EB is already included in our local dict, just append the current target to it
-            if ext_pos_results.get(ext_pos['extraction_batch__id'], None) is not None:
-                data = ext_pos_results[ext_pos['extraction_batch__id']]
-                if ext_pos['result'] == 'ext_pos_rna_rt_cq_value':
-                    ext_pos['result'] = ext_pos['ext_pos_rna_rt_cq_value']
-                elif ext_pos['result'] == 'ext_pos_dna_cq_value':
-                    ext_pos['result'] = ext_pos['extraction_batch__ext_pos_dna_cq_value']
-                data[ext_pos['target__name']] = ext_pos['result']
-            # otherwise, add the EB to our local dict and append the current target to it
-            else:
-                if ext_pos['result'] == 'ext_pos_rna_rt_cq_value':
-                    ext_pos['result'] = ext_pos['ext_pos_rna_rt_cq_value']
-                elif ext_pos['result'] == 'ext_pos_dna_cq_value':
-                    ext_pos['result'] = ext_pos['extraction_batch__ext_pos_dna_cq_value']
-                data = {
-                    "analysis_batch_string": ext_pos['extraction_batch__analysis_batch__name'],
-                    "analysis_batch": ext_pos['extraction_batch__analysis_batch'],
-                    "extraction_number": ext_pos['extraction_batch__extraction_number'],
-                    "pcrreplicate_batch": ext_pos['pcrreplicate_batch'],
-                    # "replicate_number": ext_pos['replicate_number'],
-                    ext_pos['target__name']: ext_pos['result']
-                }
-            ext_pos_results[ext_pos['extraction_batch__id']] = data
-        # convert the dict of dicts into a list of dicts
-        ext_pos_results_list = list(ext_pos_results.values())
-        ext_pos_results_list_ordered = []
-        # include targets not analyzed
-        for ext_pos_result in ext_pos_results_list:
-            for target in targets:
-                if target['name'] not in ext_pos_result:
-                    ext_pos_result[target['name']] = na
-            ext_pos_result_ids = OrderedDict({
-                "analysis_batch": ext_pos_result.pop('analysis_batch'),
-                "analysis_batch_string": ext_pos_result.pop('analysis_batch_string'),
-                "extraction_number": ext_pos_result.pop('extraction_number'),
-                "pcrreplicate_batch": ext_pos_result.pop('pcrreplicate_batch')
-            })
-            ext_pos_result_targets = OrderedDict(sorted(ext_pos_result.items()))
-            ext_pos_results_list_ordered.append(OrderedDict(**ext_pos_result_ids, **ext_pos_result_targets))
+        pcrrep_batch_ids = list(queryset.values_list('id', flat=True))
+        if pcrrep_batch_ids:
+            PCRReplicate.objects.recalc(PCRReplicate.objects.filter(
+                get_recalc_reps_filter('PCRReplicateBatch', pcrrep_batch_ids)), recalc_rep_conc=False)
+
+        progress.set_phase('aggregating')
+        pos = CONTROL_POSITIVE
+        neg = CONTROL_NEGATIVE
+        nr = CONTROL_NO_RESULT
+        na = CONTROL_NOT_ANALYZED
+
+        # PCRReplicateBatch-level and ExtractionBatch-level controls
+        # fetch the values of all the controls of the batches in one query, and pivot them into one table per control
+        # (with a row per extraction batch and a column per target) in a single pass
+        rts = ReverseTranscription.objects.filter(extraction_batch=OuterRef('extraction_batch'))
+        active_rts = rts.filter(re_rt__isnull=True)
+        controls = queryset.annotate(
+            has_rt=Exists(rts), has_active_rt=Exists(active_rts),
+            ext_pos_rna_rt_cq_value=Subquery(active_rts.values('ext_pos_rna_rt_cq_value')[:1])
+        ).values(
+            'id', 'extraction_batch__id', 'extraction_batch__analysis_batch', 'extraction_batch__analysis_batch__name',
+            'extraction_batch__extraction_number', 'target__name', 'target__nucleic_acid_type__name',
+            'ext_neg_cq_value', 'rt_neg_cq_value', 'pcr_neg_cq_value', 'pcr_pos_cq_value',
+            'extraction_batch__ext_pos_dna_cq_value', 'has_rt', 'has_active_rt', 'ext_pos_rna_rt_cq_value'
+        ).order_by('extraction_batch__analysis_batch', 'extraction_batch__id', 'id')
+        control_results = pivot_rows(
+            controls.iterator(), 'extraction_batch__id', CONTROL_RESULTS_ROW_FIELDS, 'target__name',
+            CONTROL_RESULTS, columns=target_names, missing=na)
 
         # Sample-level controls
         # PegNegs
         # peg_negs = Sample.objects.filter(record_type=2)
         peg_neg_ids = list(set(Sample.objects.filter(id__in=sample_ids).values_list('peg_neg', flat=True)))
         peg_negs = Sample.objects.filter(id__in=peg_neg_ids).order_by('id')
+        # count the valid reps, the positive reps, and the zero reps of every peg neg and target in one query
+        peg_neg_counts = {
+            (count['sample_extraction__sample'], count['pcrreplicate_batch__target']): count
+            for count in PCRReplicate.objects.filter(
+                sample_extraction__sample__in=peg_neg_ids,
+                pcrreplicate_batch__target__in=[target['id'] for target in targets], invalid=False
+            ).values('sample_extraction__sample', 'pcrreplicate_batch__target').annotate(
+                positive_count=Count('id', filter=Q(cq_value__gt=Decimal('0'))),
+                zero_count=Count('id', filter=Q(cq_value=Decimal('0')))).order_by()}
         peg_neg_results_list = []
-        for peg_neg in peg_negs:
-            peg_neg_resp = {"id": peg_neg.id, "collaborator_sample_id": peg_neg.collaborator_sample_id,
-                            "collection_start_date": peg_neg.collection_start_date}
+        for peg_neg in peg_negs.values('id', 'collaborator_sample_id', 'collection_start_date'):
+            peg_neg_resp = {"id": peg_neg['id'], "collaborator_sample_id": peg_neg['collaborator_sample_id'],
+                            "collection_start_date": peg_neg['collection_start_date']}
             for target in targets:
-                # only check for valid reps with the same target
-                reps = PCRReplicate.objects.filter(
-                    sample_extraction__sample_id=peg_neg.id,
-                    pcrreplicate_batch__target_id__exact=target['id'], invalid=False)
+                # only count valid reps with the same target
+                count = peg_neg_counts.get((peg_neg['id'], target['id']))
                 # if there are no reps, then this target was not analyzed
-                if len(reps) == 0:
+                if count is None:
                     result = na
+                # if even a single one of the peg_neg reps is greater than zero,
+                # the data rep result must be set to positive
+                elif count['positive_count'] > 0:
+                    result = pos
                 else:
-                    # if even a single one of the peg_neg reps is greater than zero,
-                    # the data rep result must be set to positive
-                    pos_result = [r.cq_value for r in reps if r.cq_value is not None and r.cq_value > Decimal('0')]
-                    if pos_result:
-                        result = pos
-                    else:
-                        neg_result = [r.cq_value for r in reps if r.cq_value is not None and r.cq_value == Decimal('0')]
-                        result = neg if neg_result else nr
+                    result = neg if count['zero_count'] > 0 else nr
                 peg_neg_resp[target['name']] = result
             peg_neg_results_list.append(peg_neg_resp)
 
-        data = {
-            "ext_neg": ext_neg_results_list_ordered,
-            "pcr_neg": pcr_neg_results_list_ordered,
-            "pcr_pos": pcr_pos_results_list_ordered,
-            "ext_pos": ext_pos_results_list_ordered,
-            "peg_neg": peg_neg_results_list,
-            "targets": target_names
-        }
-
+        progress.set_phase('writing', rows_total=sum(len(rows) for rows in control_results.values())
+                           + len(peg_neg_results_list) + len(target_names))
+        writer = ReportWriter(report_format, default=str, progress=progress)
+        writer.write_sections([
+            *control_results.items(),
+            ("peg_neg", peg_neg_results_list),
+            ("targets", target_names)
+        ])
         datetimenow = datetime.today().strftime('%Y-%m-%d_%H:%M:%S')
-        new_file_name = "ControlResultsReport_" + username + "_" + datetimenow + ".json"
-        new_file_content = ContentFile(json.dumps(data, cls=DecimalEncoder, default=str))
+        new_file_name = writer.save(report_file, "ControlResultsReport_" + username + "_" + datetimenow)
 
-        report_file.file.save(new_file_name, new_file_content)
+        progress.set_phase('complete')
         report_file.status = Status.objects.filter(id=2).first()
         report_file.save()
         return "control_results_report_task completed and created file {0}".format(new_file_name)
 
     except Exception as exc:
         message = "control_results_report_task failed and no file was created, error message: {0}".format(exc)
+        progress.set_phase('failed')
         report_file.status = Status.objects.filter(id=3).first()
         report_file.fail_reason = message
         report_file.save()
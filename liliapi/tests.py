@@ -1,3 +1,322 @@
-from django.test import TestCase
+from decimal import Decimal
+from unittest import mock, skipUnless
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, override_settings
+from liliapi import calculations
+from liliapi.calculations import calc_rep_concs
+from liliapi.models import *
+from liliapi.tasks import get_qc_sample_stats, recalc_pending, QC_SAMPLE_COUNT_METRICS, QC_SAMPLE_MIN_MAX_METRICS
+from liliapi.views import get_report_format
 
-# Create your tests here.
+
+class QualityControlSampleStatsTest(TestCase):
+
+    def setUp(self):
+        RecordType.objects.create(name='Data')
+        matrix = Matrix.objects.create(name='Water', code='W')
+        sample_type = SampleType.objects.create(name='Grab', code='G')
+        study = Study.objects.create(name='Study')
+        unit = Unit.objects.create(name='Liter', symbol='L')
+        for index, volume in enumerate([Decimal('10'), Decimal('30')]):
+            Sample.objects.create(sample_type=sample_type, matrix=matrix, study=study,
+                                  collaborator_sample_id='sample{0}'.format(index), collection_start_date='2020-01-01',
+                                  total_volume_or_mass_sampled=volume, meter_reading_unit=unit)
+
+    def test_sample_stats(self):
+        # the union of the count and the min and max queries runs as one query, with a row per value of each count
+        # metric and a row per min and max metric
+        stats = get_qc_sample_stats(Sample.objects.all())
+        self.assertEqual([stat['metric'] for stat in stats],
+                         [metric for metric, field in QC_SAMPLE_COUNT_METRICS + QC_SAMPLE_MIN_MAX_METRICS])
+        stats = {stat['metric']: stat for stat in stats}
+        self.assertEqual((stats['Sample Matrix']['value'], stats['Sample Matrix']['count']), ('Water', 2))
+        self.assertEqual((stats['Meter Reading Unit']['value'], stats['Meter Reading Unit']['count']), ('Liter', 2))
+        self.assertEqual(stats['Total Volume Sampled Unit Initial']['count'], 0)
+        volume = stats['Total Volume or Mass Sampled']
+        self.assertEqual((volume['count'], volume['min'], volume['max']), (None, Decimal('10'), Decimal('30')))
+
+    def test_sample_stats_without_samples(self):
+        # the min and max metrics still give a row each (of None values), and the count metrics none
+        stats = get_qc_sample_stats(Sample.objects.filter(id__lt=0))
+        self.assertEqual([(stat['metric'], stat['count'], stat['min'], stat['max']) for stat in stats],
+                         [(metric, None, None, None) for metric, field in QC_SAMPLE_MIN_MAX_METRICS])
+
+
+class ReportFormatTest(TestCase):
+
+    def test_report_format(self):
+        self.assertEqual(get_report_format(None), 'json')
+        self.assertEqual(get_report_format('CSV'), 'csv')
+        self.assertIsNone(get_report_format('xml'))
+        # the format of a JSON request body can be any JSON value
+        self.assertIsNone(get_report_format(1))
+        self.assertIsNone(get_report_format(['csv']))
+
+
+class ReplicateConcentrationModesTest(SimpleTestCase):
+
+    def setUp(self):
+        self.eb_contexts = {
+            1: {"qpcr_reaction_volume": Decimal('20'), "qpcr_template_volume": Decimal('5'),
+                "elution_volume": Decimal('100'), "extraction_volume": Decimal('50'),
+                "sample_dilution_factor": Decimal('2'), "rt_reaction_volume": Decimal('20'),
+                "rt_template_volume": Decimal('8')},
+            2: {"qpcr_reaction_volume": Decimal('25'), "qpcr_template_volume": Decimal('3'),
+                "elution_volume": Decimal('75'), "extraction_volume": Decimal('35'),
+                "sample_dilution_factor": Decimal('1'), "rt_reaction_volume": None, "rt_template_volume": None}
+        }
+        self.sample_contexts = {}
+        for sample_id, (matrix_code, volume) in enumerate(
+                [('W', Decimal('33.3')), ('A', Decimal('7')), ('SM', Decimal('12.5')), ('LM', None), ('F', None)]):
+            self.sample_contexts[sample_id] = {
+                "matrix_code": matrix_code, "total_volume_or_mass_sampled": Decimal('1234.5'),
+                "final_concentrated_sample_volume": volume, "dissolution_volume": volume, "post_dilution_volume": volume}
+        self.reps = []
+        for gc_reaction in [Decimal('0'), Decimal('0.000123'), Decimal('98765.4321'), None]:
+            for extraction_batch_id in self.eb_contexts:
+                for sample_id in self.sample_contexts:
+                    for nucleic_acid_type_name in ['DNA', 'RNA']:
+                        self.reps.append({
+                            "gc_reaction": gc_reaction, "extraction_batch_id": extraction_batch_id,
+                            "sample_id": sample_id, "nucleic_acid_type_name": nucleic_acid_type_name,
+                            "inhibition_dilution_factor": Decimal('3')})
+
+    @skipUnless(calculations.numpy, "NumPy is not installed")
+    def test_float_mode_agrees_with_exact_mode(self):
+        exact_concs = calc_rep_concs(self.reps, self.eb_contexts, self.sample_contexts)
+        float_concs = calc_rep_concs(self.reps, self.eb_contexts, self.sample_contexts, exact=False)
+        self.assertEqual(len(float_concs), len(exact_concs))
+        # both modes agree on which reps have no concentration, and on the rest within float precision
+        self.assertEqual([conc is None for conc in float_concs], [conc is None for conc in exact_concs])
+        self.assertTrue(any(conc for conc in exact_concs))
+        for exact_conc, float_conc in zip(exact_concs, float_concs):
+            if exact_conc is not None:
+                self.assertIsInstance(exact_conc, (Decimal, int))
+                self.assertAlmostEqual(float_conc, float(exact_conc), delta=abs(float(exact_conc)) * 1e-12)
+
+    def test_float_mode_falls_back_to_exact_mode(self):
+        numpy = calculations.numpy
+        calculations.numpy = None
+        try:
+            self.assertEqual(calc_rep_concs(self.reps, self.eb_contexts, self.sample_contexts, exact=False),
+                             calc_rep_concs(self.reps, self.eb_contexts, self.sample_contexts))
+        finally:
+            calculations.numpy = numpy
+
+
+class ExtractionBatchTestCase(TestCase):
+    """
+    An extraction batch of a peg_neg and three data samples (two using the peg_neg), with an active and a replaced RT,
+    and PCR replicate batches for a DNA and an RNA target, the RNA one with an invalid PCR negative control
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        Unit.objects.create(name='gram', symbol='g')
+        Unit.objects.create(name='Liter', symbol='L')
+        RecordType.objects.create(id=1, name='Data')
+        RecordType.objects.create(id=2, name='Control')
+        dna = NucleicAcidType.objects.create(name='DNA')
+        rna = NucleicAcidType.objects.create(name='RNA')
+        self.dna_target = Target.objects.create(name='DNA target', code='D', nucleic_acid_type=dna)
+        self.rna_target = Target.objects.create(name='RNA target', code='R', nucleic_acid_type=rna)
+        sample_type = SampleType.objects.create(name='Grab', code='G')
+        study = Study.objects.create(name='Study')
+        concentration_type = ConcentrationType.objects.create(name='Concentration')
+
+        def create_sample(name, matrix_code, record_type_id=1, peg_neg=None, **kwargs):
+            return Sample.objects.create(
+                sample_type=sample_type, matrix=Matrix.objects.get_or_create(name=matrix_code, code=matrix_code)[0],
+                study=study, collaborator_sample_id=name, collection_start_date='2020-01-01',
+                total_volume_or_mass_sampled=Decimal('40'), record_type_id=record_type_id, peg_neg=peg_neg, **kwargs)
+        self.peg_neg = create_sample('peg_neg', 'W', record_type_id=2)
+        self.peg_neg_sample = create_sample('water', 'W', peg_neg=self.peg_neg)
+        self.air_sample = create_sample('air', 'A', dissolution_volume=Decimal('2.5'))
+        # a solid manure sample without the post_dilution_volume its concentration needs
+        self.manure_sample = create_sample('manure', 'SM', peg_neg=self.peg_neg)
+        for sample, volume in ((self.peg_neg, Decimal('15')), (self.peg_neg_sample, Decimal('20'))):
+            FinalConcentratedSampleVolume.objects.create(
+                sample=sample, concentration_type=concentration_type, final_concentrated_sample_volume=volume)
+
+        self.extraction_batch = ExtractionBatch.objects.create(
+            analysis_batch=AnalysisBatch.objects.create(name='Analysis Batch'),
+            extraction_method=ExtractionMethod.objects.create(name='Method'), extraction_number=1,
+            extraction_volume=Decimal('100'), elution_volume=Decimal('50'), sample_dilution_factor=2,
+            ext_pos_dna_cq_value=Decimal('20'))
+        active_rt = ReverseTranscription.objects.create(
+            extraction_batch=self.extraction_batch, template_volume=Decimal('8'), reaction_volume=Decimal('40'),
+            ext_pos_rna_rt_cq_value=Decimal('10'))
+        ReverseTranscription.objects.create(
+            extraction_batch=self.extraction_batch, template_volume=Decimal('5'), reaction_volume=Decimal('25'),
+            ext_pos_rna_rt_cq_value=Decimal('10'), re_rt=active_rt)
+
+        # the cq_value and gc_reaction of the reps of each sample, for the DNA replicate batches and the RNA one
+        rep_values = {
+            self.peg_neg: [(Decimal('0'), Decimal('0')), (Decimal('0'), Decimal('0')), (Decimal('0'), Decimal('0'))],
+            self.peg_neg_sample: [(Decimal('31'), Decimal('123.4')), (Decimal('0'), Decimal('0')),
+                                  (Decimal('28'), Decimal('56.7'))],
+            self.air_sample: [(Decimal('33'), Decimal('98.7')), (None, None), (Decimal('30'), Decimal('12.3'))],
+            self.manure_sample: [(Decimal('35'), Decimal('45.6')), (Decimal('36'), Decimal('7.8')),
+                                 (Decimal('29'), Decimal('65.4'))]
+        }
+        pcrreplicate_batches = [
+            PCRReplicateBatch.objects.create(
+                extraction_batch=self.extraction_batch, target=self.dna_target, replicate_number=1,
+                ext_neg_cq_value=Decimal('0'), pcr_neg_cq_value=Decimal('0')),
+            PCRReplicateBatch.objects.create(
+                extraction_batch=self.extraction_batch, target=self.dna_target, replicate_number=2,
+                ext_neg_cq_value=Decimal('0'), pcr_neg_cq_value=Decimal('0')),
+            PCRReplicateBatch.objects.create(
+                extraction_batch=self.extraction_batch, target=self.rna_target, replicate_number=1,
+                ext_neg_cq_value=Decimal('0'), rt_neg_cq_value=Decimal('0'), pcr_neg_cq_value=Decimal('1'))
+        ]
+        for sample, values in rep_values.items():
+            sample_extraction = SampleExtraction.objects.create(
+                sample=sample, extraction_batch=self.extraction_batch,
+                inhibition_dna=Inhibition.objects.create(
+                    sample=sample, extraction_batch=self.extraction_batch, nucleic_acid_type=dna, dilution_factor=2),
+                inhibition_rna=Inhibition.objects.create(
+                    sample=sample, extraction_batch=self.extraction_batch, nucleic_acid_type=rna, dilution_factor=5))
+            for pcrreplicate_batch, (cq_value, gc_reaction) in zip(pcrreplicate_batches, values):
+                PCRReplicate.objects.create(sample_extraction=sample_extraction, pcrreplicate_batch=pcrreplicate_batch,
+                                            cq_value=cq_value, gc_reaction=gc_reaction, created_by=self.user)
+        # a rep whose validity was overridden by a user, which a recalc must leave as it is
+        PCRReplicate.objects.filter(sample_extraction__sample=self.air_sample,
+                                    pcrreplicate_batch=pcrreplicate_batches[0]).update(
+            invalid=False, invalid_override=self.user)
+
+    def get_rep_values(self):
+        return {rep_id: (replicate_concentration, invalid) for rep_id, replicate_concentration, invalid in
+                PCRReplicate.objects.values_list('id', 'replicate_concentration', 'invalid')}
+
+    def reset_rep_values(self):
+        PCRReplicate.objects.update(replicate_concentration=None)
+        PCRReplicate.objects.filter(invalid_override__isnull=True).update(invalid=True)
+
+
+class ReplicateRecalculationTest(ExtractionBatchTestCase):
+
+    def recalc_per_row(self):
+        # the per-row calculation the set-based recalc replaces, assessing the peg_neg reps before the data reps
+        reps = sorted(PCRReplicate.objects.all(), key=lambda rep: rep.sample_extraction.sample.record_type_id == 1)
+        for rep in reps:
+            values = {"replicate_concentration": rep.calc_rep_conc()}
+            if rep.invalid_override is None:
+                values["invalid"] = rep.calc_invalid()
+            PCRReplicate.objects.filter(id=rep.id).update(**values)
+
+    def test_recalc_matches_per_row_calculation(self):
+        self.reset_rep_values()
+        self.recalc_per_row()
+        expected_values = self.get_rep_values()
+
+        self.reset_rep_values()
+        PCRReplicate.objects.recalc(PCRReplicate.objects.all())
+        self.assertEqual(self.get_rep_values(), expected_values)
+
+        # the data covers concentrations that are missing, zero, and positive, and both valid and invalid reps
+        concentrations = [concentration for concentration, invalid in expected_values.values()]
+        self.assertIn(None, concentrations)
+        self.assertIn(0, concentrations)
+        self.assertTrue(any(concentration for concentration in concentrations))
+        self.assertEqual({invalid for concentration, invalid in expected_values.values()}, {True, False})
+
+    def test_recalc_uses_the_active_rt(self):
+        PCRReplicate.objects.recalc(PCRReplicate.objects.all())
+        rep = PCRReplicate.objects.get(sample_extraction__sample=self.peg_neg_sample,
+                                       pcrreplicate_batch__target=self.rna_target)
+        # gc_reaction / qpcr_reaction_volume * qpcr ratio * elution ratio * sample dilution factor
+        # * inhibition dilution factor * RT ratio * sample volume ratio * unit factor
+        expected = (Decimal('56.7') / Decimal('20') * (Decimal('20') / Decimal('6')) * (Decimal('50') / Decimal('100'))
+                    * 2 * 5 * (Decimal('40') / Decimal('8')) * (Decimal('20') / Decimal('40')) * 1000)
+        self.assertEqual(rep.replicate_concentration, expected)
+
+    def test_invalid_reasons_match_per_rep_reasons(self):
+        PCRReplicate.objects.recalc(PCRReplicate.objects.all())
+        reps = list(PCRReplicate.objects.all())
+        reasons = PCRReplicate.objects.get_invalid_reasons(reps)
+        for rep in reps:
+            self.assertEqual(reasons[rep.id], rep.invalid_reasons)
+
+        # the RNA reps are invalid because of the PCR negative control of their replicate batch
+        rna_rep = PCRReplicate.objects.get(sample_extraction__sample=self.air_sample,
+                                           pcrreplicate_batch__target=self.rna_target)
+        self.assertTrue(rna_rep.invalid)
+        self.assertTrue(reasons[rna_rep.id]['pcr_neg_invalid'])
+        self.assertFalse(reasons[rna_rep.id]['ext_rt_pos_rna_missing'])
+        # and the valid reps have none of the reasons
+        valid_rep = PCRReplicate.objects.get(sample_extraction__sample=self.peg_neg_sample,
+                                             pcrreplicate_batch__target=self.dna_target,
+                                             pcrreplicate_batch__replicate_number=1)
+        self.assertFalse(valid_rep.invalid)
+        self.assertFalse(any(reasons[valid_rep.id].values()))
+
+
+@override_settings(RECALC_ASYNC=True)
+class PendingRecalcTest(ExtractionBatchTestCase):
+
+    def setUp(self):
+        super().setUp()
+        PCRReplicate.objects.recalc(PCRReplicate.objects.all())
+        PendingRecalc.objects.all().delete()
+
+    def test_schedules_of_the_same_recalc_are_merged(self):
+        schedule_recalc_reps('ExtractionBatch', self.extraction_batch.id, recalc_rep_conc=False)
+        schedule_recalc_reps('ExtractionBatch', self.extraction_batch.id, recalc_invalid=False)
+        schedule_recalc_reps('Sample', self.air_sample.id)
+        schedule_recalc_reps('FinalSampleMeanConcentration', self.air_sample.id, self.dna_target.id)
+        schedule_recalc_reps('FinalSampleMeanConcentration', self.air_sample.id, self.dna_target.id)
+
+        self.assertEqual(PendingRecalc.objects.count(), 3)
+        # the merged recalculation runs everything either schedule asked for
+        pending = PendingRecalc.objects.get(level='ExtractionBatch', level_id=self.extraction_batch.id)
+        self.assertTrue(pending.recalc_rep_conc)
+        self.assertTrue(pending.recalc_invalid)
+
+    def test_recalc_pending_clears_the_markers(self):
+        PCRReplicate.objects.update(replicate_concentration=None)
+        schedule_recalc_reps('ExtractionBatch', self.extraction_batch.id)
+        schedule_recalc_reps('ExtractionBatch', self.extraction_batch.id)
+        fsmcs = FinalSampleMeanConcentration.objects.all()
+        self.assertTrue(fsmcs.exists())
+        self.assertFalse(PCRReplicate.objects.filter(recalc_pending=False).exists())
+        self.assertFalse(fsmcs.filter(computed_version__gte=F('input_version')).exists())
+
+        recalc_pending()
+        self.assertFalse(PendingRecalc.objects.exists())
+        self.assertFalse(PCRReplicate.objects.filter(recalc_pending=True).exists())
+        self.assertFalse(fsmcs.filter(computed_version__lt=F('input_version')).exists())
+        self.assertTrue(PCRReplicate.objects.filter(replicate_concentration__isnull=False).exists())
+
+
+@override_settings(RECALC_ASYNC=True)
+class RecalcUnitOfWorkTest(ExtractionBatchTestCase):
+
+    def test_saves_recalculate_once(self):
+        # bring the reps up to date first, so that the saves below do not flip the validity of the peg_neg
+        PCRReplicate.objects.recalc(PCRReplicate.objects.all())
+        reps = list(PCRReplicate.objects.all())
+        with mock.patch.object(PCRReplicate.objects, 'recalc', wraps=PCRReplicate.objects.recalc) as rep_recalc, \
+                mock.patch.object(FinalSampleMeanConcentration.objects, 'recalc',
+                                  wraps=FinalSampleMeanConcentration.objects.recalc) as fsmc_recalc:
+            with recalc_unit_of_work() as unit_of_work:
+                for rep in reps:
+                    rep.save()
+                recalc_reps('ExtractionBatch', self.extraction_batch.id)
+                recalc_reps('ExtractionBatch', self.extraction_batch.id)
+                schedule_recalc_reps('Sample', self.air_sample.id)
+                self.assertEqual(rep_recalc.call_count, 0)
+            # the test transaction is never committed, so run the on_commit flush here
+            unit_of_work.flush()
+
+        self.assertEqual(rep_recalc.call_count, 1)
+        # the rep recalc updates the FSMCs of its reps, leaving none for the FSMC recalc of the flush
+        self.assertEqual(fsmc_recalc.call_count, 2)
+        self.assertEqual(set(fsmc_recalc.call_args[0][0]), set())
+        # each rep save requests its sample-target combo, and the peg_neg rep saves also their peg_neg-target combo
+        self.assertEqual(unit_of_work.requested_count, len(reps) + 3 + 3)
+        # the two peg_neg-target combos and the two rep scopes, which cover all of the sample-target combos
+        self.assertEqual(unit_of_work.run_count, 4)
+        self.assertEqual(unit_of_work.deduped_count, unit_of_work.requested_count - 4)
+        # the scheduled recalculation is queued rather than run
+        self.assertTrue(PendingRecalc.objects.filter(level='Sample', level_id=self.air_sample.id).exists())
@@ -10,6 +10,7 @@ from liliapi.serializers import *
 from liliapi.models import *
 from liliapi.permissions import *
 from liliapi.paginations import *
+from liliapi.negotiations import *
 from liliapi.authentication import *
 from liliapi.tasks import *
 
@@ -32,6 +33,61 @@ from liliapi.tasks import *
 
 
 LIST_DELIMETER = settings.LIST_DELIMETER
+REPORT_FORMAT_MESSAGE = "Unknown report format, the format must be one of: " + ", ".join(ReportWriter.get_formats())
+
+
+def get_report_format(report_format):
+    # default to JSON, and return None if the requested format is unknown
+    # (or is not a string, as the format in a JSON request body can be any JSON value)
+    if report_format is None or report_format == '':
+        return 'json'
+    if not isinstance(report_format, str):
+        return None
+    report_format = report_format.lower()
+    return report_format if report_format in ReportWriter.get_formats() else None
+
+
+def get_report_cache_param(value):
+    # normalize a list of IDs or names (either a delimited string or a list) for the report cache key,
+    # so that the same selection in a different order or with duplicates is the same request
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.split(LIST_DELIMETER)
+    return sorted({str(item).strip() for item in value})
+
+
+def get_existing_report_response(report_name, report_file):
+    # the response to a report request whose report file already exists: either it is a cached completed report,
+    # or the same request by the same user is still in progress (in which case no duplicate task is sent)
+    if report_file.status_id == 1:
+        message = "Request for {0} already in progress.".format(report_name)
+    else:
+        message = "{0} found in cache.".format(report_name)
+    return JsonResponse({"message": message, "report_file": report_file.id}, status=200)
+
+
+def get_report_task_options(samples):
+    # the queue and priority of a report task, by the estimated size of the report: the number of its samples
+    # (a delimited string or a list of IDs, or all the samples if there are none)
+    all_sample_count = None
+    if samples:
+        sample_count = len(get_report_cache_param(samples))
+    else:
+        sample_count = all_sample_count = Sample.objects.count()
+    heavy_sample_count = settings.REPORT_HEAVY_SAMPLE_COUNT
+    # within its queue, the smaller the report, the higher its priority: from the max priority for an empty report
+    # down to zero for the largest report of the queue (a report of all the samples, in the heavy reports queue)
+    if sample_count > heavy_sample_count:
+        queue = settings.REPORT_QUEUE_HEAVY
+        if all_sample_count is None:
+            all_sample_count = Sample.objects.count()
+        size = (sample_count - heavy_sample_count) / max(all_sample_count - heavy_sample_count, 1)
+    else:
+        queue = settings.REPORT_QUEUE_LIGHT
+        size = sample_count / max(heavy_sample_count, 1)
+    max_priority = settings.CELERY_TASK_QUEUE_MAX_PRIORITY
+    return {"queue": queue, "priority": max_priority - round(max_priority * min(size, 1))}
 
 
 ######
@@ -100,11 +156,9 @@ class SampleViewSet(HistoryViewSet):
                 target_list = [target]
                 queryset = queryset.filter(finalsamplemeanconcentrations__target__exact=target)
 
-        # recalc reps validity
-        for sample in queryset:
-            fsmcs = FinalSampleMeanConcentration.objects.filter(sample=sample.id, target__in=target_list)
-            for fsmc in fsmcs:
-                recalc_reps('FinalSampleMeanConcentration', sample.id, target=fsmc.target.id, recalc_rep_conc=False)
+        # recalc only the stale FSMCs (and their reps), the rest are served as stored
+        FinalSampleMeanConcentration.objects.recalc_stale(
+            FinalSampleMeanConcentration.objects.filter(sample__in=queryset, target__in=target_list))
 
         # start building up the response object
         resp = []
@@ -469,29 +523,41 @@ class ConcentrationTypeViewSet(HistoryViewSet):
 class FinalSampleMeanConcentrationViewSet(HistoryViewSet):
     serializer_class = FinalSampleMeanConcentrationSerializer
 
-    @action(detail=False)
+    @action(detail=False, content_negotiation_class=ReportContentNegotiation)
     def summary_statistics(self, request):
         sample = request.query_params.get('sample', None)
         target = request.query_params.get('target', None)
         statistic = request.query_params.get('statistic', None)
-        report_type = ReportType.objects.filter(id=2).first()
-        status = Status.objects.filter(id=1).first()
-        report_file = ReportFile.objects.create(
-            report_type=report_type, status=status, created_by=request.user, modified_by=request.user)
-        task = generate_results_summary_report.delay(sample, target, statistic, report_file.id, request.user.username)
-        monitor_task.delay(task.id, datetime.now().strftime('%Y-%m-%d_%H:%M:%S'), report_file.id)
+        report_format = get_report_format(request.query_params.get('format', None))
+        if report_format is None:
+            return JsonResponse({"format": REPORT_FORMAT_MESSAGE}, status=400)
+        # serve the report from the cache if the same report was already generated from the current data
+        report_file, created = ReportFile.objects.get_or_create_for_request(
+            2, request.user, sample=get_report_cache_param(sample), target=get_report_cache_param(target),
+            statistic=get_report_cache_param(statistic), format=report_format)
+        if not created:
+            return get_existing_report_response("Results Summary Report", report_file)
+        generate_results_summary_report.apply_async(
+            (sample, target, statistic, report_file.id, request.user.username, report_format),
+            task_id=report_file.task_id, **get_report_task_options(sample))
         return JsonResponse({"message": "Request for Results Summary Report received."}, status=200)
 
-    @action(detail=False)
+    @action(detail=False, content_negotiation_class=ReportContentNegotiation)
     def results(self, request):
         sample = request.query_params.get('sample', None)
         target = request.query_params.get('target', None)
-        report_type = ReportType.objects.filter(id=3).first()
-        status = Status.objects.filter(id=1).first()
-        report_file = ReportFile.objects.create(
-            report_type=report_type, status=status, created_by=request.user, modified_by=request.user)
-        task = generate_individual_sample_report.delay(sample, target, report_file.id, request.user.username)
-        monitor_task.delay(task.id, datetime.now().strftime('%Y-%m-%d_%H:%M:%S'), report_file.id)
+        report_format = get_report_format(request.query_params.get('format', None))
+        if report_format is None:
+            return JsonResponse({"format": REPORT_FORMAT_MESSAGE}, status=400)
+        # serve the report from the cache if the same report was already generated from the current data
+        report_file, created = ReportFile.objects.get_or_create_for_request(
+            3, request.user, sample=get_report_cache_param(sample), target=get_report_cache_param(target),
+            format=report_format)
+        if not created:
+            return get_existing_report_response("Individual Sample Report", report_file)
+        generate_individual_sample_report.apply_async(
+            (sample, target, report_file.id, request.user.username, report_format),
+            task_id=report_file.task_id, **get_report_task_options(sample))
         return JsonResponse({"message": "Request for Individual Sample Report received."}, status=200)
 
 
@@ -503,7 +569,7 @@ class FinalSampleMeanConcentrationViewSet(HistoryViewSet):
     # build a queryset using query_params
     # NOTE: this is being done in its own method to adhere to the DRY Principle
     def build_queryset(self, query_params):
-        queryset = FinalSampleMeanConcentration.objects.all()
+        queryset = FinalSampleMeanConcentration.objects.select_related('sample', 'target', 'created_by', 'modified_by')
         # filter by sample ID, exact list
         sample = query_params.get('sample', None)
         if sample is not None:
@@ -530,17 +596,36 @@ class FinalSampleMeanConcentrationViewSet(HistoryViewSet):
             collaborator_sample_id_list = sample.split(',')
             queryset = queryset.filter(sample__collaborator_sample_id__in=collaborator_sample_id_list)
 
-        # recalc reps validity
-        for fsmc in queryset:
-            recalc_reps('FinalSampleMeanConcentration', fsmc.sample.id, target=fsmc.target.id, recalc_rep_conc=False)
-
         return queryset
 
-    # override the default GET method to recalc all child PCR Replicates first before the FSMC Select query
+    # override the default list method to recalc only the stale FSMCs (and their reps) of the page being served
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            stale_ids = [fsmc.id for fsmc in page if fsmc.recalc_pending]
+            if stale_ids:
+                FinalSampleMeanConcentration.objects.recalc_stale(
+                    FinalSampleMeanConcentration.objects.filter(id__in=stale_ids))
+                for fsmc in page:
+                    if fsmc.id in stale_ids:
+                        fsmc.refresh_from_db()
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        FinalSampleMeanConcentration.objects.recalc_stale(queryset)
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data)
+
+    # override the default GET method to recalc the FSMC (and its reps) first, but only if it is stale
     def retrieve(self, request, *args, **kwargs):
-        recalc_reps('FinalSampleMeanConcentration',
-                    self.get_object().sample.id, target=self.get_object().target.id, recalc_rep_conc=False)
-        return super(FinalSampleMeanConcentrationViewSet, self).retrieve(request, *args, **kwargs)
+        instance = self.get_object()
+        if instance.recalc_pending:
+            FinalSampleMeanConcentration.objects.recalc_stale(
+                FinalSampleMeanConcentration.objects.filter(id=instance.id))
+            instance.refresh_from_db()
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
 
 
 ######
@@ -738,8 +823,11 @@ class ExtractionBatchViewSet(HistoryViewSet):
                         response_errors.append({"extractionbatch": message})
             if is_valid:
                 # now that all items are proven valid, save and return them to the user
+                # (in one unit of work, so that each recalculation triggered by the saves is only run once)
+                with recalc_unit_of_work():
+                    for item in valid_data:
+                        item.save()
                 for item in valid_data:
-                    item.save()
                     response_data.append(item.data)
                 return JsonResponse(response_data, safe=False, status=200)
             else:
@@ -816,8 +904,11 @@ class ReverseTranscriptionViewSet(HistoryViewSet):
                             {"reversetranscription": "No ReverseTranscription exists with this ID: " + str(rt_id)})
             if is_valid:
                 # now that all items are proven valid, save and return them to the user
+                # (in one unit of work, so that each recalculation triggered by the saves is only run once)
+                with recalc_unit_of_work():
+                    for item in valid_data:
+                        item.save()
                 for item in valid_data:
-                    item.save()
                     response_data.append(item.data)
                 return JsonResponse(response_data, safe=False, status=200)
             else:
@@ -841,15 +932,20 @@ class SampleExtractionViewSet(HistoryViewSet):
     queryset = SampleExtraction.objects.all()
     serializer_class = SampleExtractionSerializer
 
-    @action(detail=False)
+    @action(detail=False, content_negotiation_class=ReportContentNegotiation)
     def inhibition_report(self, request):
         sample = request.query_params.get('sample', None)
-        report_type = ReportType.objects.filter(id=1).first()
-        status = Status.objects.filter(id=1).first()
-        report_file = ReportFile.objects.create(
-            report_type=report_type, status=status, created_by=request.user, modified_by=request.user)
-        task = generate_inhibition_report.delay(sample, report_file.id, request.user.username)
-        monitor_task.delay(task.id, datetime.now().strftime('%Y-%m-%d_%H:%M:%S'), report_file.id)
+        report_format = get_report_format(request.query_params.get('format', None))
+        if report_format is None:
+            return JsonResponse({"format": REPORT_FORMAT_MESSAGE}, status=400)
+        # serve the report from the cache if the same report was already generated from the current data
+        report_file, created = ReportFile.objects.get_or_create_for_request(
+            1, request.user, sample=get_report_cache_param(sample), format=report_format)
+        if not created:
+            return get_existing_report_response("Inhibition Report", report_file)
+        generate_inhibition_report.apply_async(
+            (sample, report_file.id, request.user.username, report_format),
+            task_id=report_file.task_id, **get_report_task_options(sample))
         return JsonResponse({"message": "Request for Inhibition Report received."}, status=200)
 
     # override the default DELETE method to prevent deletion of a SampleExtraction with any results data entered
@@ -921,8 +1017,11 @@ class PCRReplicateViewSet(HistoryViewSet):
                         response_errors.append({"pcrreplicate": "No PCRReplicate exists with this ID: " + str(rep_id)})
             if is_valid:
                 # now that all items are proven valid, save and return them to the user
+                # (in one unit of work, so that each recalculation triggered by the saves is only run once)
+                with recalc_unit_of_work():
+                    for item in valid_data:
+                        item.save()
                 for item in valid_data:
-                    item.save()
                     response_data.append(item.data)
                 return JsonResponse(response_data, safe=False, status=200)
             else:
@@ -1033,15 +1132,14 @@ class PCRReplicateBatchViewSet(HistoryViewSet):
 
         if is_valid:
             # now that all items are proven valid, save and return them to the user
+            # (in one unit of work, so that each recalculation triggered by the saves is only run once)
             response_data = []
+            with recalc_unit_of_work():
+                for item in valid_data:
+                    item.save()
+                    # recalc the child rep validity
+                    recalc_reps('PCRReplicateBatch', item.instance.id, recalc_rep_conc=False)
             for item in valid_data:
-                item.save()
-                # recalc the child rep validity
-                reps = PCRReplicate.objects.filter(pcrreplicate_batch=item.data['id'])
-                for rep in reps:
-                    if rep.invalid_override is None:
-                        rep.invalid = rep.calc_invalid()
-                        rep.save()
                 response_data.append(item.data)
             return JsonResponse(response_data, safe=False, status=200)
         else:
@@ -1336,8 +1434,11 @@ class InhibitionViewSet(HistoryViewSet):
                         response_errors.append({"inhibition": "No Inhibition exists with this ID: " + str(inhib)})
             if is_valid:
                 # now that all items are proven valid, save and return them to the user
+                # (in one unit of work, so that each recalculation triggered by the saves is only run once)
+                with recalc_unit_of_work():
+                    for item in valid_data:
+                        item.save()
                 for item in valid_data:
-                    item.save()
                     response_data.append(item.data)
                 return JsonResponse(response_data, safe=False, status=200)
             else:
@@ -1521,12 +1622,17 @@ class QualityControlReportView(views.APIView):
     def post(self, request):
         request_data = JSONParser().parse(request)
         samples = request_data.get('samples', None)
-        report_type = ReportType.objects.filter(id=4).first()
-        status = Status.objects.filter(id=1).first()
-        report_file = ReportFile.objects.create(
-            report_type=report_type, status=status, created_by=request.user, modified_by=request.user)
-        task = generate_quality_control_report.delay(samples, report_file.id, request.user.username)
-        monitor_task.delay(task.id, datetime.now().strftime('%Y-%m-%d_%H:%M:%S'), report_file.id)
+        report_format = get_report_format(request_data.get('format', None))
+        if report_format is None:
+            return JsonResponse({"format": REPORT_FORMAT_MESSAGE}, status=400)
+        # serve the report from the cache if the same report was already generated from the current data
+        report_file, created = ReportFile.objects.get_or_create_for_request(
+            4, request.user, samples=get_report_cache_param(samples), format=report_format)
+        if not created:
+            return get_existing_report_response("Quality Control Report", report_file)
+        generate_quality_control_report.apply_async(
+            (samples, report_file.id, request.user.username, report_format),
+            task_id=report_file.task_id, **get_report_task_options(samples))
         return JsonResponse({"message": "Request for Inhibition Report received."}, status=200)
 
 
@@ -1537,12 +1643,18 @@ class ControlsResultsReportView(views.APIView):
         request_data = JSONParser().parse(request)
         sample_ids = request_data.get('samples', None)
         target_ids = request_data.get('targets', None)
-        report_type = ReportType.objects.filter(id=5).first()
-        status = Status.objects.filter(id=1).first()
-        report_file = ReportFile.objects.create(
-            report_type=report_type, status=status, created_by=request.user, modified_by=request.user)
-        task = generate_control_results_report.delay(sample_ids, target_ids, report_file.id, request.user.username)
-        monitor_task.delay(task.id, datetime.now().strftime('%Y-%m-%d_%H:%M:%S'), report_file.id)
+        report_format = get_report_format(request_data.get('format', None))
+        if report_format is None:
+            return JsonResponse({"format": REPORT_FORMAT_MESSAGE}, status=400)
+        # serve the report from the cache if the same report was already generated from the current data
+        report_file, created = ReportFile.objects.get_or_create_for_request(
+            5, request.user, samples=get_report_cache_param(sample_ids), targets=get_report_cache_param(target_ids),
+            format=report_format)
+        if not created:
+            return get_existing_report_response("Control Results Report", report_file)
+        generate_control_results_report.apply_async(
+            (sample_ids, target_ids, report_file.id, request.user.username, report_format),
+            task_id=report_file.task_id, **get_report_task_options(sample_ids))
         return JsonResponse({"message": "Request for Control Results Report received."}, status=200)
 
 
@@ -1550,6 +1662,15 @@ class ReportFileViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = ReportFileSerializer
 
+    # the metrics of the phases of the recent report tasks, aggregated by report type (staff only)
+    @action(detail=False, permission_classes=(permissions.IsAuthenticated, IsStaff))
+    def metrics(self, request):
+        # the number of the most recent completed reports of each report type to aggregate
+        runs = request.query_params.get('runs', '50')
+        if not runs.isdigit() or int(runs) < 1:
+            return JsonResponse({"runs": "runs must be a positive integer"}, status=400)
+        return Response(ReportFile.objects.get_phase_metrics_summary(int(runs)))
+
     def get_queryset(self):
         queryset = ReportFile.objects.all()
         query_params = self.request.query_params
@@ -1561,6 +1682,14 @@ class ReportFileViewSet(viewsets.ReadOnlyModelViewSet):
                 queryset = queryset.filter(report_type__in=report_type_list)
             else:
                 queryset = queryset.filter(report_type__exact=report_type)
+        # filter by status, exact list (e.g. to follow the progress of the reports still in progress)
+        status = query_params.get('status', None)
+        if status is not None:
+            if LIST_DELIMETER in status:
+                status_list = status.split(LIST_DELIMETER)
+                queryset = queryset.filter(status__in=status_list)
+            else:
+                queryset = queryset.filter(status__exact=status)
         return queryset
 
 
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 
 import os
 from django.utils.six import moves
+from kombu import Exchange, Queue
 
 SETTINGS_DIR = os.path.dirname(__file__)
 PROJECT_PATH = os.path.join(SETTINGS_DIR, os.pardir)
@@ -161,5 +162,75 @@ CELERY_TASK_IGNORE_RESULT = False
 CELERY_TRACK_STARTED = True
 CELERY_TASK_TRACK_STARTED = True
 
-TASK_SLEEP = 10
-TASK_TIMEOUT = 10800  # (10800 seconds == 3 hours)
+# the tasks are split into queues, each consumed by its own worker node (see default_celeryd for the concurrency
+# of each node), so that heavy reports cannot starve the small reports and the maintenance tasks:
+# the report views send each report task to the heavy or the light reports queue by the estimated size of the report
+# (the number of its samples, see REPORT_HEAVY_SAMPLE_COUNT), and the other tasks are routed here
+REPORT_QUEUE_HEAVY = 'reports-heavy'
+REPORT_QUEUE_LIGHT = 'reports-light'
+MAINTENANCE_QUEUE = 'maintenance'
+REPORT_HEAVY_SAMPLE_COUNT = 500  # reports of more samples than this are heavy
+CELERY_TASK_QUEUES = tuple(Queue(queue, Exchange(queue), routing_key=queue)
+                           for queue in (REPORT_QUEUE_HEAVY, REPORT_QUEUE_LIGHT, MAINTENANCE_QUEUE))
+CELERY_TASK_DEFAULT_QUEUE = REPORT_QUEUE_LIGHT
+CELERY_TASK_ROUTES = {
+    'report_chunk_task': {'queue': REPORT_QUEUE_HEAVY},
+    'merge_report_chunks_task': {'queue': REPORT_QUEUE_HEAVY},
+    'recalc_pending_task': {'queue': MAINTENANCE_QUEUE},
+    'report_watchdog_task': {'queue': MAINTENANCE_QUEUE},
+    'report_retention_task': {'queue': MAINTENANCE_QUEUE},
+}
+# the report views give each report task a priority within its queue (higher first) by the estimated size of the
+# report, so that the smaller reports of a queue go first
+# (the queues are declared with the max priority, and each worker reserves only one task per process at a time,
+# since the priorities cannot reorder the tasks a worker has already reserved)
+CELERY_TASK_QUEUE_MAX_PRIORITY = 9
+CELERY_TASK_DEFAULT_PRIORITY = 5
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# the reports still in progress longer than the timeout of their report type (by report type ID) after they were
+# requested are marked failed (and their tasks terminated) by a watchdog task run by celery beat
+# (run `celery -A liliservices beat` alongside the workers)
+TASK_TIMEOUT = 10800  # (10800 seconds == 3 hours) for the report types not in REPORT_TASK_TIMEOUTS
+REPORT_TASK_TIMEOUTS = {}
+REPORT_WATCHDOG_INTERVAL = 60  # seconds between the scans of the watchdog
+
+# the report files are deleted by a retention task run by celery beat, by these policies (None turns a policy off),
+# except those in progress and those still valid cached results of their request
+REPORT_RETENTION_INTERVAL = 3600  # seconds between the runs of the retention task
+REPORT_RETENTION_MAX_AGE_DAYS = 7  # report files created more than this many days ago are deleted
+REPORT_RETENTION_MAX_PER_TYPE = 10  # only the most recent report files of each report type are kept
+REPORT_RETENTION_MAX_PER_USER = None  # only the most recent report files of each user are kept
+REPORT_RETENTION_MAX_BYTES = None  # the oldest report files are deleted until the total size of those in
+                                   # media/reports is within this quota
+REPORT_RETENTION_BATCH_SIZE = 500  # report files deleted per query
+
+# the periodic tasks run by celery beat
+CELERY_BEAT_SCHEDULE = {
+    'report-watchdog': {
+        'task': 'report_watchdog_task',
+        'schedule': REPORT_WATCHDOG_INTERVAL,
+        # a scan not yet started by the next one is dropped
+        'options': {'expires': REPORT_WATCHDOG_INTERVAL}
+    },
+    'report-retention': {
+        'task': 'report_retention_task',
+        'schedule': REPORT_RETENTION_INTERVAL,
+        'options': {'expires': REPORT_RETENTION_INTERVAL}
+    }
+}
+
+# the report tasks record the metrics of each of their phases on their report file, including the peak memory
+# allocated if this is set (tracing the memory allocations with tracemalloc slows the tasks down somewhat)
+REPORT_TASK_TRACE_MEMORY = True
+
+# large inhibition and individual sample reports are split into chunks of samples generated in parallel by the
+# celery workers, and then merged into the report file
+REPORT_TASK_CHUNK_SIZE = 500  # samples per chunk
+REPORT_TASK_MAX_CHUNKS = 4  # chunks per report at most (larger reports get larger chunks), best matching the
+                            # concurrency of the heavy reports worker node
+
+# recalculations of PCR replicates triggered by saves of their parent records are run by a celery worker
+# (set RECALC_ASYNC to False to run them within the request instead)
+RECALC_ASYNC = True
+RECALC_COUNTDOWN = 5  # seconds to wait for more saves to merge into the same recalculation